@@ -0,0 +1,99 @@
+# activity.py
+# -*- coding: utf-8 -*-
+"""Асинхронний запис ActivityLog.
+
+Ендпоінти викликають record() — подія кладеться в обмежену чергу воркера без
+блокування. Фоновий flush() пише події пакетами: executemany на SQLite,
+багаторядковий INSERT на PostgreSQL. Якщо черга повна, подія відкидається й
+рахується в лічильнику dropped.
+"""
+import os
+import json
+import queue
+import logging
+import threading
+from datetime import datetime, timezone
+
+from sqlalchemy import insert
+
+from models import db, ActivityLog
+
+ACTIVITY_QUEUE_SIZE = int(os.getenv("ACTIVITY_QUEUE_SIZE", "10000"))
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv("ACTIVITY_FLUSH_INTERVAL", "2"))   # сек
+ACTIVITY_BATCH_SIZE = int(os.getenv("ACTIVITY_BATCH_SIZE", "500"))
+
+log = logging.getLogger(__name__)
+_queue = queue.Queue(maxsize=ACTIVITY_QUEUE_SIZE)
+_stats_lock = threading.Lock()
+_stats = {"enqueued": 0, "dropped": 0, "written": 0, "failed": 0, "batches": 0}
+_flush_lock = threading.Lock()
+
+
+def _bump(name: str, n: int = 1):
+    with _stats_lock:
+        _stats[name] += n
+
+
+def mask(secret: str) -> str:
+    """Для логів: лише останні 4 символи ключа."""
+    secret = str(secret or "")
+    return "…" + secret[-4:] if len(secret) > 4 else "…"
+
+
+def record(action: str, /, **details):
+    """Неблокуюче додає подію в чергу."""
+    row = {
+        "action": action[:64],
+        "details": json.dumps(details, ensure_ascii=False, default=str) if details else None,
+        "created_at": datetime.now(timezone.utc),
+    }
+    try:
+        _queue.put_nowait(row)
+    except queue.Full:
+        _bump("dropped")
+        return
+    _bump("enqueued")
+
+
+def _write(rows):
+    t = ActivityLog.__table__
+    if db.engine.dialect.name == "postgresql":
+        # один багаторядковий INSERT ... VALUES (...), (...)
+        db.session.execute(insert(t).values(rows))
+    else:
+        db.session.execute(insert(t), rows)
+    db.session.commit()
+
+
+def flush() -> int:
+    """Вигрібає чергу пакетами по ACTIVITY_BATCH_SIZE. Повертає кількість записаних подій."""
+    written = 0
+    with _flush_lock:
+        while True:
+            rows = []
+            while len(rows) < ACTIVITY_BATCH_SIZE:
+                try:
+                    rows.append(_queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not rows:
+                break
+            try:
+                _write(rows)
+            except Exception:
+                db.session.rollback()
+                _bump("failed", len(rows))
+                log.exception("activity: batch of %d events lost", len(rows))
+                break
+            _bump("written", len(rows))
+            _bump("batches")
+            written += len(rows)
+    return written
+
+
+def stats() -> dict:
+    with _stats_lock:
+        out = dict(_stats)
+    out["queued"] = _queue.qsize()
+    out["capacity"] = ACTIVITY_QUEUE_SIZE
+    return out
@@ -2,15 +2,17 @@
 # -*- coding: utf-8 -*-
 import os
 import base64
-from datetime import datetime, timezone
+import threading
+from datetime import datetime, timezone, timedelta
 from hmac import compare_digest
 
 from flask import (
-    Flask, request, jsonify, Response, send_from_directory, send_file
+    Flask, request, jsonify, Response, send_from_directory, send_file, stream_with_context
 )
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from sqlalchemy import text, inspect
+import click
+from sqlalchemy import update, select, delete, func, or_
 
 # ======== Flask / DB ========
 app = Flask(__name__, static_url_path="", static_folder="static")
@@ -27,9 +29,34 @@ app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.config["JSON_AS_ASCII"] = False
 
 # Якщо моделі окремо — імпортуємо
-from models import db, License, ApiKey, Config, Price, ActivityLog  # noqa: E402
+from models import db, License, ApiKey, Config, Price, ActivityLog, CreditLedger  # noqa: E402
+import migrations  # noqa: E402
+import idempotency  # noqa: E402
+from idempotency import idempotent  # noqa: E402
+import catalog  # noqa: E402
+import leases  # noqa: E402
+import writebehind  # noqa: E402
+import activity  # noqa: E402
+import queries  # noqa: E402
+import bulk  # noqa: E402
+import background  # noqa: E402
+import metrics  # noqa: E402
+import profiling  # noqa: E402
+import dbpool  # noqa: E402
+import replica  # noqa: E402
+import ledger  # noqa: E402
+import rollups  # noqa: E402
+import retention  # noqa: E402
+import ratelimit  # noqa: E402
+import assets  # noqa: E402
+from replica import read_only  # noqa: E402
 
+# пул зʼєднань: розміри / pre-ping / recycle / таймаути з env (див. dbpool.py)
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = dbpool.engine_options(app.config["SQLALCHEMY_DATABASE_URI"])
+# опційна репліка для читання (REPLICA_DATABASE_URL, див. replica.py)
+app.config["SQLALCHEMY_BINDS"] = replica.bind_config()
 db.init_app(app)
+dbpool.init_app(app)
 
 # ======== Адмін креденшли ========
 ADMIN_USER = os.getenv("ADMIN_USER", "admin")
@@ -54,100 +81,87 @@ def _require_admin():
         return Response("Unauthorized", 401, {"WWW-Authenticate": 'Basic realm="admin"'})
     return None
 
-# ======== Авто-міграції (легкі) ========
-def _ensure_columns_exist():
-    """Додає прості колонки в існуючих таблицях, якщо їх нема (PostgreSQL)."""
-    eng = db.engine
-    insp = inspect(eng)
-
-    def has_table(tname: str) -> bool:
-        try:
-            insp.get_columns(tname)
-            return True
-        except Exception:
-            return False
-
-    def ensure(table: str, colname: str, ddl_sql: str):
-        if not has_table(table):
-            return
-        cols = {c["name"] for c in insp.get_columns(table)}
-        if colname not in cols:
-            with eng.connect() as con:
-                con.execute(text(f"ALTER TABLE {table} ADD COLUMN {ddl_sql};"))
-                con.commit()
-
-    # config.updated_at
-    ensure("config", "updated_at", "updated_at TIMESTAMPTZ DEFAULT now()")
-    # price.updated_at
-    ensure("price", "updated_at", "updated_at TIMESTAMPTZ DEFAULT now()")
-    # api_key.in_use / api_key.note (на випадок відсутності)
-    ensure("api_key", "in_use", "in_use BOOLEAN DEFAULT FALSE")
-    ensure("api_key", "note", "note TEXT")
-    # license.last_active (якщо раптом нема)
-    ensure("license", "last_active", "last_active TIMESTAMPTZ")
-
-def _ensure_base_schema():
-    """create_all + первинна ініціалізація config та price"""
-    db.create_all()
-
-    # гарантія наявності колонок
-    _ensure_columns_exist()
-
-    # CONFIG (єдиний рядок)
-    if not Config.query.first():
-        cfg = Config(
-            latest_version="2.3.3",
-            force_update=False,
-            maintenance=False,
-            maintenance_message="",
-            update_links="[]",
-            update_description="",
-            updated_at=datetime.now(timezone.utc),
-        )
-        db.session.add(cfg)
+# ======== Схема БД (версійовані міграції, див. migrations.py) ========
+with app.app_context():
+    # під `flask db-upgrade` та іншими командами міграції робить сама команда
+    if not background.CLI_COMMAND:
+        migrations.ensure_current()
+    metrics.init_app(app, db.engine)
+    profiling.init_app(app)
+    replica.init_app(app)
+    ratelimit.init_app(app)
 
-    # PRICES (якщо порожньо — піднімаємо дефолт)
-    if Price.query.count() == 0:
-        defaults = {
-            "seedream-v4": 1,
-            "flux-dev": 1,
-            "flux-pro-v1-1": 2,
-            "gemini-2.5-flash": 1,
-            "imagen3": 2,
-            "classic-fast": 1,
-        }
-        for model_id, val in defaults.items():
-            db.session.add(Price(
-                model=model_id,
-                price=int(val),
-                updated_at=datetime.now(timezone.utc),
-            ))
-    db.session.commit()
+@app.cli.command("db-upgrade")
+def db_upgrade_command():
+    """Застосувати міграції схеми (запускати перед деплоєм)."""
+    applied = migrations.upgrade()
+    for num, name in applied:
+        click.echo(f"applied {num}: {name}")
+    click.echo(f"schema version {migrations.latest_version()}")
 
-with app.app_context():
-    _ensure_base_schema()
+@app.cli.command("db-version")
+def db_version_command():
+    """Показати поточну та останню версію схеми."""
+    with db.engine.connect() as conn:
+        click.echo(f"current {migrations.current_version(conn)}, latest {migrations.latest_version()}")
+
+@app.cli.command("logs-partition")
+def logs_partition_command():
+    """PostgreSQL: секціонувати activity_log по місяцях (старі секції ретеншн видаляє DROP)."""
+    if migrations.partition_activity_log(months_ahead=retention.LOG_PARTITION_AHEAD):
+        click.echo("activity_log partitioned by month")
+    else:
+        click.echo("activity_log is already partitioned")
+
+# ======== Фонові задачі воркера ========
+background.every(app, "idempotency-sweep", idempotency.IDEMPOTENCY_SWEEP_EVERY, idempotency.sweep_expired)
+background.every(app, "apikey-reclaim", leases.API_KEY_RECLAIM_INTERVAL, leases.reclaim)
+background.every(app, "last-active-flush", writebehind.LAST_ACTIVE_FLUSH_INTERVAL, writebehind.flush)
+background.on_shutdown(app, writebehind.flush)
+background.every(app, "activity-flush", activity.ACTIVITY_FLUSH_INTERVAL, activity.flush)
+background.on_shutdown(app, activity.flush)
+background.every(app, "ledger-compact", ledger.LEDGER_COMPACT_INTERVAL, ledger.compact)
+background.every(app, "stats-rollup", rollups.ROLLUP_INTERVAL, rollups.run)
+background.every(app, "log-retention", retention.LOG_PURGE_INTERVAL, retention.run)
+background.every(app, "ratelimit-sweep", ratelimit.RATE_LIMIT_SWEEP_INTERVAL, ratelimit.sweep)
+background.every(app, "metrics-flush", metrics.METRICS_FLUSH_INTERVAL, metrics.flush)
+
+# ======== Сервінг адмінки (з памʼяті, див. assets.py) ========
+if not background.CLI_COMMAND:
+    assets.build()
 
-# ======== Сервінг адмінки ========
 @app.get("/")
 def root():
-    return send_from_directory("static", "admin.html")
+    return assets.response("/")
 
 @app.get("/admin")
 def admin_html():
-    return send_from_directory("static", "admin.html")
+    return assets.response("/admin")
 
 @app.get("/admin.js")
 def admin_js():
-    return send_from_directory("static", "admin.js")
+    return assets.response("/admin.js")
 
 @app.get("/admin.css")
 def admin_css():
-    return send_from_directory("static", "admin.css")
+    return assets.response("/admin.css")
+
+@app.get("/assets/<name>")
+def admin_asset(name):
+    return assets.response(f"/assets/{name}")
 
 @app.get("/healthz")
 def healthz():
     return jsonify(ok=True, time=datetime.utcnow().isoformat() + "Z")
 
+@app.get("/metrics")
+def metrics_endpoint():
+    # Prometheus scrape (basic_auth адміна); агрегує всі воркери, див. metrics.py
+    unauth = _require_admin()
+    if unauth:
+        return unauth
+    return Response(metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
 # ======== ADMIN API ========
 @app.get("/admin_api/login")
 def admin_login():
@@ -158,12 +172,19 @@ def admin_login():
 
 # ---- Licenses
 @app.get("/admin_api/licenses")
+@read_only
 def admin_list_licenses():
     unauth = _require_admin();  # noqa: E702
     if unauth: return unauth    # noqa: E701
-    qs = License.query.order_by(License.id.desc()).all()
+    # keyset по id: ?cursor=<id останнього рядка>&limit=&status=&mac=&q=
+    rows, next_cursor = queries.keyset_page(
+        License.id,
+        (License.id, License.key, License.mac_id, License.status, License.credit, License.last_active),
+        queries.license_filters(request.args),
+        request.args,
+    )
     out = []
-    for x in qs:
+    for x in rows:
         out.append({
             "id": x.id,
             "key": x.key,
@@ -172,7 +193,7 @@ def admin_list_licenses():
             "credit": x.credit,
             "last_active": x.last_active.isoformat() if x.last_active else None
         })
-    return jsonify(ok=True, items=out)
+    return jsonify(ok=True, items=out, next_cursor=next_cursor)
 
 @app.post("/admin_api/licenses")
 def admin_add_license():
@@ -189,8 +210,94 @@ def admin_add_license():
         return jsonify(ok=False, msg="Key exists"), 400
     lic = License(key=key, credit=credit, status=status, last_active=None)
     db.session.add(lic); db.session.commit()
+    activity.record("admin_add_license", id=lic.id, key=activity.mask(key), credit=credit, status=status)
     return jsonify(ok=True, id=lic.id)
 
+@app.post("/admin_api/licenses/import")
+def admin_import_licenses():
+    """Потоковий імпорт: CSV (key,credit,status[,mac_id]) або NDJSON; ?format=csv|ndjson."""
+    unauth = _require_admin()
+    if unauth:
+        return unauth
+    fmt = bulk.upload_format(request)
+    try:
+        credit = int(request.args.get("credit", 0))
+    except ValueError:
+        return jsonify(ok=False, msg="Invalid credit"), 400
+    defaults = {"credit": credit, "status": request.args.get("status", "active")}
+    try:
+        summary = bulk.import_licenses(bulk.iter_upload(request.stream, fmt), defaults)
+    except bulk.BulkError as e:
+        db.session.rollback()
+        if not (e.summary and e.summary["chunks"]):
+            return jsonify(ok=False, msg=str(e), line=e.line), 400
+        # чанки до помилки вже закомічені — кажемо, що саме потрапило в БД
+        activity.record("admin_import_licenses", inserted=e.summary["inserted"],
+                        duplicates=e.summary["duplicates"], failed_line=e.line)
+        return jsonify(ok=False, msg=str(e), line=e.line, partial=e.summary), 400
+    activity.record("admin_import_licenses", inserted=summary["inserted"], duplicates=summary["duplicates"])
+    return jsonify(ok=True, **summary)
+
+@app.post("/admin_api/licenses/generate")
+def admin_generate_licenses():
+    """Генерація пачки ліцензій: {count, prefix, credit, status}. Повертає створені ключі."""
+    unauth = _require_admin()
+    if unauth:
+        return unauth
+    j = request.json or {}
+    count = int(j.get("count", 0))
+    prefix = str(j.get("prefix", "")).strip()
+    if count <= 0 or count > bulk.BULK_GENERATE_MAX:
+        return jsonify(ok=False, msg=f"count must be 1..{bulk.BULK_GENERATE_MAX}"), 400
+    defaults = {"credit": int(j.get("credit", 0)), "status": str(j.get("status", "active"))}
+    items = ({"key": k} for k in bulk.generate_license_keys(count, prefix))
+    summary = bulk.import_licenses(items, defaults, collect_keys=True)
+    activity.record("admin_generate_licenses", prefix=prefix, inserted=summary["inserted"])
+    return jsonify(ok=True, **summary)
+
+_LICENSE_BULK_ACTIONS = ("activate", "suspend", "unbind", "add_credit", "set_credit", "delete")
+
+@app.post("/admin_api/licenses/bulk")
+def admin_bulk_licenses():
+    """Одна set-based операція: {action, ids:[..]} або {action, filter:{status, mac, q, active_before}}."""
+    unauth = _require_admin()
+    if unauth:
+        return unauth
+    j = request.json or {}
+    action = str(j.get("action", "")).strip()
+    if action not in _LICENSE_BULK_ACTIONS:
+        return jsonify(ok=False, msg="Unknown action"), 400
+    try:
+        cond = queries.selection(License, j, queries.license_filters)
+    except queries.SelectionError as e:
+        return jsonify(ok=False, msg=str(e)), 400
+    if cond is None:
+        return jsonify(ok=False, msg="ids or filter required"), 400
+
+    if action == "delete":
+        stmt = delete(License).where(*cond)
+    else:
+        if action == "activate":
+            values = {"status": "active"}
+        elif action == "suspend":
+            values = {"status": "inactive"}
+        elif action == "unbind":
+            values = {"mac_id": None}
+        else:
+            amount = j.get("amount", 0)
+            if not isinstance(amount, int) or isinstance(amount, bool):
+                return jsonify(ok=False, msg="Invalid amount"), 400
+            if action == "add_credit" and amount <= 0 or action == "set_credit" and amount < 0:
+                return jsonify(ok=False, msg="Invalid amount"), 400
+            values = {"credit": License.credit + amount if action == "add_credit" else amount}
+            ledger.record_adjustments(cond, amount, "add" if action == "add_credit" else "set")
+        stmt = update(License).where(*cond).values(**values)
+    affected = db.session.execute(stmt.execution_options(synchronize_session=False)).rowcount
+    db.session.commit()
+    activity.record("admin_bulk_licenses", action=action, affected=affected,
+                    ids=len(j.get("ids") or []), filter=j.get("filter"), amount=j.get("amount"))
+    return jsonify(ok=True, action=action, affected=affected)
+
 @app.delete("/admin_api/licenses/<int:lic_id>")
 def admin_del_license(lic_id):
     unauth = _require_admin()
@@ -199,27 +306,71 @@ def admin_del_license(lic_id):
     row = License.query.get(lic_id)
     if not row:
         return jsonify(ok=False, msg="Not found"), 404
+    key = row.key
     db.session.delete(row); db.session.commit()
+    activity.record("admin_del_license", id=lic_id, key=activity.mask(key))
     return jsonify(ok=True)
 
+@app.get("/admin_api/licenses/<int:lic_id>/usage")
+@read_only
+def admin_license_usage(lic_id):
+    """Історія кредиту з журналу: ?cursor=&limit=&model=&kind=&since=&until=&summary=1."""
+    unauth = _require_admin()
+    if unauth:
+        return unauth
+    bal = ledger.balance(lic_id)
+    if bal is None:
+        return jsonify(ok=False, msg="Not found"), 404
+    cond = ledger.usage_conditions(lic_id, request.args)
+    rows, next_cursor = queries.keyset_page(
+        CreditLedger.id,
+        (CreditLedger.id, CreditLedger.kind, CreditLedger.model, CreditLedger.units, CreditLedger.unit_price,
+         CreditLedger.amount, CreditLedger.balance_after, CreditLedger.created_at),
+        cond,
+        request.args,
+    )
+    items = [{
+        "id": x.id,
+        "kind": x.kind,
+        "model": x.model,
+        "units": x.units,
+        "unit_price": x.unit_price,
+        "amount": x.amount,
+        "balance_after": x.balance_after,
+        "created_at": x.created_at.isoformat() if x.created_at else None,
+    } for x in rows]
+    out = {"ok": True, "balance": bal, "items": items, "next_cursor": next_cursor}
+    if request.args.get("summary") in ("1", "true"):
+        out["summary"] = ledger.usage_summary(cond)
+    return jsonify(out)
+
 # ---- API Keys
 @app.get("/admin_api/apikeys")
+@read_only
 def admin_list_apikeys():
     unauth = _require_admin()
     if unauth:
         return unauth
-    qs = ApiKey.query.order_by(ApiKey.id.desc()).all()
+    # keyset по id: ?cursor=&limit=&status=&in_use=&q=
+    rows, next_cursor = queries.keyset_page(
+        ApiKey.id,
+        (ApiKey.id, ApiKey.api_key, ApiKey.status, ApiKey.in_use, ApiKey.last_used,
+         ApiKey.leased_until, ApiKey.note),
+        queries.apikey_filters(request.args),
+        request.args,
+    )
     out = []
-    for x in qs:
+    for x in rows:
         out.append({
             "id": x.id,
             "api_key": x.api_key,
             "status": x.status,
             "in_use": bool(x.in_use),
             "last_used": x.last_used.isoformat() if x.last_used else None,
+            "leased_until": x.leased_until.isoformat() if x.leased_until else None,
             "note": x.note or ""
         })
-    return jsonify(ok=True, items=out)
+    return jsonify(ok=True, items=out, next_cursor=next_cursor)
 
 @app.post("/admin_api/apikeys")
 def admin_add_apikey():
@@ -236,8 +387,30 @@ def admin_add_apikey():
         return jsonify(ok=False, msg="Duplicate key"), 400
     row = ApiKey(api_key=api_key, status=status, in_use=False, note=note, last_used=None)
     db.session.add(row); db.session.commit()
+    activity.record("admin_add_apikey", id=row.id, api_key=activity.mask(api_key), status=status)
     return jsonify(ok=True, id=row.id)
 
+@app.post("/admin_api/apikeys/import")
+def admin_import_apikeys():
+    """Потоковий імпорт: CSV (api_key,status,note) або NDJSON; ?format=csv|ndjson."""
+    unauth = _require_admin()
+    if unauth:
+        return unauth
+    fmt = bulk.upload_format(request)
+    defaults = {"status": request.args.get("status", "active")}
+    try:
+        summary = bulk.import_apikeys(bulk.iter_upload(request.stream, fmt), defaults)
+    except bulk.BulkError as e:
+        db.session.rollback()
+        if not (e.summary and e.summary["chunks"]):
+            return jsonify(ok=False, msg=str(e), line=e.line), 400
+        # чанки до помилки вже закомічені — кажемо, що саме потрапило в БД
+        activity.record("admin_import_apikeys", inserted=e.summary["inserted"],
+                        duplicates=e.summary["duplicates"], failed_line=e.line)
+        return jsonify(ok=False, msg=str(e), line=e.line, partial=e.summary), 400
+    activity.record("admin_import_apikeys", inserted=summary["inserted"], duplicates=summary["duplicates"])
+    return jsonify(ok=True, **summary)
+
 @app.post("/admin_api/apikeys/<int:pk>/toggle_use")
 def admin_toggle_api_use(pk):
     unauth = _require_admin()
@@ -247,10 +420,55 @@ def admin_toggle_api_use(pk):
     if not row:
         return jsonify(ok=False, msg="Not found"), 404
     row.in_use = not bool(row.in_use)
+    # ручне утримання — без терміну оренди
+    row.lease_token = None
+    row.leased_until = None
     row.last_used = datetime.now(timezone.utc)
     db.session.commit()
+    activity.record("admin_toggle_apikey", id=pk, in_use=bool(row.in_use))
     return jsonify(ok=True, in_use=bool(row.in_use))
 
+_APIKEY_BULK_ACTIONS = ("release", "activate", "deactivate", "delete")
+
+@app.post("/admin_api/apikeys/bulk")
+def admin_bulk_apikeys():
+    """Одна set-based операція: {action, ids:[..]} або {action, filter:{status, in_use, q}}."""
+    unauth = _require_admin()
+    if unauth:
+        return unauth
+    j = request.json or {}
+    action = str(j.get("action", "")).strip()
+    if action not in _APIKEY_BULK_ACTIONS:
+        return jsonify(ok=False, msg="Unknown action"), 400
+    try:
+        cond = queries.selection(ApiKey, j, queries.apikey_filters)
+    except queries.SelectionError as e:
+        return jsonify(ok=False, msg=str(e)), 400
+    if cond is None:
+        return jsonify(ok=False, msg="ids or filter required"), 400
+
+    if action == "delete":
+        stmt = delete(ApiKey).where(*cond)
+    else:
+        values = {"in_use": False, "lease_token": None, "leased_until": None}
+        if action == "activate":
+            values = {"status": "active"}
+        elif action == "deactivate":
+            values["status"] = "inactive"
+        stmt = update(ApiKey).where(*cond).values(**values)
+    affected = db.session.execute(stmt.execution_options(synchronize_session=False)).rowcount
+    db.session.commit()
+    activity.record("admin_bulk_apikeys", action=action, affected=affected,
+                    ids=len(j.get("ids") or []), filter=j.get("filter"))
+    return jsonify(ok=True, action=action, affected=affected)
+
+@app.get("/admin_api/apikeys/pool")
+def admin_apikeys_pool():
+    unauth = _require_admin()
+    if unauth:
+        return unauth
+    return jsonify(ok=True, pool=leases.pool_stats(), lease_ttl=leases.API_KEY_LEASE_TTL)
+
 @app.delete("/admin_api/apikeys/<int:pk>")
 def admin_delete_apikey(pk):
     unauth = _require_admin()
@@ -260,10 +478,12 @@ def admin_delete_apikey(pk):
     if not row:
         return jsonify(ok=False, msg="Not found"), 404
     db.session.delete(row); db.session.commit()
+    activity.record("admin_del_apikey", id=pk)
     return jsonify(ok=True)
 
 # ---- Config
 @app.get("/admin_api/config")
+@read_only
 def admin_get_config():
     unauth = _require_admin()
     if unauth:
@@ -312,11 +532,16 @@ def admin_set_config():
     cfg.update_links = str(links)
     cfg.update_description = str(j.get("update_description", cfg.update_description or ""))
     cfg.updated_at = datetime.now(timezone.utc)
+    catalog.bump_version()
     db.session.commit()
+    catalog.invalidate()
+    activity.record("admin_set_config", maintenance=bool(cfg.maintenance),
+                    force_update=bool(cfg.force_update), latest_version=cfg.latest_version)
     return jsonify(ok=True)
 
 # ---- Prices
 @app.get("/admin_api/prices")
+@read_only
 def admin_get_prices():
     unauth = _require_admin()
     if unauth:
@@ -343,63 +568,259 @@ def admin_set_price():
     else:
         row = Price(model=model_id, price=price_val, updated_at=datetime.now(timezone.utc))
         db.session.add(row)
+    catalog.bump_version()
     db.session.commit()
+    catalog.invalidate()
+    activity.record("admin_set_price", model=model_id, price=price_val)
     return jsonify(ok=True, id=row.id)
 
 # ---- Logs (read-only)
 @app.get("/admin_api/logs")
+@read_only
 def admin_get_logs():
     unauth = _require_admin()
     if unauth:
         return unauth
-    limit = int(request.args.get("limit", 200))
-    qs = ActivityLog.query.order_by(ActivityLog.id.desc()).limit(limit).all()
+    # keyset по id: ?cursor=&limit=&action=&since=&until=; archive=1 — з архівних сегментів
+    if request.args.get("archive") == "1":
+        items, next_cursor = retention.read_archive(request.args)
+        return jsonify(ok=True, items=items, next_cursor=next_cursor, archive=True)
+    rows, next_cursor = queries.keyset_page(
+        ActivityLog.id,
+        (ActivityLog.id, ActivityLog.action, ActivityLog.details, ActivityLog.created_at),
+        queries.log_filters(request.args),
+        request.args,
+    )
     out = []
-    for x in qs:
+    for x in rows:
         out.append({
             "id": x.id,
             "action": x.action,
             "details": x.details,
             "created_at": x.created_at.isoformat() if x.created_at else None
         })
-    return jsonify(ok=True, items=out)
+    return jsonify(ok=True, items=out, next_cursor=next_cursor)
+
+@app.get("/admin_api/logs/retention")
+def admin_logs_retention():
+    unauth = _require_admin()
+    if unauth:
+        return unauth
+    return jsonify(ok=True, retention=retention.status())
+
+# ---- Export (streaming)
+_EXPORT_FILTERS = {
+    "licenses": queries.license_filters,
+    "apikeys": queries.apikey_filters,
+    "logs": queries.log_filters,
+}
+
+@app.get("/admin_api/export/<kind>")
+@read_only
+def admin_export(kind):
+    """Потоковий експорт: ?format=csv|ndjson&gzip=1 + ті самі фільтри, що й у списках."""
+    unauth = _require_admin()
+    if unauth:
+        return unauth
+    if kind not in bulk.EXPORTS:
+        return jsonify(ok=False, msg="Unknown export"), 404
+    fmt = str(request.args.get("format", "csv")).strip().lower()
+    if fmt not in ("csv", "ndjson"):
+        return jsonify(ok=False, msg="Unsupported format (csv | ndjson)"), 400
+    gz = request.args.get("gzip", "") in ("1", "true", "yes")
+    conditions = _EXPORT_FILTERS[kind](request.args)
+
+    filename = f"{kind}-{datetime.now(timezone.utc):%Y%m%d-%H%M%S}.{fmt}" + (".gz" if gz else "")
+    mimetype = "application/gzip" if gz else ("text/csv" if fmt == "csv" else "application/x-ndjson")
+    activity.record("admin_export", kind=kind, format=fmt, gzip=gz)
+    return Response(
+        stream_with_context(bulk.export_stream(kind, conditions, fmt, gz)),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+@app.get("/admin_api/logs/writer")
+def admin_logs_writer():
+    unauth = _require_admin()
+    if unauth:
+        return unauth
+    return jsonify(ok=True, writer=activity.stats())
+
+# ---- Stats (з rollup-таблиць, див. rollups.py)
+@app.get("/admin_api/stats")
+@read_only
+def admin_stats():
+    """?granularity=hour|day&since=&until= — ряди по бакетах, без сканування сирих даних."""
+    unauth = _require_admin()
+    if unauth:
+        return unauth
+    granularity = str(request.args.get("granularity", "day")).strip().lower()
+    if granularity not in rollups.GRANULARITIES:
+        return jsonify(ok=False, msg="granularity: hour | day"), 400
+    until = queries.parse_ts(request.args.get("until")) or datetime.now(timezone.utc)
+    default_span = timedelta(hours=48) if granularity == "hour" else timedelta(days=30)
+    since = queries.parse_ts(request.args.get("since")) or until - default_span
+    if since > until:
+        return jsonify(ok=False, msg="since > until"), 400
+    return jsonify(ok=True, **rollups.query(granularity, since, until))
+
+@app.get("/admin_api/ratelimit")
+def admin_ratelimit():
+    unauth = _require_admin()
+    if unauth:
+        return unauth
+    return jsonify(ok=True, ratelimit=ratelimit.status())
+
+@app.get("/admin_api/db/pool")
+def admin_db_pool():
+    unauth = _require_admin()
+    if unauth:
+        return unauth
+    return jsonify(ok=True, pool=dbpool.status(db.engine))
+
+@app.get("/admin_api/db/replica")
+def admin_db_replica():
+    unauth = _require_admin()
+    if unauth:
+        return unauth
+    if replica.enabled():
+        replica.check(force=True)
+    return jsonify(ok=True, replica=replica.status())
+
+# ---- Profiles (PROFILE_* env, див. profiling.py)
+@app.get("/admin_api/profiles")
+def admin_list_profiles():
+    unauth = _require_admin()
+    if unauth:
+        return unauth
+    return jsonify(ok=True, enabled=profiling.enabled(), items=profiling.list_dumps())
+
+@app.get("/admin_api/profiles/<name>")
+def admin_get_profile(name):
+    unauth = _require_admin()
+    if unauth:
+        return unauth
+    if not profiling.DUMP_NAME_RE.match(name):
+        return jsonify(ok=False, msg="Bad name"), 400
+    return send_from_directory(profiling.PROFILE_DIR, name, as_attachment=True, mimetype="application/json")
 
 # ======== CLIENT-FACING API (для десктопу) ========
 def _get_prices_map():
-    rows = Price.query.all()
-    if not rows:
-        # fallback у разі пустої таблиці
-        return {
-            "seedream-v4": 1,
-            "flux-dev": 1,
-            "flux-pro-v1-1": 2,
-            "gemini-2.5-flash": 1,
-            "imagen3": 2,
-            "classic-fast": 1,
-        }
-    return {r.model: int(r.price) for r in rows}
+    # знімок із кешу каталогу (порожня таблиця -> дефолтні ціни)
+    return catalog.snapshot().prices
+
+def _check_license(key: str, mac: str):
+    """Перевірка ліцензії для /license/check і /client/bootstrap.
+    Повертає (payload, http_status); commit робить викликач."""
+    if not key or not mac:
+        return {"ok": False, "msg": "Missing key or mac"}, 400
+    row = db.session.execute(
+        select(License.id, License.status, License.mac_id, License.credit, License.last_active)
+        .where(License.key == key)
+    ).first()
+    if not row:
+        return {"ok": False, "msg": "Key not found"}, 200
+    if (row.status or "").lower() != "active":
+        return {"ok": False, "msg": "Inactive key", "status": row.status or "unknown"}, 200
+    if not row.mac_id:
+        # перша привʼязка — умовно, щоб два пристрої не привʼязались одночасно
+        bound = db.session.execute(
+            update(License)
+            .where(License.id == row.id, or_(License.mac_id.is_(None), License.mac_id == ""))
+            .values(mac_id=mac, last_active=datetime.now(timezone.utc))
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if not bound:
+            current = db.session.execute(select(License.mac_id).where(License.id == row.id)).scalar()
+            if (current or "").upper().strip() != mac:
+                activity.record("license_check", license_id=row.id, key=activity.mask(key), mac=mac,
+                                result="mac_mismatch")
+                return {"ok": False, "msg": "Already used on another device", "status": "active"}, 200
+        else:
+            activity.record("license_bind", license_id=row.id, key=activity.mask(key), mac=mac)
+    elif row.mac_id.upper().strip() != mac:
+        activity.record("license_check", license_id=row.id, key=activity.mask(key), mac=mac,
+                        result="mac_mismatch")
+        return {"ok": False, "msg": "Already used on another device", "status": "active"}, 200
+    else:
+        # last_active — через буфер воркера, без транзакції на кожен check
+        writebehind.touch(row.id, row.last_active)
+    activity.record("license_check", license_id=row.id, key=activity.mask(key), mac=mac, result="ok")
+    return {"ok": True, "credit": int(row.credit), "status": "active"}, 200
 
 @app.post("/license/check")
+@ratelimit.limit("license_check")
 def license_check():
     j = request.json or {}
-    key = str(j.get("key", "")).strip()
-    mac = str(j.get("mac", "")).strip().upper()
-    if not key or not mac:
-        return jsonify(ok=False, msg="Missing key or mac"), 400
+    payload, code = _check_license(str(j.get("key", "")).strip(), str(j.get("mac", "")).strip().upper())
+    db.session.commit()
+    return jsonify(payload), code
+
+def _debit_license(key: str, mac: str, total_cost: int):
+    """Атомарне списання одним умовним UPDATE.
+
+    Списує лише якщо ключ активний, MAC збігається (або ще не привʼязаний)
+    і credit >= total_cost. Повертає (license_id, новий баланс) або None, якщо умова не виконалась.
+    """
+    stmt = (
+        update(License)
+        .where(
+            License.key == key,
+            func.lower(License.status) == "active",
+            or_(
+                License.mac_id.is_(None),
+                License.mac_id == "",
+                func.upper(func.trim(License.mac_id)) == mac,
+            ),
+            License.credit >= total_cost,
+        )
+        .values(
+            credit=License.credit - total_cost,
+            mac_id=func.coalesce(func.nullif(License.mac_id, ""), mac),
+            last_active=datetime.now(timezone.utc),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    if db.engine.dialect.update_returning:
+        return db.session.execute(stmt.returning(License.id, License.credit)).first()
+    # SQLite без RETURNING: UPDATE тримає write-lock до commit,
+    # тож SELECT у тій самій транзакції бачить саме наш результат
+    if db.session.execute(stmt).rowcount != 1:
+        return None
+    return db.session.execute(select(License.id, License.credit).where(License.key == key)).one()
+
+def _debit_rejection(key: str, mac: str, total_cost: int):
+    """Пояснює, чому умовне списання не пройшло (тільки на гілці відмови)."""
     row = License.query.filter_by(key=key).first()
     if not row:
         return jsonify(ok=False, msg="Key not found")
     if (row.status or "").lower() != "active":
         return jsonify(ok=False, msg="Inactive key", status=row.status or "unknown")
-    if not row.mac_id:
-        row.mac_id = mac
-    elif row.mac_id.upper().strip() != mac:
-        return jsonify(ok=False, msg="Already used on another device", status="active")
-    row.last_active = datetime.now(timezone.utc)
-    db.session.commit()
-    return jsonify(ok=True, credit=int(row.credit), status="active")
+    if row.mac_id and row.mac_id.upper().strip() != mac:
+        return jsonify(ok=False, msg="Key bound to another device", status="active")
+    if int(row.credit) < total_cost:
+        return jsonify(ok=False, msg="Insufficient credit", credit=int(row.credit))
+    return None
+
+def _debit_or_reject(key: str, mac: str, entries: list):
+    """entries: [(model, count, unit_price)]. ((license_id, new_credit), None) при успіху або (None, response) при відмові.
+    Рядки журналу кредиту пишуться в тій самій транзакції, що й списання; commit робить @idempotent."""
+    total_cost = sum(count * unit for _, count, unit in entries)
+    for _ in range(2):
+        debited = _debit_license(key, mac, total_cost)
+        if debited is not None:
+            ledger.record_debit(debited.id, int(debited.credit), entries)
+            return (debited.id, int(debited.credit)), None
+        db.session.rollback()
+        rejected = _debit_rejection(key, mac, total_cost)
+        if rejected is not None:
+            return None, rejected
+        # стан змінився між UPDATE та перевіркою — пробуємо ще раз
+    return None, (jsonify(ok=False, msg="Debit conflict, retry"), 409)
 
 @app.post("/license/debit")
+@ratelimit.limit("license_debit")
+@idempotent("debit")
 def license_debit():
     j = request.json or {}
     key = str(j.get("key", "")).strip()
@@ -409,50 +830,132 @@ def license_debit():
     if not key or not mac or not model or count <= 0:
         return jsonify(ok=False, msg="Invalid payload"), 400
 
-    row = License.query.filter_by(key=key).first()
-    if not row:
-        return jsonify(ok=False, msg="Key not found")
-    if (row.status or "").lower() != "active":
-        return jsonify(ok=False, msg="Inactive key", status=row.status or "unknown")
-    if not row.mac_id:
-        row.mac_id = mac
-    elif row.mac_id.upper().strip() != mac:
-        return jsonify(ok=False, msg="Key bound to another device", status="active")
-
     prices = _get_prices_map()
     unit = int(prices.get(model, 1))
     total_cost = unit * count
-    if int(row.credit) < total_cost:
-        return jsonify(ok=False, msg="Insufficient credit", credit=int(row.credit))
-    row.credit = int(row.credit) - total_cost
-    row.last_active = datetime.now(timezone.utc)
-    db.session.commit()
-    return jsonify(ok=True, credit=int(row.credit), debited=total_cost, unitPrice=unit, model=model, count=count)
+    debited, rejected = _debit_or_reject(key, mac, [(model, count, unit)])
+    if rejected is not None:
+        return rejected
+    lic_id, credit = debited
+    activity.record("license_debit", license_id=lic_id, key=activity.mask(key),
+                    model=model, count=count, debited=total_cost, credit=credit)
+    return jsonify(ok=True, credit=credit, debited=total_cost, unitPrice=unit, model=model, count=count)
+
+@app.post("/license/debit_batch")
+@ratelimit.limit("license_debit_batch")
+@idempotent("debit_batch")
+def license_debit_batch():
+    """Кілька пар (model, count) для одного ключа — один запит і одна транзакція.
+    Списання «все або нічого»: якщо кредиту не вистачає на всю пачку, нічого не списується."""
+    j = request.json or {}
+    key = str(j.get("key", "")).strip()
+    mac = str(j.get("mac", "")).strip().upper()
+    raw_items = j.get("items")
+    if not key or not mac or not isinstance(raw_items, list) or not raw_items:
+        return jsonify(ok=False, msg="Invalid payload"), 400
+
+    prices = _get_prices_map()
+    items = []
+    for it in raw_items:
+        if not isinstance(it, dict):
+            return jsonify(ok=False, msg="Invalid payload"), 400
+        model = str(it.get("model", "")).strip()
+        count = int(it.get("count", 0))
+        if not model or count <= 0:
+            return jsonify(ok=False, msg="Invalid payload"), 400
+        unit = int(prices.get(model, 1))
+        items.append({"model": model, "count": count, "unitPrice": unit, "debited": unit * count})
+
+    total_cost = sum(it["debited"] for it in items)
+    debited, rejected = _debit_or_reject(key, mac, [(it["model"], it["count"], it["unitPrice"]) for it in items])
+    if rejected is not None:
+        return rejected
+    lic_id, credit = debited
+    activity.record("license_debit", license_id=lic_id, key=activity.mask(key),
+                    debited=total_cost, credit=credit, items=[[it["model"], it["count"]] for it in items])
+    return jsonify(ok=True, credit=credit, debited=total_cost, items=items)
 
 @app.post("/next_api_key")
+@ratelimit.limit("next_api_key")
+@idempotent("next_api_key")
 def next_api_key():
-    # шукаємо перший active & not in_use
-    row = ApiKey.query.filter_by(status="active", in_use=False).order_by(ApiKey.id.asc()).first()
-    if not row:
+    # найдавніше використаний active & вільний (або з протермінованою орендою)
+    lease = leases.acquire()
+    if not lease:
+        db.session.rollback()
+        activity.record("apikey_lease", result="pool_empty")
         return jsonify(ok=False, msg="No ACTIVE free API keys")
-    row.in_use = True
-    row.last_used = datetime.now(timezone.utc)
+    activity.record("apikey_lease", api_key=activity.mask(lease["api_key"]), result="ok")
+    return jsonify(ok=True, api_key=lease["api_key"], lease_token=lease["lease_token"],
+                   lease_expires=lease["leased_until"].isoformat(), lease_ttl=lease["ttl"])
+
+@app.post("/client/bootstrap")
+@ratelimit.limit("client_bootstrap")
+@idempotent("client_bootstrap")
+def client_bootstrap():
+    """Старт десктопу одним запитом замість get_config + get_prices + license/check + next_api_key.
+
+    config / prices — з кешу каталогу; перевірка ліцензії та оренда ключа — одна транзакція
+    (commit робить @idempotent).
+    Кожна секція має той самий вигляд, що й відповідь окремого endpoint-а;
+    ключ видається лише для валідної ліцензії ({"lease": false} — не брати ключ).
+    """
+    j = request.json or {}
+    snap = catalog.snapshot()
+    # без key / mac лише секція license має помилку — config і prices віддаються як завжди
+    lic, _ = _check_license(str(j.get("key", "")).strip(), str(j.get("mac", "")).strip().upper())
+    out = {
+        "config": {"ok": True, "config": snap.config},
+        "prices": {"ok": True, "prices": snap.prices},
+        # для наступних /get_config, /get_prices з If-None-Match
+        "etags": {"config": _catalog_etag("config", snap.version), "prices": _catalog_etag("prices", snap.version)},
+        "license": lic,
+    }
+    if str(j.get("lease", True)).strip().lower() not in ("false", "0", "no"):
+        if not lic["ok"]:
+            out["api_key"] = {"ok": False, "msg": "License check failed"}
+        else:
+            lease = leases.acquire()
+            if lease:
+                activity.record("apikey_lease", api_key=activity.mask(lease["api_key"]), result="ok")
+                out["api_key"] = {
+                    "ok": True, "api_key": lease["api_key"], "lease_token": lease["lease_token"],
+                    "lease_expires": lease["leased_until"].isoformat(), "lease_ttl": lease["ttl"],
+                }
+            else:
+                activity.record("apikey_lease", result="pool_empty")
+                out["api_key"] = {"ok": False, "msg": "No ACTIVE free API keys"}
+    return jsonify(ok=bool(lic["ok"]), **out)
+
+@app.post("/renew_api_key")
+def renew_api_key():
+    """Heartbeat оренди: продовжує термін, поки клієнт працює з ключем."""
+    j = request.json or {}
+    api_key = str(j.get("api_key", "")).strip()
+    lease_token = str(j.get("lease_token", "")).strip()
+    if not api_key:
+        return jsonify(ok=False, msg="Missing api_key"), 400
+    until = leases.renew(api_key, lease_token)
+    if until is None:
+        db.session.rollback()
+        return jsonify(ok=False, msg="Lease lost")
     db.session.commit()
-    return jsonify(ok=True, api_key=row.api_key)
+    return jsonify(ok=True, lease_expires=until.isoformat(), lease_ttl=leases.API_KEY_LEASE_TTL)
 
 @app.post("/release_api_key")
 def release_api_key():
     j = request.json or {}
     api_key = str(j.get("api_key", "")).strip()
+    lease_token = str(j.get("lease_token", "")).strip()
     if not api_key:
         return jsonify(ok=False, msg="Missing api_key"), 400
-    row = ApiKey.query.filter_by(api_key=api_key).first()
+    changed = leases.release(api_key, lease_token)
+    db.session.commit()
+    activity.record("apikey_release", api_key=activity.mask(api_key), changed=changed)
+    row = db.session.execute(select(ApiKey.status).where(ApiKey.api_key == api_key)).first()
     if not row:
         return jsonify(ok=False, msg="API key not found")
-    row.in_use = False
-    row.last_used = datetime.now(timezone.utc)
-    db.session.commit()
-    return jsonify(ok=True, status=row.status, changed=True)
+    return jsonify(ok=True, status=row.status, changed=changed)
 
 @app.post("/deactivate_api_key")
 def deactivate_api_key():
@@ -465,36 +968,78 @@ def deactivate_api_key():
         return jsonify(ok=False, msg="API key not found")
     row.status = "inactive"
     row.in_use = False
+    row.lease_token = None
+    row.leased_until = None
     row.last_used = datetime.now(timezone.utc)
     db.session.commit()
+    activity.record("apikey_deactivate", api_key=activity.mask(api_key))
     return jsonify(ok=True)
 
+# ---- Каталог (config / prices): ETag + long-poll
+CATALOG_LONGPOLL_TIMEOUT = float(os.getenv("CATALOG_LONGPOLL_TIMEOUT", "25"))
+# long-poll займає потік gunicorn (--threads=4), тож обмежуємо кількість очікувачів
+CATALOG_LONGPOLL_MAX_WAITERS = int(os.getenv("CATALOG_LONGPOLL_MAX_WAITERS", "2"))
+_longpoll_slots = threading.BoundedSemaphore(CATALOG_LONGPOLL_MAX_WAITERS)
+
+def _catalog_etag(section: str, version: int) -> str:
+    return f"{section[0]}{version}"
+
+def _catalog_response(section: str, snap):
+    """200 з готовими байтами або 304, якщо клієнт уже має цю версію."""
+    etag = _catalog_etag(section, snap.version)
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        body = snap.config_body if section == "config" else snap.prices_body
+        resp = Response(body, mimetype="application/json")
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+def _catalog_wait(section: str):
+    snap = catalog.snapshot()
+    if not request.if_none_match.contains(_catalog_etag(section, snap.version)):
+        return _catalog_response(section, snap)
+    try:
+        timeout = min(float(request.args.get("timeout", CATALOG_LONGPOLL_TIMEOUT)), CATALOG_LONGPOLL_TIMEOUT)
+    except ValueError:
+        timeout = CATALOG_LONGPOLL_TIMEOUT
+    if not _longpoll_slots.acquire(blocking=False):
+        # усі слоти зайняті — клієнт повертається до звичайного опитування
+        resp = _catalog_response(section, snap)
+        resp.headers["Retry-After"] = str(int(catalog.CATALOG_PROBE_INTERVAL) or 1)
+        return resp
+    try:
+        snap = catalog.wait_for_change(snap.version, max(timeout, 0.0))
+    finally:
+        _longpoll_slots.release()
+    return _catalog_response(section, snap)
+
+@app.get("/get_config")
 @app.post("/get_config")
+@read_only
 def get_config():
-    cfg = Config.query.first()
-    if not cfg:
-        cfg = Config(
-            latest_version="2.3.3",
-            force_update=False,
-            maintenance=False,
-            maintenance_message="",
-            update_links="[]",
-            update_description="",
-            updated_at=datetime.now(timezone.utc),
-        )
-        db.session.add(cfg); db.session.commit()
-    return jsonify(ok=True, config={
-        "latest_version": cfg.latest_version,
-        "force_update": bool(cfg.force_update),
-        "maintenance": bool(cfg.maintenance),
-        "maintenance_message": cfg.maintenance_message or "",
-        "update_links": cfg.update_links or "[]",
-        "update_description": cfg.update_description or "",
-    })
+    # готові байти з кешу каталогу — без ORM і без вставок на read-шляху
+    return _catalog_response("config", catalog.snapshot())
 
+@app.get("/get_prices")
 @app.post("/get_prices")
+@read_only
 def get_prices():
-    return jsonify(ok=True, prices=_get_prices_map())
+    return _catalog_response("prices", catalog.snapshot())
+
+@app.get("/get_config/wait")
+@app.post("/get_config/wait")
+@read_only
+def get_config_wait():
+    """Тримає запит (If-None-Match = поточний ETag), доки конфіг/ціни не зміняться або timeout."""
+    return _catalog_wait("config")
+
+@app.get("/get_prices/wait")
+@app.post("/get_prices/wait")
+@read_only
+def get_prices_wait():
+    return _catalog_wait("prices")
 
 # ======== gunicorn entry ========
 if __name__ == "__main__":
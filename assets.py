@@ -0,0 +1,161 @@
+# assets.py
+# -*- coding: utf-8 -*-
+"""Статика адмінки з памʼяті: імена з відбитком вмісту + попередньо стиснуті варіанти.
+
+build() на старті воркера читає static/admin.js і admin.css, рахує sha256 і
+тримає кожен файл у трьох варіантах: як є, gzip і br (пакет Brotli з
+requirements.txt; без нього, напр. у локальному venv, лише gzip). /assets/admin.<hash>.js віддається з Cache-Control immutable
+на ASSET_MAX_AGE — новий вміст означає нове імʼя, тож кеш ніколи не застаріє.
+Варіант обирається за Accept-Encoding (br > gzip > identity), Vary: Accept-Encoding.
+
+HTML адмінки (static/admin.html; у цьому дереві розмітка лежить в admin.txt)
+переписується на імена з відбитками й віддається з no-cache + ETag — браузер
+лише перевіряє його і отримує 304. Старі /admin.js, /admin.css лишаються
+(no-cache + ETag) для сторінок, що вже відкриті в браузері.
+ADMIN_ASSETS_RELOAD=1 — перебудова при зміні файлів (для розробки).
+"""
+import os
+import re
+import gzip
+import hashlib
+import logging
+import threading
+
+from flask import request, Response, abort
+
+try:
+    import brotli
+except ImportError:  # у requirements.txt; без пакета — лише gzip
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+ASSET_MAX_AGE = int(os.getenv("ASSET_MAX_AGE", str(365 * 24 * 3600)))   # сек
+ADMIN_ASSETS_RELOAD = os.getenv("ADMIN_ASSETS_RELOAD", "0") == "1"
+ASSET_MIN_COMPRESS = 256   # менші файли не стискаємо — заголовки дорожчі за виграш
+
+ASSET_FILES = ("admin.js", "admin.css")
+HTML_FILES = ("admin.html", "admin.txt")   # перший наявний
+HTML_ROUTES = ("/", "/admin")
+MIMETYPES = {
+    ".js": "application/javascript",
+    ".css": "text/css",
+    ".html": "text/html",
+}
+IMMUTABLE = f"public, max-age={ASSET_MAX_AGE}, immutable"
+REVALIDATE = "no-cache"
+ENCODINGS = ("br", "gzip")
+ETAG_SUFFIX = {"identity": "", "gzip": ".gz", "br": ".br"}
+
+log = logging.getLogger(__name__)
+
+
+class Asset:
+    __slots__ = ("mimetype", "digest", "variants", "cache_control")
+
+    def __init__(self, mimetype, data, cache_control):
+        self.mimetype = mimetype
+        self.digest = hashlib.sha256(data).hexdigest()
+        self.cache_control = cache_control
+        self.variants = {"identity": data}
+        if len(data) >= ASSET_MIN_COMPRESS:
+            # mtime=0 — однакові байти в усіх воркерах і між деплоями
+            self.variants["gzip"] = gzip.compress(data, compresslevel=9, mtime=0)
+            if brotli is not None:
+                self.variants["br"] = brotli.compress(data, quality=11)
+
+
+_lock = threading.Lock()
+_routes = {}      # шлях URL -> Asset
+_manifest = {}    # "admin.js" -> "/assets/admin.<hash>.js"
+_mtimes = {}
+
+
+def _read(name: str):
+    path = os.path.join(STATIC_DIR, name)
+    try:
+        with open(path, "rb") as fh:
+            data = fh.read()
+        _mtimes[path] = os.path.getmtime(path)
+        return data
+    except OSError:
+        return None
+
+
+def build():
+    """Збирає відбитки та стиснуті варіанти; HTML переписує на нові імена."""
+    global _routes, _manifest
+    routes, manifest = {}, {}
+    with _lock:
+        _mtimes.clear()
+        for name in ASSET_FILES:
+            data = _read(name)
+            if data is None:
+                log.warning("assets: static/%s not found", name)
+                continue
+            stem, ext = os.path.splitext(name)
+            asset = Asset(MIMETYPES[ext], data, IMMUTABLE)
+            hashed = f"/assets/{stem}.{asset.digest[:12]}{ext}"
+            routes[hashed] = asset
+            routes[f"/{name}"] = Asset(MIMETYPES[ext], data, REVALIDATE)
+            manifest[name] = hashed
+        for name in HTML_FILES:
+            data = _read(name)
+            if data is None:
+                continue
+            html = data.decode("utf-8")
+            for src, hashed in manifest.items():
+                # src="/admin.js", href="admin.css" -> /assets/admin.<hash>.*
+                html = re.sub(r'(?<=["\'])/?%s(?=["\'])' % re.escape(src), hashed, html)
+            page = Asset(MIMETYPES[".html"], html.encode("utf-8"), REVALIDATE)
+            for route in HTML_ROUTES:
+                routes[route] = page
+            break
+        else:
+            log.warning("assets: admin HTML not found in static/")
+        _routes, _manifest = routes, manifest
+    log.info("assets: built %s (brotli %s)", ", ".join(manifest.values()) or "nothing",
+             "on" if brotli is not None else "off")
+
+
+def _stale() -> bool:
+    for path, mtime in list(_mtimes.items()):
+        try:
+            if os.path.getmtime(path) != mtime:
+                return True
+        except OSError:
+            return True
+    return False
+
+
+def manifest() -> dict:
+    return dict(_manifest)
+
+
+def negotiate(asset: Asset) -> str:
+    accept = request.accept_encodings
+    for enc in ENCODINGS:
+        if enc in asset.variants and accept[enc] > 0:
+            return enc
+    return "identity"
+
+
+def response(path: str):
+    """Готові байти з памʼяті або 304 за ETag конкретного варіанта."""
+    if ADMIN_ASSETS_RELOAD and _stale():
+        build()
+    asset = _routes.get(path)
+    if asset is None:
+        abort(404)
+    enc = negotiate(asset)
+    etag = asset.digest[:16] + ETAG_SUFFIX[enc]
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        resp = Response(asset.variants[enc], mimetype=asset.mimetype)
+        if enc != "identity":
+            resp.headers["Content-Encoding"] = enc
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = asset.cache_control
+    if len(asset.variants) > 1:
+        resp.headers["Vary"] = "Accept-Encoding"
+    return resp
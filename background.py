@@ -0,0 +1,80 @@
+# background.py
+# -*- coding: utf-8 -*-
+"""Фонові задачі воркера: періодичні daemon-потоки з app context та хуки завершення.
+
+Кожен gunicorn-воркер імпортує app окремо (без --preload), тож потоки
+стартують у кожному воркері. BACKGROUND_TASKS=0 вимикає їх (скрипти);
+під командами Flask CLI (крім `flask run`) вони не стартують самі.
+"""
+import os
+import sys
+import atexit
+import logging
+import threading
+
+from models import db
+
+BACKGROUND_TASKS = os.getenv("BACKGROUND_TASKS", "1") == "1"
+# опції `flask`, що мають значення окремим аргументом
+_CLI_VALUE_OPTS = ("--app", "-A", "--env-file", "-e")
+
+
+def _cli_command():
+    """Імʼя команди, якщо процес — `flask <команда>` (None для gunicorn, скриптів і `flask run`)."""
+    prog = os.path.normpath(sys.argv[0] if sys.argv else "")
+    if os.path.basename(prog) not in ("flask", "flask.exe") and \
+            not prog.endswith(os.path.join("flask", "__main__.py")):
+        return None
+    args = iter(sys.argv[1:])
+    for a in args:
+        if a in _CLI_VALUE_OPTS:
+            next(args, None)
+        elif not a.startswith("-"):
+            return None if a == "run" else a
+    return None
+
+
+CLI_COMMAND = _cli_command()
+
+log = logging.getLogger(__name__)
+_stop = threading.Event()
+_shutdown_hooks = []
+
+
+def every(app, name: str, interval: float, fn):
+    """Запускає fn() кожні interval секунд у власному потоці."""
+    if not BACKGROUND_TASKS or CLI_COMMAND:
+        return None
+
+    def loop():
+        while not _stop.wait(interval):
+            with app.app_context():
+                try:
+                    fn()
+                except Exception:
+                    log.exception("background task %s failed", name)
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+
+    t = threading.Thread(target=loop, name=name, daemon=True)
+    t.start()
+    return t
+
+
+def on_shutdown(app, fn):
+    """fn() виконається при завершенні воркера (graceful exit gunicorn)."""
+    _shutdown_hooks.append((app, fn))
+
+
+@atexit.register
+def _run_shutdown_hooks():
+    _stop.set()
+    for app, fn in _shutdown_hooks:
+        with app.app_context():
+            try:
+                fn()
+            except Exception:
+                log.exception("shutdown hook %s failed", getattr(fn, "__name__", fn))
+            finally:
+                db.session.remove()
@@ -0,0 +1,3 @@
+# bench/__init__.py
+# -*- coding: utf-8 -*-
+"""Бенчмарки клієнтського API: python -m bench.run, python -m bench.compare."""
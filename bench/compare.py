@@ -0,0 +1,55 @@
+# bench/compare.py
+# -*- coding: utf-8 -*-
+"""Порівняння двох JSON-результатів bench.run (наприклад, між комітами).
+
+    python -m bench.compare bench/results/old.json bench/results/new.json [--threshold 10]
+
+Друкує зміну rps та p50/p95/p99 по кожній операції; код виходу 1, якщо
+p95 або p99 погіршились більше ніж на threshold % чи зламались інваріанти.
+"""
+import sys
+import json
+import argparse
+
+METRICS = ("rps", "p50_ms", "p95_ms", "p99_ms")
+INVARIANTS = ("negative_credit", "credit_mismatch", "double_leases")
+
+
+def _delta(old: float, new: float) -> float:
+    return (new - old) / old * 100.0 if old else 0.0
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Compare two bench.run results")
+    ap.add_argument("old")
+    ap.add_argument("new")
+    ap.add_argument("--threshold", type=float, default=10.0, help="allowed p95/p99 regression, %%")
+    args = ap.parse_args(argv)
+    with open(args.old) as fh:
+        old = json.load(fh)
+    with open(args.new) as fh:
+        new = json.load(fh)
+
+    print(f"{old['meta']['commit']} -> {new['meta']['commit']}")
+    regressed = False
+    rows = [(op, old["ops"].get(op), new["ops"].get(op)) for op in new["ops"]]
+    rows.append(("total", old["total"], new["total"]))
+    for op, o, n in rows:
+        if not o or not n:
+            continue
+        cells = []
+        for m in METRICS:
+            d = _delta(o[m], n[m])
+            cells.append(f"{m} {o[m]} -> {n[m]} ({d:+.1f}%)")
+            if m in ("p95_ms", "p99_ms") and d > args.threshold:
+                regressed = True
+        print(f"{op:<8} " + "  ".join(cells))
+    for k in INVARIANTS:
+        if new["invariants"].get(k):
+            print(f"invariant broken: {k}={new['invariants'][k]}")
+            regressed = True
+    return 1 if regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,458 @@
+# bench/run.py
+# -*- coding: utf-8 -*-
+"""Навантажувальний бенчмарк клієнтського API (те, що бʼє десктоп).
+
+Запуск з кореня репозиторію:
+
+    # піднімає gunicorn з топологією з Procfile на SQLite і ганяє суміш 20 с
+    python -m bench.run --spawn --database-url sqlite:////tmp/bench.db
+
+    # проти вже запущеного сервера / локального Postgres
+    python -m bench.run --url http://127.0.0.1:8000 --processes 4 --threads 8
+
+Кожен прогін сідить власні ліцензії та API-ключі (префікс bench-<run_id>),
+ганяє зважену суміш операцій (check / debit / lease+release / config / prices;
+bootstrap — /client/bootstrap + release, у суміш лише явно через --mix)
+у P процесах × T потоках з keep-alive зʼєднаннями і пише JSON з
+пропускною здатністю, p50/p95/p99 по кожній операції та інваріантами:
+  - negative_credit      — ліцензій з credit < 0 (має бути 0);
+  - credit_mismatch      — ліцензій, де seed - сума успішних списань != фінальний credit;
+  - double_leases        — перетинів оренди одного ключа двома клієнтами.
+Ліміт запитів (ratelimit.py) бенч вимикає у сервері, який піднімає сам
+(усі клієнти йдуть з одного IP); --rate-limit лишає його ввімкненим.
+Для --url запускайте сервер з RATE_LIMIT=0.
+Порівняння двох прогонів: python -m bench.compare old.json new.json
+"""
+import os
+import re
+import sys
+import json
+import time
+import base64
+import random
+import shutil
+import secrets
+import argparse
+import threading
+import subprocess
+import http.client
+import multiprocessing
+from urllib.parse import urlsplit, urlencode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "bench", "results")
+DEFAULT_MIX = "check=35,debit=35,lease=15,config=10,prices=5"
+OPS = ("check", "debit", "lease", "release", "config", "prices", "bootstrap")
+
+
+# ======== HTTP ========
+class Client:
+    """Одне keep-alive зʼєднання на потік; перепідключення після помилки."""
+
+    def __init__(self, base: str, auth: str = None, timeout: float = 30.0):
+        u = urlsplit(base)
+        self.https = u.scheme == "https"
+        self.host = u.hostname
+        self.port = u.port or (443 if self.https else 80)
+        self.prefix = u.path.rstrip("/")
+        self.timeout = timeout
+        self.headers = {"Authorization": "Basic " + base64.b64encode(auth.encode()).decode()} if auth else {}
+        self.conn = None
+
+    def _connect(self):
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        self.conn = cls(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method: str, path: str, body=None, raw: bytes = None, content_type: str = "application/json"):
+        """-> (status, json|None, seconds). status 0 = мережева помилка."""
+        headers = dict(self.headers)
+        data = raw
+        if body is not None:
+            data = json.dumps(body).encode()
+        if data is not None:
+            headers["Content-Type"] = content_type
+        if self.conn is None:
+            self._connect()
+        t0 = time.perf_counter()
+        try:
+            self.conn.request(method, self.prefix + path, body=data, headers=headers)
+            resp = self.conn.getresponse()
+            payload = resp.read()
+            elapsed = time.perf_counter() - t0
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            self.conn = None
+            return 0, None, time.perf_counter() - t0
+        try:
+            parsed = json.loads(payload) if payload else None
+        except ValueError:
+            parsed = None
+        return resp.status, parsed, elapsed
+
+
+# ======== Seed ========
+def license_key(run_id: str, i: int) -> str:
+    return f"bench-{run_id}-{i:07d}"
+
+
+def license_mac(i: int) -> str:
+    return f"BE:NC:{i >> 16 & 0xFF:02X}:{i >> 8 & 0xFF:02X}:{i & 0xFF:02X}"
+
+
+def seed(base: str, auth: str, run_id: str, n_licenses: int, n_keys: int, credit: int):
+    c = Client(base, auth, timeout=600)
+    lic = "\n".join(json.dumps({"key": license_key(run_id, i), "credit": credit}) for i in range(n_licenses))
+    st, j, _ = c.request("POST", "/admin_api/licenses/import?format=ndjson", raw=lic.encode(),
+                         content_type="application/x-ndjson")
+    if st != 200 or not (j or {}).get("ok"):
+        raise SystemExit(f"license seed failed: {st} {j}")
+    keys = "\n".join(json.dumps({"api_key": f"bench-{run_id}-ak-{i:06d}"}) for i in range(n_keys))
+    st, j, _ = c.request("POST", "/admin_api/apikeys/import?format=ndjson", raw=keys.encode(),
+                         content_type="application/x-ndjson")
+    if st != 200 or not (j or {}).get("ok"):
+        raise SystemExit(f"api key seed failed: {st} {j}")
+
+
+# ======== Навантаження ========
+def parse_mix(spec: str) -> dict:
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPS or name == "release":
+            raise SystemExit(f"unknown op in --mix: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def _new_stats() -> dict:
+    return {op: {"lat": [], "ok": 0, "rejected": 0, "errors": 0} for op in OPS}
+
+
+def _account(stats: dict, op: str, status: int, j, elapsed: float):
+    s = stats[op]
+    s["lat"].append(elapsed)
+    if status == 0 or status >= 500:
+        s["errors"] += 1
+    elif status == 200 and (j or {}).get("ok"):
+        s["ok"] += 1
+    else:
+        s["rejected"] += 1
+
+
+def _drive(cfg: dict, seed_no: int, deadline: float, out: dict):
+    rng = random.Random(seed_no)
+    c = Client(cfg["url"])
+    stats = _new_stats()
+    debited = {}     # індекс ліцензії -> сума успішних списань
+    uncertain = set()
+    leases = []      # (api_key, t_acquired, t_released)
+    names = list(cfg["mix"])
+    weights = [cfg["mix"][n] for n in names]
+    n_lic = cfg["licenses"]
+    while time.time() < deadline:
+        op = rng.choices(names, weights)[0]
+        if op in ("check", "debit"):
+            i = rng.randrange(n_lic)
+            body = {"key": license_key(cfg["run_id"], i), "mac": license_mac(i)}
+            if op == "debit":
+                body.update(model=cfg["model"], count=1)
+            st, j, el = c.request("POST", "/license/" + op, body)
+            _account(stats, op, st, j, el)
+            if op == "debit":
+                if st == 200 and (j or {}).get("ok"):
+                    debited[i] = debited.get(i, 0) + cfg["unit_price"]
+                elif st == 0 or st >= 500:
+                    uncertain.add(i)
+        elif op in ("lease", "bootstrap"):
+            if op == "lease":
+                st, j, el = c.request("POST", "/next_api_key", {})
+                _account(stats, "lease", st, j, el)
+            else:
+                i = rng.randrange(n_lic)
+                st, j, el = c.request("POST", "/client/bootstrap",
+                                      {"key": license_key(cfg["run_id"], i), "mac": license_mac(i)})
+                _account(stats, "bootstrap", st, j, el)
+                j = (j or {}).get("api_key")
+            if st == 200 and (j or {}).get("ok"):
+                acquired = time.time()
+                if cfg["lease_hold"]:
+                    time.sleep(cfg["lease_hold"])
+                released = time.time()
+                st, rj, el = c.request("POST", "/release_api_key",
+                                       {"api_key": j["api_key"], "lease_token": j.get("lease_token", "")})
+                _account(stats, "release", st, rj, el)
+                leases.append((j["api_key"], acquired, released))
+        else:
+            st, j, el = c.request("GET", "/get_" + op)
+            _account(stats, op, st, j, el)
+    out.update(stats=stats, debited=debited, uncertain=uncertain, leases=leases)
+
+
+def _process_load(cfg: dict, proc_no: int, deadline: float) -> dict:
+    outs = [{} for _ in range(cfg["threads"])]
+    threads = [
+        threading.Thread(target=_drive, args=(cfg, cfg["seed"] * 1000 + proc_no * 100 + t, deadline, outs[t]))
+        for t in range(cfg["threads"])
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return _merge(outs)
+
+
+def _process_main(cfg: dict, proc_no: int, deadline: float, queue):
+    queue.put(_process_load(cfg, proc_no, deadline))
+
+
+def _merge(outs: list) -> dict:
+    stats, debited, uncertain, leases = _new_stats(), {}, set(), []
+    for o in outs:
+        for op, s in o["stats"].items():
+            for k in ("ok", "rejected", "errors"):
+                stats[op][k] += s[k]
+            stats[op]["lat"] += s["lat"]
+        for i, v in o["debited"].items():
+            debited[i] = debited.get(i, 0) + v
+        uncertain |= o["uncertain"]
+        leases += o["leases"]
+    return {"stats": stats, "debited": debited, "uncertain": uncertain, "leases": leases}
+
+
+def run_load(cfg: dict) -> tuple:
+    """-> (обʼєднані результати, фактична тривалість)."""
+    started = time.time()
+    deadline = started + cfg["duration"]
+    if cfg["processes"] <= 1:
+        return _process_load(cfg, 0, deadline), time.time() - started
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    procs = [ctx.Process(target=_process_main, args=(cfg, p, deadline, queue)) for p in range(cfg["processes"])]
+    for p in procs:
+        p.start()
+    results = [queue.get() for _ in procs]
+    for p in procs:
+        p.join()
+    return _merge(results), time.time() - started
+
+
+# ======== Звіт ========
+def percentile(sorted_vals: list, q: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    idx = min(len(sorted_vals) - 1, max(0, int(round(q / 100.0 * len(sorted_vals) + 0.5)) - 1))
+    return sorted_vals[idx]
+
+
+def summarize(stats: dict, elapsed: float) -> dict:
+    ops, all_lat = {}, []
+    for op, s in stats.items():
+        lat = sorted(s["lat"])
+        if not lat:
+            continue
+        all_lat += lat
+        ops[op] = {
+            "count": len(lat),
+            "ok": s["ok"],
+            "rejected": s["rejected"],
+            "errors": s["errors"],
+            "rps": round(len(lat) / elapsed, 2),
+            "p50_ms": round(percentile(lat, 50) * 1000, 3),
+            "p95_ms": round(percentile(lat, 95) * 1000, 3),
+            "p99_ms": round(percentile(lat, 99) * 1000, 3),
+            "max_ms": round(lat[-1] * 1000, 3),
+        }
+    all_lat.sort()
+    total = {
+        "count": len(all_lat),
+        "errors": sum(o["errors"] for o in ops.values()),
+        "rps": round(len(all_lat) / elapsed, 2),
+        "p50_ms": round(percentile(all_lat, 50) * 1000, 3),
+        "p95_ms": round(percentile(all_lat, 95) * 1000, 3),
+        "p99_ms": round(percentile(all_lat, 99) * 1000, 3),
+    }
+    return {"ops": ops, "total": total}
+
+
+def check_invariants(cfg: dict, auth: str, merged: dict) -> dict:
+    c = Client(cfg["url"], auth, timeout=120)
+    prefix = f"bench-{cfg['run_id']}-"
+    final, cursor = {}, None
+    while True:
+        args = {"q": prefix, "limit": 500}
+        if cursor:
+            args["cursor"] = cursor
+        st, j, _ = c.request("GET", "/admin_api/licenses?" + urlencode(args))
+        if st != 200 or not (j or {}).get("ok"):
+            raise SystemExit(f"license listing failed: {st}")
+        for it in j["items"]:
+            final[it["key"]] = it["credit"]
+        cursor = j.get("next_cursor")
+        if not cursor:
+            break
+
+    negative = sum(1 for v in final.values() if v is not None and v < 0)
+    mismatch = 0
+    for i in range(cfg["licenses"]):
+        if i in merged["uncertain"]:
+            continue
+        expected = cfg["credit"] - merged["debited"].get(i, 0)
+        if final.get(license_key(cfg["run_id"], i)) != expected:
+            mismatch += 1
+
+    # інтервали [отримали, відпустили] лежать усередині справжньої оренди,
+    # тож будь-який перетин для одного ключа — це реальна подвійна видача
+    double = 0
+    by_key = {}
+    for key, a, b in merged["leases"]:
+        by_key.setdefault(key, []).append((a, b))
+    for spans in by_key.values():
+        spans.sort()
+        for (a1, b1), (a2, b2) in zip(spans, spans[1:]):
+            if a2 < b1:
+                double += 1
+    return {
+        "licenses_checked": len(final),
+        "negative_credit": negative,
+        "credit_mismatch": mismatch,
+        "uncertain_licenses": len(merged["uncertain"]),
+        "leases": len(merged["leases"]),
+        "double_leases": double,
+    }
+
+
+# ======== Сервер ========
+def procfile_topology() -> tuple:
+    try:
+        with open(os.path.join(ROOT, "Procfile")) as fh:
+            text = fh.read()
+    except OSError:
+        text = ""
+    workers = re.search(r"--workers[= ](\d+)", text)
+    threads = re.search(r"--threads[= ](\d+)", text)
+    return int(workers.group(1)) if workers else 2, int(threads.group(1)) if threads else 4
+
+
+def spawn_server(database_url: str, port: int, workers: int, threads: int, rate_limit: bool = False):
+    env = dict(os.environ, DATABASE_URL=database_url)
+    if not rate_limit:
+        env["RATE_LIMIT"] = "0"
+    if shutil.which("gunicorn"):
+        cmd = ["gunicorn", "app:app", f"--workers={workers}", f"--threads={threads}",
+               "--timeout=120", f"--bind=127.0.0.1:{port}"]
+        kind = "gunicorn"
+    else:
+        # без gunicorn — один процес werkzeug з потоками (топологія не та, див. meta.server)
+        cmd = [sys.executable, "-m", "flask", "--app", "app", "run", "--with-threads",
+               "--host", "127.0.0.1", "--port", str(port)]
+        kind = "werkzeug"
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{port}"
+    c = Client(base, timeout=2)
+    for _ in range(300):
+        if proc.poll() is not None:
+            raise SystemExit(f"server exited with code {proc.returncode}")
+        if c.request("GET", "/healthz")[0] == 200:
+            return proc, base, kind
+        time.sleep(0.1)
+    proc.terminate()
+    raise SystemExit("server did not become healthy")
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main(argv=None):
+    workers, threads = procfile_topology()
+    ap = argparse.ArgumentParser(description="Benchmark the client API")
+    ap.add_argument("--url", help="running server base URL")
+    ap.add_argument("--spawn", action="store_true", help="start the app (gunicorn, Procfile topology)")
+    ap.add_argument("--database-url", default=os.getenv("DATABASE_URL", "sqlite:////tmp/amulet-bench.db"))
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--server-workers", type=int, default=workers)
+    ap.add_argument("--server-threads", type=int, default=threads)
+    ap.add_argument("--processes", type=int, default=workers, help="client processes")
+    ap.add_argument("--threads", type=int, default=threads, help="client threads per process")
+    ap.add_argument("--duration", type=float, default=20.0, help="seconds of load")
+    ap.add_argument("--licenses", type=int, default=1000)
+    ap.add_argument("--keys", type=int, default=20)
+    ap.add_argument("--credit", type=int, default=50, help="seed credit per license")
+    ap.add_argument("--mix", default=DEFAULT_MIX)
+    ap.add_argument("--lease-hold-ms", type=float, default=5.0)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--rate-limit", action="store_true", help="keep the server rate limiter on (--spawn)")
+    ap.add_argument("--admin", default=f"{os.getenv('ADMIN_USER', 'admin')}:{os.getenv('ADMIN_PASS', 'admin')}")
+    ap.add_argument("--out", help="result JSON path (default bench/results/<time>-<commit>.json)")
+    args = ap.parse_args(argv)
+    if not args.url and not args.spawn:
+        ap.error("--url or --spawn required")
+
+    server, kind = None, "external"
+    base = args.url
+    if args.spawn:
+        server, base, kind = spawn_server(args.database_url, args.port, args.server_workers, args.server_threads,
+                                           args.rate_limit)
+    try:
+        run_id = time.strftime("%Y%m%d%H%M%S") + secrets.token_hex(2)
+        seed(base, args.admin, run_id, args.licenses, args.keys, args.credit)
+        st, prices, _ = Client(base).request("GET", "/get_prices")
+        prices = (prices or {}).get("prices") or {}
+        model = sorted(prices)[0] if prices else "bench"
+        cfg = {
+            "url": base, "run_id": run_id, "mix": parse_mix(args.mix),
+            "processes": args.processes, "threads": args.threads, "duration": args.duration,
+            "licenses": args.licenses, "credit": args.credit, "seed": args.seed,
+            "model": model, "unit_price": int(prices.get(model, 1)),
+            "lease_hold": args.lease_hold_ms / 1000.0,
+        }
+        merged, elapsed = run_load(cfg)
+        report = summarize(merged["stats"], elapsed)
+        report["invariants"] = check_invariants(cfg, args.admin, merged)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+    report["meta"] = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "server": kind,
+        "url": base,
+        "database": args.database_url.split("://", 1)[0] if args.spawn else "external",
+        "server_workers": args.server_workers if args.spawn else None,
+        "server_threads": args.server_threads if args.spawn else None,
+        "rate_limit": args.rate_limit if args.spawn else None,
+        "processes": args.processes,
+        "threads": args.threads,
+        "duration": args.duration,
+        "licenses": args.licenses,
+        "keys": args.keys,
+        "credit": args.credit,
+        "mix": cfg["mix"],
+        "run_id": run_id,
+    }
+    out = args.out or os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{report['meta']['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as fh:
+        json.dump(report, fh, indent=2, sort_keys=True)
+
+    print(f"{'op':<8} {'count':>8} {'rps':>9} {'p50':>8} {'p95':>8} {'p99':>8} {'err':>5}")
+    for op, s in report["ops"].items():
+        print(f"{op:<8} {s['count']:>8} {s['rps']:>9} {s['p50_ms']:>8} {s['p95_ms']:>8} {s['p99_ms']:>8} {s['errors']:>5}")
+    t = report["total"]
+    print(f"{'total':<8} {t['count']:>8} {t['rps']:>9} {t['p50_ms']:>8} {t['p95_ms']:>8} {t['p99_ms']:>8} {t['errors']:>5}")
+    inv = report["invariants"]
+    print(f"invariants: negative_credit={inv['negative_credit']} credit_mismatch={inv['credit_mismatch']} "
+          f"double_leases={inv['double_leases']}")
+    print(f"saved {out}")
+    bad = inv["negative_credit"] or inv["credit_mismatch"] or inv["double_leases"]
+    return 1 if bad else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,248 @@
+# bulk.py
+# -*- coding: utf-8 -*-
+"""Потоковий масовий імпорт/генерація та експорт License / ApiKey / ActivityLog.
+
+Завантаження (CSV із заголовком або NDJSON) читається з request.stream рядок за
+рядком і пишеться чанками по BULK_CHUNK_SIZE з окремим commit на чанк — памʼять
+не росте з розміром файлу. Дублікати пропускає сама БД (ON CONFLICT DO NOTHING):
+на PostgreSQL — один багаторядковий INSERT ... RETURNING на чанк, на SQLite —
+executemany, а дублікати визначаються одним SELECT ... IN по унікальному індексу.
+Помилка посеред файлу (BulkError) несе підсумок уже закомічених чанків і номер
+рядка, тож адмін бачить, що вставлено, і може продовжити з цього місця.
+"""
+import io
+import os
+import csv
+import json
+import zlib
+import secrets
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import db, License, ApiKey, ActivityLog
+
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "1000"))
+BULK_GENERATE_MAX = int(os.getenv("BULK_GENERATE_MAX", "100000"))
+# скільки ключів-дублікатів повертати у відповіді (решта — лише лічильник)
+BULK_REPORT_DUPLICATES = 1000
+EXPORT_YIELD_PER = int(os.getenv("EXPORT_YIELD_PER", "1000"))
+
+
+class BulkError(ValueError):
+    """Некоректне завантаження. summary — підсумок чанків, закомічених до помилки."""
+
+    def __init__(self, msg: str, line: int = None):
+        super().__init__(msg)
+        self.line = line
+        self.summary = None
+
+
+# ---- Джерела рядків
+def _text_lines(stream):
+    """Рядки потоку, декодовані по одному: не-UTF-8 -> BulkError з номером рядка."""
+    for n, raw in enumerate(stream, 1):
+        try:
+            yield raw.decode("utf-8-sig" if n == 1 else "utf-8")
+        except UnicodeDecodeError:
+            raise BulkError(f"Invalid UTF-8 on line {n}", line=n)
+
+
+def iter_upload(stream, fmt: str):
+    """Ітерує dict-рядки з потоку завантаження: fmt = csv | ndjson."""
+    text = _text_lines(stream)
+    if fmt == "csv":
+        yield from csv.DictReader(text)
+    elif fmt == "ndjson":
+        for n, line in enumerate(text, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                raise BulkError(f"Invalid JSON on line {n}", line=n)
+            yield item if isinstance(item, dict) else {}
+    else:
+        raise BulkError("Unsupported format (csv | ndjson)")
+
+
+def upload_format(req) -> str:
+    fmt = str(req.args.get("format", "")).strip().lower()
+    if fmt:
+        return fmt
+    ctype = (req.mimetype or "").lower()
+    if "csv" in ctype:
+        return "csv"
+    if "ndjson" in ctype or "jsonl" in ctype:
+        return "ndjson"
+    return ""
+
+
+def generate_license_keys(count: int, prefix: str = "", groups: int = 3):
+    """Випадкові ключі виду PREFIX-XXXX-XXXX-XXXX."""
+    for _ in range(count):
+        body = "-".join(secrets.token_hex(2).upper() for _ in range(groups))
+        yield f"{prefix}-{body}" if prefix else body
+
+
+# ---- Нормалізація рядків
+def license_row(item: dict, defaults: dict = None):
+    defaults = defaults or {}
+    key = str(item.get("key") or "").strip()
+    if not key or len(key) > 100:
+        return None
+    credit = item.get("credit")
+    if credit is None or str(credit).strip() == "":
+        credit = defaults.get("credit", 0)
+    try:
+        credit = int(credit)
+    except (TypeError, ValueError):
+        return None
+    status = str(item.get("status") or defaults.get("status", "active")).strip().lower()
+    mac = str(item.get("mac_id") or "").strip().upper() or None
+    return {"key": key, "credit": credit, "status": status, "mac_id": mac}
+
+
+def apikey_row(item: dict, defaults: dict = None):
+    defaults = defaults or {}
+    api_key = str(item.get("api_key") or "").strip()
+    if not api_key or len(api_key) > 255:
+        return None
+    status = str(item.get("status") or defaults.get("status", "active")).strip().lower()
+    note = str(item.get("note") or "").strip() or None
+    return {"api_key": api_key, "status": status, "in_use": False, "note": note}
+
+
+# ---- Запис чанками
+def _insert_chunk(model, key_attr: str, rows: list):
+    """Вставляє чанк, пропускаючи наявні ключі. Повертає множину вставлених ключів."""
+    t = model.__table__
+    key_col = t.c[key_attr]
+    keys = [r[key_attr] for r in rows]
+    if db.engine.dialect.name == "postgresql":
+        stmt = pg_insert(t).values(rows).on_conflict_do_nothing(index_elements=[key_col])
+        inserted = set(db.session.execute(stmt.returning(key_col)).scalars())
+    else:
+        existing = set(db.session.execute(select(key_col).where(key_col.in_(keys))).scalars())
+        fresh = [r for r in rows if r[key_attr] not in existing]
+        stmt = sqlite_insert(t).on_conflict_do_nothing(index_elements=[key_attr])
+        if fresh:
+            db.session.execute(stmt, fresh)
+        inserted = {r[key_attr] for r in fresh}
+    db.session.commit()
+    return inserted
+
+
+def import_rows(model, key_attr: str, items, normalize, defaults: dict = None, collect_keys: bool = False):
+    """Імпортує ітератор dict-ів чанками. Повертає підсумок із лічильниками по чанках."""
+    summary = {"inserted": 0, "duplicates": 0, "invalid": 0, "chunks": [], "duplicate_keys": []}
+    if collect_keys:
+        summary["keys"] = []
+    items = iter(items)
+    n = 0
+    while True:
+        try:
+            raw = list(islice(items, BULK_CHUNK_SIZE))
+        except BulkError as e:
+            # рядки незавершеного чанка не записані; попередні чанки вже в БД
+            e.summary = summary
+            raise
+        if not raw:
+            break
+        n += 1
+        rows, seen, invalid = [], set(), 0
+        dup_keys = []
+        for item in raw:
+            row = normalize(item, defaults)
+            if row is None:
+                invalid += 1
+                continue
+            if row[key_attr] in seen:
+                dup_keys.append(row[key_attr])
+                continue
+            seen.add(row[key_attr])
+            rows.append(row)
+        inserted = _insert_chunk(model, key_attr, rows) if rows else set()
+        dup_keys += [r[key_attr] for r in rows if r[key_attr] not in inserted]
+
+        summary["chunks"].append({"chunk": n, "rows": len(raw), "inserted": len(inserted),
+                                  "duplicates": len(dup_keys), "invalid": invalid})
+        summary["inserted"] += len(inserted)
+        summary["duplicates"] += len(dup_keys)
+        summary["invalid"] += invalid
+        room = BULK_REPORT_DUPLICATES - len(summary["duplicate_keys"])
+        if room > 0:
+            summary["duplicate_keys"] += dup_keys[:room]
+        if collect_keys:
+            summary["keys"] += [r[key_attr] for r in rows if r[key_attr] in inserted]
+    return summary
+
+
+def import_licenses(items, defaults: dict = None, collect_keys: bool = False):
+    return import_rows(License, "key", items, license_row, defaults, collect_keys)
+
+
+def import_apikeys(items, defaults: dict = None):
+    return import_rows(ApiKey, "api_key", items, apikey_row, defaults)
+
+
+# ---- Експорт
+EXPORTS = {
+    "licenses": (License, ("id", "key", "mac_id", "status", "credit", "last_active")),
+    "apikeys": (ApiKey, ("id", "api_key", "status", "in_use", "last_used", "leased_until", "note")),
+    "logs": (ActivityLog, ("id", "action", "details", "created_at")),
+}
+
+
+def _cell(v):
+    if isinstance(v, datetime):
+        return v.isoformat()
+    return v
+
+
+def _encode(fields, rows, fmt: str, header: bool) -> bytes:
+    buf = io.StringIO()
+    if fmt == "csv":
+        w = csv.writer(buf)
+        if header:
+            w.writerow(fields)
+        for r in rows:
+            w.writerow(["" if v is None else _cell(v) for v in r])
+    else:
+        for r in rows:
+            buf.write(json.dumps({f: _cell(v) for f, v in zip(fields, r)}, ensure_ascii=False))
+            buf.write("\n")
+    return buf.getvalue().encode("utf-8")
+
+
+def export_stream(kind: str, conditions: list, fmt: str = "csv", gzip: bool = False):
+    """Генератор байтів експорту. Рядки йдуть із серверного курсора пачками
+    по EXPORT_YIELD_PER, тож памʼять не залежить від розміру таблиці."""
+    model, fields = EXPORTS[kind]
+    cols = [getattr(model, f) for f in fields]
+    stmt = (
+        select(*cols).where(*conditions).order_by(model.id.asc())
+        .execution_options(yield_per=EXPORT_YIELD_PER)
+    )
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip else None  # wbits=31 -> формат gzip
+    header = True
+    result = db.session.execute(stmt)
+    try:
+        for part in result.partitions():
+            data = _encode(fields, part, fmt, header)
+            header = False
+            if gz:
+                data = gz.compress(data)
+            if data:
+                yield data
+        if header and fmt == "csv":
+            data = _encode(fields, [], fmt, True)
+            yield gz.compress(data) if gz else data
+        if gz:
+            yield gz.flush()
+    finally:
+        result.close()
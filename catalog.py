@@ -0,0 +1,198 @@
+# catalog.py
+# -*- coding: utf-8 -*-
+"""Кеш каталогу (config + price) у памʼяті воркера.
+
+Знімок тримає вже серіалізовані JSON-відповіді /get_config та /get_prices і
+версію з таблиці catalog_version. Адмінські write-ендпоінти збільшують версію
+(bump_version); інші воркери помічають це одним дешевим SELECT не частіше ніж
+раз на CATALOG_PROBE_INTERVAL, а на PostgreSQL — одразу через LISTEN/NOTIFY.
+"""
+import os
+import time
+import logging
+import threading
+from datetime import datetime, timezone
+
+from flask import current_app
+from sqlalchemy import select, update, text
+
+from models import db, Config, Price, CatalogVersion
+
+CATALOG_PROBE_INTERVAL = float(os.getenv("CATALOG_PROBE_INTERVAL", "2"))
+# при активному LISTEN перевіряємо версію рідко — лише як страховку
+CATALOG_LISTEN_PROBE_INTERVAL = float(os.getenv("CATALOG_LISTEN_PROBE_INTERVAL", "30"))
+CATALOG_LISTEN = os.getenv("CATALOG_LISTEN", "1") == "1"
+CATALOG_CHANNEL = "amulet_catalog"
+
+DEFAULT_PRICES = {
+    "seedream-v4": 1,
+    "flux-dev": 1,
+    "flux-pro-v1-1": 2,
+    "gemini-2.5-flash": 1,
+    "imagen3": 2,
+    "classic-fast": 1,
+}
+
+log = logging.getLogger(__name__)
+
+
+class Snapshot:
+    __slots__ = ("version", "config", "prices", "config_body", "prices_body")
+
+    def __init__(self, version, config, prices, config_body, prices_body):
+        self.version = version
+        self.config = config
+        self.prices = prices
+        self.config_body = config_body
+        self.prices_body = prices_body
+
+
+_lock = threading.Lock()
+_changed = threading.Condition()
+_snap = None
+_next_probe = 0.0
+_dirty_gen = 0
+_listening = False
+_listener_started = False
+
+
+def _mark_dirty():
+    global _next_probe, _dirty_gen
+    _dirty_gen += 1
+    _next_probe = 0.0
+    with _changed:
+        _changed.notify_all()
+
+
+def invalidate():
+    """Локальна інвалідація (після commit у цьому воркері)."""
+    _mark_dirty()
+
+
+def bump_version():
+    """Збільшує версію каталогу в поточній транзакції; commit робить викликач."""
+    now = datetime.now(timezone.utc)
+    res = db.session.execute(
+        update(CatalogVersion).where(CatalogVersion.id == 1)
+        .values(version=CatalogVersion.version + 1, updated_at=now)
+        .execution_options(synchronize_session=False)
+    )
+    if not res.rowcount:
+        db.session.add(CatalogVersion(id=1, version=2, updated_at=now))
+    if db.engine.dialect.name == "postgresql":
+        # NOTIFY транзакційний — слухачі отримають його лише після commit
+        db.session.execute(text("SELECT pg_notify(:ch, '')"), {"ch": CATALOG_CHANNEL})
+
+
+def _probe() -> int:
+    return int(db.session.execute(
+        select(CatalogVersion.version).where(CatalogVersion.id == 1)
+    ).scalar() or 0)
+
+
+def _load(version: int) -> Snapshot:
+    cfg = Config.query.order_by(Config.id.asc()).first()
+    config = {
+        "latest_version": cfg.latest_version if cfg else "2.3.3",
+        "force_update": bool(cfg.force_update) if cfg else False,
+        "maintenance": bool(cfg.maintenance) if cfg else False,
+        "maintenance_message": (cfg.maintenance_message if cfg else "") or "",
+        "update_links": (cfg.update_links if cfg else "[]") or "[]",
+        "update_description": (cfg.update_description if cfg else "") or "",
+    }
+    rows = db.session.execute(select(Price.model, Price.price)).all()
+    # fallback у разі пустої таблиці
+    prices = {m: int(p) for m, p in rows} if rows else dict(DEFAULT_PRICES)
+
+    def body(payload) -> bytes:
+        # той самий формат, що й jsonify
+        return current_app.json.response(payload).get_data()
+
+    return Snapshot(
+        version=version,
+        config=config,
+        prices=prices,
+        config_body=body({"ok": True, "config": config}),
+        prices_body=body({"ok": True, "prices": prices}),
+    )
+
+
+def snapshot() -> Snapshot:
+    """Поточний знімок каталогу; БД чіпаємо лише коли настав час перевірки версії."""
+    global _snap, _next_probe
+    snap = _snap
+    if snap is not None and time.monotonic() < _next_probe:
+        return snap
+    with _lock:
+        snap = _snap
+        if snap is not None and time.monotonic() < _next_probe:
+            return snap
+        _ensure_listener()
+        gen = _dirty_gen
+        version = _probe()
+        if snap is None or version != snap.version:
+            snap = _snap = _load(version)
+            with _changed:
+                _changed.notify_all()
+        interval = CATALOG_LISTEN_PROBE_INTERVAL if _listening else CATALOG_PROBE_INTERVAL
+        # NOTIFY міг прийти під час перевірки — тоді наступний виклик перевірить знову
+        _next_probe = 0.0 if gen != _dirty_gen else time.monotonic() + interval
+    return snap
+
+
+def wait_for_change(version: int, timeout: float) -> Snapshot:
+    """Long-poll: чекає, поки версія стане відмінною від version, або timeout.
+
+    Без LISTEN зміни з інших воркерів помічаємо звичайною перевіркою версії,
+    тож затримка не більша за CATALOG_PROBE_INTERVAL.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        snap = snapshot()
+        left = deadline - time.monotonic()
+        if snap.version != version or left <= 0:
+            return snap
+        with _changed:
+            _changed.wait(min(left, max(_next_probe - time.monotonic(), 0.05)))
+
+
+# ======== PostgreSQL LISTEN/NOTIFY ========
+def _ensure_listener():
+    global _listener_started
+    if _listener_started or not CATALOG_LISTEN or db.engine.dialect.name != "postgresql":
+        return
+    _listener_started = True
+    app = current_app._get_current_object()
+    threading.Thread(target=_listen_loop, args=(app,), name="catalog-listen", daemon=True).start()
+
+
+def _listen_loop(app):
+    global _listening
+    while True:
+        raw = None
+        try:
+            with app.app_context():
+                raw = db.engine.raw_connection()
+            raw.detach()
+            conn = raw.driver_connection
+            if not type(conn).__module__.startswith("psycopg."):
+                log.info("catalog: LISTEN потребує psycopg 3, лишаємось на polling")
+                return
+            conn.rollback()
+            conn.autocommit = True
+            conn.execute(f"LISTEN {CATALOG_CHANNEL}")
+            _listening = True
+            _mark_dirty()  # поки не слухали, зміни могли пройти повз
+            for _ in conn.notifies():
+                _mark_dirty()
+        except Exception as e:  # зʼєднання впало — повертаємось до polling і пробуємо знову
+            log.warning("catalog: LISTEN connection lost: %s", e)
+        finally:
+            _listening = False
+            _mark_dirty()
+            if raw is not None:
+                try:
+                    raw.close()
+                except Exception:
+                    pass
+        time.sleep(5)
@@ -0,0 +1,101 @@
+# dbpool.py
+# -*- coding: utf-8 -*-
+"""Налаштування пулу зʼєднань SQLAlchemy з env + fast-fail 503.
+
+Пул у кожного gunicorn-воркера свій, тож дефолти рахуються від потоків
+воркера (WEB_THREADS, як --threads у Procfile): кожен потік запиту тримає
+щонайбільше одне зʼєднання, плюс одне на фонові задачі; overflow покриває
+long-poll і потокові експорти. Разом у БД: WEB_CONCURRENCY × (size + overflow).
+
+DB_POOL_SIZE / DB_MAX_OVERFLOW   — розмір пулу та overflow;
+DB_POOL_PRE_PING=1               — перевірка зʼєднання перед видачею (хостинг рве простої);
+DB_POOL_RECYCLE=300              — перевідкривати зʼєднання, старші за N секунд;
+DB_POOL_TIMEOUT=10               — скільки чекати вільне зʼєднання;
+DB_CONNECT_TIMEOUT=10            — таймаут TCP-підключення (PostgreSQL);
+DB_STATEMENT_TIMEOUT_MS=30000    — statement_timeout на сесію (PostgreSQL, 0 = вимк.);
+DB_POOL_FAST_FAIL=1              — чекати лише DB_FAST_FAIL_TIMEOUT і віддавати 503 з Retry-After.
+"""
+import os
+
+from flask import jsonify
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+import metrics
+
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "2"))
+WEB_THREADS = int(os.getenv("WEB_THREADS", "4"))
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", str(WEB_THREADS + 1)))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", str(max(2, WEB_THREADS // 2))))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "300"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "10"))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "30000"))
+DB_POOL_FAST_FAIL = os.getenv("DB_POOL_FAST_FAIL", "0") == "1"
+# Flask-SQLAlchemy пропускає опції через engine_from_config, а той робить pool_timeout цілим
+DB_FAST_FAIL_TIMEOUT = int(os.getenv("DB_FAST_FAIL_TIMEOUT", "1"))
+DB_RETRY_AFTER = int(os.getenv("DB_RETRY_AFTER", "2"))   # сек у Retry-After для 503
+
+
+def _is_memory_sqlite(url: str) -> bool:
+    return url.startswith("sqlite") and (":memory:" in url or url.rstrip("/") in ("sqlite:", "sqlite:/"))
+
+
+def engine_options(url: str) -> dict:
+    """SQLALCHEMY_ENGINE_OPTIONS для поточного DATABASE_URL."""
+    if _is_memory_sqlite(url):
+        # памʼять SQLite живе в одному зʼєднанні — пул не налаштовуємо
+        return {}
+    opts = {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_timeout": DB_FAST_FAIL_TIMEOUT if DB_POOL_FAST_FAIL else DB_POOL_TIMEOUT,
+        "pool_use_lifo": True,   # зайві зʼєднання простоюють і закриваються recycle
+    }
+    if url.startswith("postgres"):
+        connect_args = {"connect_timeout": DB_CONNECT_TIMEOUT}
+        if DB_STATEMENT_TIMEOUT_MS > 0:
+            connect_args["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+        opts["connect_args"] = connect_args
+    return opts
+
+
+def status(engine) -> dict:
+    """Стан пулу цього воркера (для /admin_api/db/pool)."""
+    pool = engine.pool
+    out = {
+        "pid": os.getpid(),
+        "pool_class": type(pool).__name__,
+        "status": pool.status(),
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": pool.timeout() if hasattr(pool, "timeout") else None,
+        "pre_ping": DB_POOL_PRE_PING,
+        "recycle": DB_POOL_RECYCLE,
+        "statement_timeout_ms": DB_STATEMENT_TIMEOUT_MS if engine.dialect.name == "postgresql" else None,
+        "fast_fail": DB_POOL_FAST_FAIL,
+        "workers": WEB_CONCURRENCY,
+        "threads": WEB_THREADS,
+        "max_connections_total": WEB_CONCURRENCY * (DB_POOL_SIZE + DB_MAX_OVERFLOW),
+    }
+    for name in ("checkedout", "checkedin", "overflow", "size"):
+        fn = getattr(pool, name, None)
+        if fn is not None:
+            out[name] = fn()
+    return out
+
+
+def _pool_timeout(e):
+    metrics.inc("amulet_db_pool_timeouts_total")
+    resp = jsonify(ok=False, msg="Database busy, retry")
+    resp.status_code = 503
+    resp.headers["Retry-After"] = str(DB_RETRY_AFTER)
+    return resp
+
+
+def init_app(app):
+    # вичерпаний пул -> 503 з Retry-After замість 500 (або зависання до --timeout)
+    app.register_error_handler(PoolTimeoutError, _pool_timeout)
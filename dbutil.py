@@ -0,0 +1,39 @@
+# dbutil.py
+# -*- coding: utf-8 -*-
+"""Спільні дрібниці для фонових задач: час з БД та водяні знаки stat_watermark.
+
+Водяний знак — останній оброблений id джерела (rollups, retention). Пакет
+обробляється в одній транзакції з CAS знаку, тож кілька воркерів не візьмуть
+той самий пакет двічі.
+"""
+from datetime import datetime, timezone
+
+from sqlalchemy import select, update
+
+from models import db, StatWatermark
+
+
+def aware(dt):
+    """SQLite повертає naive datetime — вважаємо його UTC."""
+    return dt if dt is None or dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+def watermark(name: str) -> int:
+    return int(db.session.execute(select(StatWatermark.last_id).where(StatWatermark.name == name)).scalar() or 0)
+
+
+def advance_watermark(name: str, old: int, new: int) -> bool:
+    """CAS водяного знаку першим записом транзакції: програв — пакет уже взяв інший воркер."""
+    now = datetime.now(timezone.utc)
+    res = db.session.execute(
+        update(StatWatermark)
+        .where(StatWatermark.name == name, StatWatermark.last_id == old)
+        .values(last_id=new, updated_at=now)
+    )
+    if res.rowcount == 1:
+        return True
+    if old == 0 and db.session.get(StatWatermark, name) is None:
+        db.session.add(StatWatermark(name=name, last_id=new, updated_at=now))
+        db.session.flush()
+        return True
+    return False
@@ -0,0 +1,217 @@
+# idempotency.py
+# -*- coding: utf-8 -*-
+"""Ідемпотентні повтори клієнтських запитів (Idempotency-Key).
+
+Клієнт передає заголовок ``Idempotency-Key`` (або поле ``idempotency_key`` у JSON).
+Перший запит «застовпує» ключ у таблиці idempotency_key, виконується і зберігає
+відповідь; повтор з тим самим ключем отримує збережену відповідь, не торкаючись
+License/ApiKey. Перед таблицею — LRU у памʼяті воркера.
+Commit робить декоратор, а не view: відповідь записується в рядок ключа тією ж
+транзакцією, що й списання / оренда, тож ефект без збереженої відповіді не
+буває. Незавершений запит тримає ключ лише IDEMPOTENCY_PENDING_TTL (таймаут
+воркера з запасом): якщо воркер убили посеред запиту, його транзакція не
+закомічена, і повтор безпечно перехоплює ключ, а не отримує 409 до кінця доби.
+Повний IDEMPOTENCY_TTL — лише для збереженої відповіді.
+"""
+import os
+import json
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+
+from flask import request, jsonify, Response, current_app
+from sqlalchemy import select, update, delete
+from sqlalchemy.exc import IntegrityError
+
+from models import db, IdempotencyKey
+import dbutil
+
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))            # сек
+IDEMPOTENCY_LRU_SIZE = int(os.getenv("IDEMPOTENCY_LRU_SIZE", "4096"))
+# оренда незавершеного запиту: --timeout=120 у Procfile + запас
+IDEMPOTENCY_PENDING_TTL = int(os.getenv("IDEMPOTENCY_PENDING_TTL", "150"))   # сек
+IDEMPOTENCY_SWEEP_EVERY = int(os.getenv("IDEMPOTENCY_SWEEP_EVERY", "300"))  # сек
+IDEMPOTENCY_SWEEP_BATCH = int(os.getenv("IDEMPOTENCY_SWEEP_BATCH", "5000"))
+IDEMPOTENCY_SWEEP_MAX_BATCHES = int(os.getenv("IDEMPOTENCY_SWEEP_MAX_BATCHES", "20"))  # пакетів за прохід
+
+# ці відповіді не кешуємо — клієнт має право повторити запит по-справжньому
+_NOT_REPLAYABLE = {409, 429}
+
+
+class _ReplayLRU:
+    """Потокобезпечний LRU: (scope, key) -> (fingerprint, status, body, expires_ts)."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, k):
+        with self._lock:
+            item = self._data.get(k)
+            if item is None:
+                return None
+            if item[3] < time.time():
+                del self._data[k]
+                return None
+            self._data.move_to_end(k)
+            return item
+
+    def put(self, k, item):
+        with self._lock:
+            self._data[k] = item
+            self._data.move_to_end(k)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+_lru = _ReplayLRU(IDEMPOTENCY_LRU_SIZE)
+
+
+def _request_key() -> str:
+    k = request.headers.get("Idempotency-Key")
+    if not k:
+        j = request.get_json(silent=True)
+        k = j.get("idempotency_key") if isinstance(j, dict) else None
+    return str(k or "").strip()[:128]
+
+
+def _fingerprint() -> str:
+    j = request.get_json(silent=True)
+    if isinstance(j, dict):
+        j = {k: v for k, v in j.items() if k != "idempotency_key"}
+    raw = json.dumps(j, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def _replay(status: int, body: str) -> Response:
+    return Response(body, status, mimetype="application/json",
+                    headers={"Idempotent-Replayed": "true"})
+
+
+def sweep_expired(max_batches: int = IDEMPOTENCY_SWEEP_MAX_BATCHES) -> int:
+    """Фонова задача: видаляє протерміновані записи id-батчами, щоб не тримати довгі локи."""
+    now = datetime.now(timezone.utc)
+    total = 0
+    for _ in range(max_batches):
+        ids = select(IdempotencyKey.id).where(IdempotencyKey.expires_at < now) \
+            .limit(IDEMPOTENCY_SWEEP_BATCH).scalar_subquery()
+        n = db.session.execute(
+            delete(IdempotencyKey).where(IdempotencyKey.id.in_(ids))
+            .execution_options(synchronize_session=False)
+        ).rowcount or 0
+        db.session.commit()
+        total += n
+        if n < IDEMPOTENCY_SWEEP_BATCH:
+            break
+    return total
+
+
+def _pending_until() -> datetime:
+    return datetime.now(timezone.utc) + timedelta(seconds=IDEMPOTENCY_PENDING_TTL)
+
+
+def _take_over(row, fp: str):
+    """CAS на протермінований рядок (оренда вмерлого запиту або стара відповідь). None — програли гонку.
+
+    Pending-рядок без відповіді означає, що транзакція запиту не закомічена, — повтор нічого не подвоїть.
+    """
+    res = db.session.execute(
+        update(IdempotencyKey)
+        .where(IdempotencyKey.id == row.id, IdempotencyKey.expires_at == row.expires_at)
+        .values(fingerprint=fp, status_code=None, response=None, expires_at=_pending_until())
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return row.id if res.rowcount == 1 else None
+
+
+def _claim(scope: str, key: str, fp: str):
+    """Застовплює ключ на IDEMPOTENCY_PENDING_TTL. Повертає (claim_id, None) або (None, готова відповідь)."""
+    for _ in range(2):
+        claim = IdempotencyKey(scope=scope, key=key, fingerprint=fp, expires_at=_pending_until())
+        db.session.add(claim)
+        try:
+            db.session.flush()
+            claim_id = claim.id
+            db.session.commit()
+            return claim_id, None
+        except IntegrityError:
+            db.session.rollback()
+
+        row = db.session.execute(
+            select(IdempotencyKey).where(IdempotencyKey.scope == scope, IdempotencyKey.key == key)
+        ).scalar_one_or_none()
+        if row is None:
+            continue
+        if dbutil.aware(row.expires_at) < datetime.now(timezone.utc):
+            claim_id = _take_over(row, fp)
+            if claim_id is not None:
+                return claim_id, None
+            continue
+        if row.fingerprint != fp:
+            return None, (jsonify(ok=False, msg="Idempotency key reused with different payload"), 422)
+        if row.status_code is None:
+            return None, (jsonify(ok=False, msg="Request in progress"), 409, {"Retry-After": "1"})
+        _lru.put((scope, key), (fp, row.status_code, row.response,
+                                dbutil.aware(row.expires_at).timestamp()))
+        return None, _replay(row.status_code, row.response)
+    return None, (jsonify(ok=False, msg="Request in progress"), 409, {"Retry-After": "1"})
+
+
+def _release(claim_id: int):
+    db.session.rollback()
+    db.session.execute(
+        delete(IdempotencyKey).where(IdempotencyKey.id == claim_id)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+
+def idempotent(scope: str):
+    """Декоратор для клієнтських write-ендпоінтів; view не комітить — commit робить декоратор.
+    Без ключа — звичайна поведінка."""
+    def deco(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = _request_key()
+            if not key:
+                resp = view(*args, **kwargs)
+                db.session.commit()
+                return resp
+            fp = _fingerprint()
+
+            cached = _lru.get((scope, key))
+            if cached is not None:
+                if cached[0] != fp:
+                    return jsonify(ok=False, msg="Idempotency key reused with different payload"), 422
+                return _replay(cached[1], cached[2])
+
+            claim_id, early = _claim(scope, key, fp)
+            if early is not None:
+                return early
+
+            try:
+                resp = current_app.make_response(view(*args, **kwargs))
+                if resp.status_code >= 500 or resp.status_code in _NOT_REPLAYABLE:
+                    # зміни view відкочуються разом із ключем — клієнт повторить по-справжньому
+                    _release(claim_id)
+                    return resp
+                body = resp.get_data(as_text=True)
+                expires = datetime.now(timezone.utc) + timedelta(seconds=IDEMPOTENCY_TTL)
+                db.session.execute(
+                    update(IdempotencyKey).where(IdempotencyKey.id == claim_id)
+                    .values(status_code=resp.status_code, response=body, expires_at=expires)
+                    .execution_options(synchronize_session=False)
+                )
+                db.session.commit()   # ефект view і відповідь — одна транзакція
+            except Exception:
+                _release(claim_id)
+                raise
+            _lru.put((scope, key), (fp, resp.status_code, body, expires.timestamp()))
+            return resp
+        return wrapper
+    return deco
@@ -0,0 +1,146 @@
+# leases.py
+# -*- coding: utf-8 -*-
+"""Оренда API-ключів з пулу ApiKey.
+
+Ключ видається на API_KEY_LEASE_TTL секунд з токеном оренди; клієнт продовжує
+оренду heartbeat-ом (renew). Протерміновані оренди вважаються вільними вже при
+видачі, а фоновий reclaim() ще й прибирає їх у таблиці. Видача — один умовний
+UPDATE: на PostgreSQL кандидат обирається з FOR UPDATE SKIP LOCKED, на SQLite
+UPDATE атомарний під write-lock. Порядок — за last_used (LRU), тож навантаження
+розходиться по всіх ключах, а не лише по найменших id.
+"""
+import os
+import secrets
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select, update, func, case, and_, or_
+
+from models import db, ApiKey
+
+API_KEY_LEASE_TTL = int(os.getenv("API_KEY_LEASE_TTL", "1800"))              # сек
+API_KEY_RECLAIM_INTERVAL = int(os.getenv("API_KEY_RECLAIM_INTERVAL", "60"))  # сек
+
+
+def _free_clause(now):
+    return and_(
+        ApiKey.status == "active",
+        or_(
+            ApiKey.in_use.is_(False),
+            and_(ApiKey.leased_until.isnot(None), ApiKey.leased_until < now),
+        ),
+    )
+
+
+def acquire(ttl: int = None):
+    """Видає найдавніше використаний вільний ключ. Повертає dict або None. Commit робить викликач."""
+    ttl = ttl or API_KEY_LEASE_TTL
+    for _ in range(3):
+        now = datetime.now(timezone.utc)
+        until = now + timedelta(seconds=ttl)
+        token = secrets.token_hex(16)
+        pick = (
+            select(ApiKey.id)
+            .where(_free_clause(now))
+            .order_by(ApiKey.last_used.asc().nulls_first(), ApiKey.id.asc())
+            .limit(1)
+        )
+        if db.engine.dialect.name == "postgresql":
+            pick = pick.with_for_update(skip_locked=True)
+        stmt = (
+            update(ApiKey)
+            .where(ApiKey.id == pick.scalar_subquery(), _free_clause(now))
+            .values(in_use=True, lease_token=token, leased_until=until, last_used=now)
+            .execution_options(synchronize_session=False)
+        )
+        if db.engine.dialect.update_returning:
+            api_key = db.session.execute(stmt.returning(ApiKey.api_key)).scalar_one_or_none()
+        elif db.session.execute(stmt).rowcount == 1:
+            api_key = db.session.execute(
+                select(ApiKey.api_key).where(ApiKey.lease_token == token)
+            ).scalar_one()
+        else:
+            api_key = None
+        if api_key is not None:
+            return {"api_key": api_key, "lease_token": token, "leased_until": until, "ttl": ttl}
+        # кандидата перехопили між SELECT і UPDATE — пробуємо, лише якщо ще є вільні
+        if not db.session.execute(select(ApiKey.id).where(_free_clause(now)).limit(1)).first():
+            return None
+    return None
+
+
+def _lease_match(api_key: str, lease_token: str):
+    cond = [ApiKey.api_key == api_key]
+    if lease_token:
+        cond.append(ApiKey.lease_token == lease_token)
+    return cond
+
+
+def renew(api_key: str, lease_token: str = "", ttl: int = None):
+    """Heartbeat: продовжує оренду, поки ключ не видано іншому. Повертає новий leased_until або None."""
+    ttl = ttl or API_KEY_LEASE_TTL
+    now = datetime.now(timezone.utc)
+    until = now + timedelta(seconds=ttl)
+    n = db.session.execute(
+        update(ApiKey)
+        .where(*_lease_match(api_key, lease_token), ApiKey.in_use.is_(True))
+        .values(leased_until=until, last_used=now)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    return until if n else None
+
+
+def release(api_key: str, lease_token: str = "") -> bool:
+    """Повертає ключ у пул. З токеном — лише якщо оренда ще наша."""
+    n = db.session.execute(
+        update(ApiKey)
+        .where(*_lease_match(api_key, lease_token))
+        .values(in_use=False, lease_token=None, leased_until=None,
+                last_used=datetime.now(timezone.utc))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    return bool(n)
+
+
+def reclaim() -> int:
+    """Фонова задача: повертає в пул усі протерміновані оренди одним UPDATE."""
+    n = db.session.execute(
+        update(ApiKey)
+        .where(ApiKey.in_use.is_(True), ApiKey.leased_until.isnot(None),
+               ApiKey.leased_until < datetime.now(timezone.utc))
+        .values(in_use=False, lease_token=None, leased_until=None)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    return n or 0
+
+
+def pool_stats() -> dict:
+    """Використання пулу одним агрегатним запитом."""
+    now = datetime.now(timezone.utc)
+    active = ApiKey.status == "active"
+    # кошики не перетинаються: free + leased + held + expired + inactive == total
+    leased = and_(ApiKey.in_use.is_(True), ApiKey.leased_until.isnot(None), ApiKey.leased_until >= now)
+    expired = and_(ApiKey.in_use.is_(True), ApiKey.leased_until < now)
+
+    def count(cond):
+        return func.coalesce(func.sum(case((cond, 1), else_=0)), 0)
+
+    row = db.session.execute(select(
+        func.count(ApiKey.id),
+        count(and_(active, ApiKey.in_use.is_(False))),
+        count(and_(active, leased)),
+        count(and_(active, ApiKey.in_use.is_(True), ApiKey.leased_until.is_(None))),
+        count(and_(active, expired)),
+        count(~active),
+        count(and_(active, ApiKey.in_use.is_(True))),
+    )).one()
+    total, free, leased_n, held, expired_n, inactive, in_use = (int(x) for x in row)
+    return {
+        "total": total,
+        "free": free,
+        "in_use": in_use,        # усі зайняті: leased + held + expired
+        "leased": leased_n,
+        "held": held,            # in_use без терміну (зайняті вручну з адмінки)
+        "expired": expired_n,
+        "inactive": inactive,
+    }
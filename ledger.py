@@ -0,0 +1,175 @@
+# ledger.py
+# -*- coding: utf-8 -*-
+"""Журнал кредиту: кожна зміна License.credit лишає рядок у credit_ledger.
+
+License.credit — матеріалізований баланс: умовний UPDATE у debit лишається
+захистом від мінусу, а рядок журналу пишеться в тій самій транзакції з
+balance_after, тож останній рядок журналу завжди дорівнює credit.
+Ліцензія без рядків має лише початковий баланс (імпорт / створення).
+
+Стиснення: списання, старші за LEDGER_COMPACT_AFTER_DAYS, згортаються в
+один рядок kind="daily" на (ліцензія, модель, день). Підсумковий рядок
+отримує id останнього списання групи, тож порядок історії за id зберігається.
+"""
+import os
+import logging
+from datetime import datetime, timezone, timedelta
+
+from sqlalchemy import select, insert, delete, func, literal
+
+from models import db, License, CreditLedger
+import dbutil
+import queries
+
+LEDGER_COMPACT_AFTER_DAYS = int(os.getenv("LEDGER_COMPACT_AFTER_DAYS", "30"))
+LEDGER_COMPACT_INTERVAL = float(os.getenv("LEDGER_COMPACT_INTERVAL", "3600"))   # сек
+LEDGER_COMPACT_MAX_DAYS = int(os.getenv("LEDGER_COMPACT_MAX_DAYS", "7"))          # днів за прохід
+LEDGER_IN_CHUNK = 1000
+
+USAGE_KINDS = ("debit", "daily")
+
+log = logging.getLogger(__name__)
+
+
+# ---- Запис (викликач робить commit)
+def record_debit(license_id: int, credit_after: int, entries: list):
+    """entries: [(model, count, unit_price)] у порядку списання; credit_after — баланс після всіх."""
+    now = datetime.now(timezone.utc)
+    balance = credit_after + sum(count * unit for _, count, unit in entries)
+    rows = []
+    for model, count, unit in entries:
+        balance -= count * unit
+        rows.append({
+            "license_id": license_id, "kind": "debit", "model": model[:64], "units": count,
+            "unit_price": unit, "amount": -count * unit, "balance_after": balance, "created_at": now,
+        })
+    db.session.execute(insert(CreditLedger), rows)
+
+
+def record_adjustments(conditions: list, amount: int, mode: str):
+    """Рядки adjust для масового add_credit / set_credit — ДО самого UPDATE, тією ж транзакцією.
+
+    На PostgreSQL рядки ліцензій спершу блокуються, щоб паралельний debit не
+    змінив credit між цим INSERT ... SELECT і UPDATE; SQLite і так має одного писача.
+    """
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute(select(License.id).where(*conditions).with_for_update()).all()
+    if mode == "add":
+        delta, after = literal(amount), License.credit + amount
+    else:
+        delta, after = literal(amount) - License.credit, literal(amount)
+        conditions = list(conditions) + [License.credit != amount]
+    src = select(
+        License.id, literal("adjust"), literal(0), delta, after, literal(datetime.now(timezone.utc)),
+    ).where(*conditions)
+    db.session.execute(insert(CreditLedger).from_select(
+        ["license_id", "kind", "units", "amount", "balance_after", "created_at"], src,
+    ))
+
+
+# ---- Читання
+def balance(license_id: int):
+    """Швидкий баланс (License.credit) + звірка з останнім рядком журналу. None — нема ліцензії."""
+    credit = db.session.execute(select(License.credit).where(License.id == license_id)).scalar()
+    if credit is None:
+        return None
+    last = db.session.execute(
+        select(CreditLedger.balance_after)
+        .where(CreditLedger.license_id == license_id)
+        .order_by(CreditLedger.id.desc()).limit(1)
+    ).scalar()
+    return {"credit": int(credit), "ledger_balance": last, "consistent": last is None or last == credit}
+
+
+def usage_conditions(license_id: int, args) -> list:
+    cond = [CreditLedger.license_id == license_id]
+    model = str(args.get("model", "")).strip()
+    if model:
+        cond.append(CreditLedger.model == model)
+    kind = str(args.get("kind", "")).strip().lower()
+    if kind:
+        cond.append(CreditLedger.kind == kind)
+    since = queries.parse_ts(args.get("since"))
+    if since:
+        cond.append(CreditLedger.created_at >= since)
+    until = queries.parse_ts(args.get("until"))
+    if until:
+        cond.append(CreditLedger.created_at < until)
+    return cond
+
+
+def usage_summary(conditions: list) -> list:
+    """Витрати по моделях у межах умов (лише списання та їх денні підсумки)."""
+    rows = db.session.execute(
+        select(CreditLedger.model, func.sum(CreditLedger.units), func.sum(CreditLedger.amount))
+        .where(*conditions, CreditLedger.kind.in_(USAGE_KINDS))
+        .group_by(CreditLedger.model)
+        .order_by(func.sum(CreditLedger.amount))
+    ).all()
+    return [{"model": m, "units": int(u or 0), "spent": -int(a or 0)} for m, u, a in rows]
+
+
+# ---- Стиснення
+def _compact_day(start: datetime, end: datetime) -> int:
+    """Згортає списання за [start, end) в один рядок на (ліцензія, модель). Повертає к-сть прибраних рядків."""
+    window = (CreditLedger.kind == "debit", CreditLedger.created_at >= start, CreditLedger.created_at < end)
+    groups = db.session.execute(
+        select(CreditLedger.license_id, CreditLedger.model, func.sum(CreditLedger.units),
+               func.sum(CreditLedger.amount), func.max(CreditLedger.id), func.count())
+        .where(*window)
+        .group_by(CreditLedger.license_id, CreditLedger.model)
+    ).all()
+    if not groups:
+        return 0
+    last_ids = [g[4] for g in groups]
+    tail = {}
+    for i in range(0, len(last_ids), LEDGER_IN_CHUNK):
+        for rid, bal, ts in db.session.execute(
+            select(CreditLedger.id, CreditLedger.balance_after, CreditLedger.created_at)
+            .where(CreditLedger.id.in_(last_ids[i:i + LEDGER_IN_CHUNK]))
+        ):
+            tail[rid] = (bal, ts)
+    expected = sum(g[5] for g in groups)
+    removed = db.session.execute(
+        delete(CreditLedger).where(*window, CreditLedger.id <= max(last_ids))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if removed != expected:
+        # інший воркер уже стискає цей день
+        db.session.rollback()
+        return 0
+    rows = []
+    for lic_id, model, units, amount, last_id, _ in groups:
+        units, spent = int(units or 0), -int(amount or 0)
+        bal, ts = tail[last_id]
+        rows.append({
+            "id": last_id, "license_id": lic_id, "kind": "daily", "model": model, "units": units,
+            "unit_price": spent // units if units and spent % units == 0 else None,
+            "amount": -spent, "balance_after": bal, "created_at": ts,
+        })
+    db.session.execute(insert(CreditLedger), rows)
+    db.session.commit()
+    return removed
+
+
+def compact() -> int:
+    """Фонова задача: стискає до LEDGER_COMPACT_MAX_DAYS найстаріших повних днів."""
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    cutoff = today - timedelta(days=LEDGER_COMPACT_AFTER_DAYS)
+    total = 0
+    for _ in range(LEDGER_COMPACT_MAX_DAYS):
+        oldest = dbutil.aware(db.session.execute(
+            select(func.min(CreditLedger.created_at))
+            .where(CreditLedger.kind == "debit", CreditLedger.created_at < cutoff)
+        ).scalar())
+        db.session.rollback()
+        if oldest is None:
+            break
+        start = oldest.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        removed = _compact_day(start, start + timedelta(days=1))
+        if not removed:
+            break
+        total += removed
+    if total:
+        log.info("ledger: compacted %d debit rows", total)
+    return total
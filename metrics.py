@@ -0,0 +1,326 @@
+# metrics.py
+# -*- coding: utf-8 -*-
+"""Метрики у форматі Prometheus (/metrics).
+
+Кожен воркер рахує в памʼяті (один lock, без I/O на запиті) і раз на
+METRICS_FLUSH_INTERVAL секунд скидає знімок у METRICS_DIR/worker-<pid>.json.
+/metrics підсумовує файли всіх воркерів: лічильники й гістограми — сумою,
+гейджі — лише від живих воркерів (свіжий файл) з міткою pid.
+Файл воркера, якого вже нема (перезапуск, таймаут gunicorn), старший за
+METRICS_STALE_AFTER, згортається в METRICS_DIR/retired.json і видаляється:
+сумарні лічильники не падають, а файлів не більше, ніж живих воркерів.
+DB-метрики збираються подіями SQLAlchemy before/after_cursor_execute,
+пул — подіями checkout/checkin/connect.
+"""
+import os
+import json
+import time
+import glob
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from flask import request, g, has_request_context
+from sqlalchemy import event
+
+METRICS_DIR = os.getenv("METRICS_DIR", os.path.join(tempfile.gettempdir(), "amulet-metrics"))
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))   # сек
+METRICS_STALE_AFTER = float(os.getenv("METRICS_STALE_AFTER", "300"))       # сек
+RETIRED_FILE = "retired.json"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+HELP = {
+    "amulet_http_requests_total": ("counter", "HTTP requests by route, method and status"),
+    "amulet_http_request_duration_seconds": ("histogram", "HTTP request latency"),
+    "amulet_db_queries_per_request": ("histogram", "DB queries issued per HTTP request"),
+    "amulet_db_request_seconds_total": ("counter", "DB time spent inside HTTP requests"),
+    "amulet_http_query_heavy_total": ("counter", "Requests over PROFILE_QUERY_LIMIT queries"),
+    "amulet_db_queries_total": ("counter", "DB statements executed"),
+    "amulet_db_query_duration_seconds": ("histogram", "DB statement latency"),
+    "amulet_db_pool_checkouts_total": ("counter", "Connection pool checkouts"),
+    "amulet_db_pool_connects_total": ("counter", "New DB connections opened by the pool"),
+    "amulet_db_pool_timeouts_total": ("counter", "Requests rejected with 503 on pool checkout timeout"),
+    "amulet_db_replica_reads_total": ("counter", "Read-only requests by database used"),
+    "amulet_db_replica_lag_seconds": ("gauge", "Replica lag seen by the last probe"),
+    "amulet_db_replica_healthy": ("gauge", "1 when reads may go to the replica"),
+    "amulet_db_pool_checked_out": ("gauge", "Connections currently checked out"),
+    "amulet_db_pool_size": ("gauge", "Configured pool size"),
+    "amulet_db_pool_overflow": ("gauge", "Current pool overflow"),
+    "amulet_rate_limited_total": ("counter", "Client requests rejected with 429 by endpoint and bucket scope"),
+    "amulet_last_active_pending": ("gauge", "License last_active timestamps buffered for the next flush"),
+}
+
+_lock = threading.Lock()
+_counters = {}   # (name, labels) -> float
+_hists = {}      # (name, labels) -> [bucket counts..., sum, count]
+_gauge_fns = []  # callables -> [(name, labels, value)]
+
+
+def inc(name: str, labels: tuple = (), value: float = 1.0):
+    k = (name, labels)
+    with _lock:
+        _counters[k] = _counters.get(k, 0.0) + value
+
+
+def observe(name: str, labels: tuple, value: float, buckets=LATENCY_BUCKETS):
+    k = (name, labels)
+    with _lock:
+        h = _hists.get(k)
+        if h is None:
+            h = _hists[k] = [0] * len(buckets) + [0.0, 0]
+        for i, b in enumerate(buckets):
+            if value <= b:
+                h[i] += 1
+                break
+        h[-2] += value
+        h[-1] += 1
+
+
+def gauge_source(fn):
+    _gauge_fns.append(fn)
+    return fn
+
+
+# ======== Хуки запитів ========
+def _before_request():
+    g._m_start = time.perf_counter()
+    g._m_queries = 0
+    g._m_db_time = 0.0
+
+
+def _after_request(resp):
+    start = g.pop("_m_start", None)
+    if start is None:
+        return resp
+    route = request.url_rule.rule if request.url_rule else "<unmatched>"
+    method = request.method
+    elapsed = time.perf_counter() - start
+    queries = g.get("_m_queries", 0)
+    inc("amulet_http_requests_total", (("route", route), ("method", method), ("status", str(resp.status_code))))
+    observe("amulet_http_request_duration_seconds", (("route", route), ("method", method)), elapsed)
+    observe("amulet_db_queries_per_request", (("route", route),), queries, QUERY_COUNT_BUCKETS)
+    if queries:
+        inc("amulet_db_request_seconds_total", (("route", route),), g.get("_m_db_time", 0.0))
+    return resp
+
+
+# ======== Події SQLAlchemy ========
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("_m_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stack = conn.info.get("_m_query_start")
+    if not stack:
+        return
+    elapsed = time.perf_counter() - stack.pop()
+    inc("amulet_db_queries_total")
+    observe("amulet_db_query_duration_seconds", (), elapsed)
+    if has_request_context() and "_m_start" in g:
+        g._m_queries = g.get("_m_queries", 0) + 1
+        g._m_db_time = g.get("_m_db_time", 0.0) + elapsed
+        capture = g.get("_m_capture")
+        if capture is not None:
+            capture.append((statement, elapsed))
+
+
+def instrument_engine(engine):
+    """Час і кількість SQL для engine (primary або репліка)."""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def init_app(app, engine):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    instrument_engine(engine)
+    event.listen(engine, "checkout", lambda *a: inc("amulet_db_pool_checkouts_total"))
+    event.listen(engine, "connect", lambda *a: inc("amulet_db_pool_connects_total"))
+
+    @gauge_source
+    def _pool_gauges():
+        pool = engine.pool
+        out = []
+        for name, attr in (("amulet_db_pool_checked_out", "checkedout"),
+                           ("amulet_db_pool_size", "size"),
+                           ("amulet_db_pool_overflow", "overflow")):
+            fn = getattr(pool, attr, None)
+            if fn is not None:
+                out.append((name, (), float(fn())))
+        return out
+
+
+# ======== Мультипроцесне сховище ========
+def _snapshot() -> dict:
+    with _lock:
+        counters = [[n, list(l), v] for (n, l), v in _counters.items()]
+        hists = [[n, list(l), list(h)] for (n, l), h in _hists.items()]
+    gauges = []
+    for fn in _gauge_fns:
+        try:
+            gauges += [[n, list(l), v] for n, l, v in fn()]
+        except Exception:
+            pass
+    return {"pid": os.getpid(), "ts": time.time(), "counters": counters, "hists": hists, "gauges": gauges}
+
+
+def flush():
+    """Атомарно записує знімок цього воркера у METRICS_DIR."""
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"worker-{os.getpid()}.json")
+    tmp = path + ".tmp"
+    with open(tmp, "w") as fh:
+        json.dump(_snapshot(), fh)
+    os.replace(tmp, path)
+
+
+def _labels_str(labels) -> str:
+    if not labels:
+        return ""
+    parts = []
+    for k, v in labels:
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _bucket_bounds(name: str):
+    return QUERY_COUNT_BUCKETS if name == "amulet_db_queries_per_request" else LATENCY_BUCKETS
+
+
+def _load(path: str):
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def _merge(counters: dict, hists: dict, snap: dict):
+    for n, l, v in snap.get("counters", []):
+        k = (n, tuple(map(tuple, l)))
+        counters[k] = counters.get(k, 0.0) + v
+    for n, l, h in snap.get("hists", []):
+        k = (n, tuple(map(tuple, l)))
+        acc = hists.get(k)
+        hists[k] = list(h) if acc is None else [a + b for a, b in zip(acc, h)]
+
+
+def _alive(pid) -> bool:
+    if os.name == "nt":   # os.kill(pid, 0) на Windows завершує процес — там лише вік файлу
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except (ProcessLookupError, TypeError, ValueError):
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+@contextmanager
+def _retire_lock(path: str):
+    try:
+        import fcntl
+    except ImportError:  # Windows — без міжпроцесного лока
+        yield
+        return
+    with open(path + ".lock", "w") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def _retire(path: str):
+    """Згортає знімок мертвого воркера в retired.json і видаляє його файл."""
+    claim = path + ".retiring"
+    try:
+        os.rename(path, claim)   # атомарно: згорне лише один воркер
+    except OSError:
+        return
+    snap = _load(claim) or {}
+    retired_path = os.path.join(METRICS_DIR, RETIRED_FILE)
+    with _retire_lock(retired_path):
+        counters, hists = {}, {}
+        _merge(counters, hists, _load(retired_path) or {})
+        _merge(counters, hists, snap)
+        tmp = retired_path + f".{os.getpid()}.tmp"
+        with open(tmp, "w") as fh:
+            json.dump({
+                "counters": [[n, list(l), v] for (n, l), v in counters.items()],
+                "hists": [[n, list(l), h] for (n, l), h in hists.items()],
+            }, fh)
+        os.replace(tmp, retired_path)
+    os.remove(claim)
+
+
+def _collect():
+    """Сума знімків усіх воркерів: (counters, hists, gauges)."""
+    try:
+        flush()
+    except OSError:
+        pass
+    counters, hists, gauges = {}, {}, []
+    now = time.time()
+    for path in glob.glob(os.path.join(METRICS_DIR, "worker-*.json")):
+        snap = _load(path)
+        if snap is None:
+            continue
+        if now - snap.get("ts", 0) > METRICS_STALE_AFTER and not _alive(snap.get("pid")):
+            try:
+                _retire(path)
+            except OSError:
+                pass
+            continue
+        _merge(counters, hists, snap)
+        # гейджі мертвих воркерів не показуємо
+        if now - snap.get("ts", 0) <= METRICS_FLUSH_INTERVAL * 3:
+            for n, l, v in snap.get("gauges", []):
+                gauges.append((n, tuple(map(tuple, l)) + (("pid", str(snap.get("pid"))),), v))
+    _merge(counters, hists, _load(os.path.join(METRICS_DIR, RETIRED_FILE)) or {})
+    return counters, hists, gauges
+
+
+def counter_totals(name: str) -> dict:
+    """Лічильник name по всіх воркерах: {"k=v,...": значення}."""
+    counters, _, _ = _collect()
+    return {
+        ",".join(f"{k}={v}" for k, v in l): val
+        for (n, l), val in sorted(counters.items()) if n == name
+    }
+
+
+def render() -> str:
+    """Prometheus text format по всіх воркерах."""
+    counters, hists, gauges = _collect()
+    lines = []
+    seen = set()
+
+    def header(name):
+        if name not in seen:
+            seen.add(name)
+            kind, text = HELP.get(name, ("untyped", name))
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (n, l), v in sorted(counters.items()):
+        header(n)
+        lines.append(f"{n}{_labels_str(l)} {v:g}")
+    for (n, l), h in sorted(hists.items()):
+        header(n)
+        bounds = _bucket_bounds(n)
+        cum = 0
+        for b, c in zip(bounds, h):
+            cum += c
+            lines.append(f"{n}_bucket{_labels_str(l + (('le', f'{b:g}'),))} {cum}")
+        lines.append(f"{n}_bucket{_labels_str(l + (('le', '+Inf'),))} {h[-1]}")
+        lines.append(f"{n}_sum{_labels_str(l)} {h[-2]:g}")
+        lines.append(f"{n}_count{_labels_str(l)} {h[-1]}")
+    for n, l, v in sorted(gauges):
+        header(n)
+        lines.append(f"{n}{_labels_str(l)} {v:g}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,307 @@
+# migrations.py
+# -*- coding: utf-8 -*-
+"""Версійовані міграції схеми.
+
+Кожна міграція — ідемпотентна функція fn(conn), зареєстрована через
+@migration(N, "опис"). Поточна версія зберігається в schema_version.
+Воркер на старті робить один SELECT (ensure_current); якщо схема відстає,
+міграції виконуються під advisory lock (PostgreSQL) або файловим локом (SQLite),
+тож кілька воркерів не женуться один з одним на ALTER TABLE.
+Перед деплоєм: flask --app app db-upgrade
+"""
+import os
+import logging
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timezone, timedelta
+
+from sqlalchemy import inspect, text, select, update, insert, func
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+from models import (
+    db, SchemaVersion, License, Config, Price, CatalogVersion, ActivityLog, CreditLedger,
+    StatRollup, StatActive, StatWatermark, RateBucket,
+)
+
+# ключ pg_advisory_lock (довільне стале число для цього застосунку)
+MIGRATION_LOCK_KEY = 0x616D756C
+
+log = logging.getLogger(__name__)
+MIGRATIONS = []
+
+
+def migration(version: int, name: str):
+    def deco(fn):
+        MIGRATIONS.append((version, name, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return deco
+
+
+def latest_version() -> int:
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+# ---- Хелпери для ідемпотентних міграцій
+def add_column(conn, table: str, colname: str, ddl_sql: str):
+    insp = inspect(conn)
+    if not insp.has_table(table):
+        return
+    if colname not in {c["name"] for c in insp.get_columns(table)}:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {ddl_sql}"))
+
+
+def create_index(conn, name: str, table: str, columns: str):
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})"))
+
+
+def create_tables(conn, *models):
+    for m in models:
+        m.__table__.create(conn, checkfirst=True)
+
+
+# ======== Міграції ========
+@migration(1, "base schema")
+def _m001_base_schema(conn):
+    db.metadata.create_all(conn)
+    # колонки, яких могло не бути в старих БД
+    add_column(conn, "config", "updated_at", "updated_at TIMESTAMPTZ DEFAULT now()")
+    add_column(conn, "price", "updated_at", "updated_at TIMESTAMPTZ DEFAULT now()")
+    add_column(conn, "api_key", "in_use", "in_use BOOLEAN DEFAULT FALSE")
+    add_column(conn, "api_key", "note", "note TEXT")
+    add_column(conn, "license", "last_active", "last_active TIMESTAMPTZ")
+    add_column(conn, "api_key", "lease_token", "lease_token VARCHAR(64)")
+    add_column(conn, "api_key", "leased_until", "leased_until TIMESTAMPTZ")
+    create_index(conn, "ix_api_key_leased_until", "api_key", "leased_until")
+    create_index(conn, "ix_api_key_last_used", "api_key", "last_used")
+
+
+@migration(2, "seed config, prices, catalog version")
+def _m002_seed(conn):
+    now = datetime.now(timezone.utc)
+    # CONFIG (єдиний рядок)
+    if conn.execute(select(func.count()).select_from(Config.__table__)).scalar() == 0:
+        conn.execute(insert(Config.__table__).values(
+            latest_version="2.3.3",
+            force_update=False,
+            maintenance=False,
+            maintenance_message="",
+            update_links="[]",
+            update_description="",
+            updated_at=now,
+        ))
+    # PRICES (якщо порожньо — піднімаємо дефолт)
+    if conn.execute(select(func.count()).select_from(Price.__table__)).scalar() == 0:
+        defaults = {
+            "seedream-v4": 1,
+            "flux-dev": 1,
+            "flux-pro-v1-1": 2,
+            "gemini-2.5-flash": 1,
+            "imagen3": 2,
+            "classic-fast": 1,
+        }
+        conn.execute(insert(Price.__table__), [
+            {"model": m, "price": int(v), "updated_at": now} for m, v in defaults.items()
+        ])
+    # CATALOG VERSION (лічильник для кешу каталогу)
+    if conn.execute(select(CatalogVersion.version).where(CatalogVersion.id == 1)).first() is None:
+        conn.execute(insert(CatalogVersion.__table__).values(id=1, version=1, updated_at=now))
+
+
+@migration(3, "credit ledger")
+def _m003_credit_ledger(conn):
+    create_tables(conn, CreditLedger)
+
+
+@migration(4, "stats rollups")
+def _m004_stats_rollups(conn):
+    create_tables(conn, StatRollup, StatActive, StatWatermark)
+
+
+@migration(5, "rate limit buckets")
+def _m005_rate_buckets(conn):
+    create_tables(conn, RateBucket)
+
+
+@migration(6, "license ids without reuse")
+def _m006_license_autoincrement(conn):
+    """SQLite без AUTOINCREMENT видає id найбільшої видаленої ліцензії знову — і нова
+    ліцензія успадкувала б її журнал кредиту. Таблицю перебудовуємо з AUTOINCREMENT,
+    а лічильник ставимо не нижче за будь-який id, що вже є в журналі.
+    PostgreSQL: послідовність SERIAL і так не повертається назад."""
+    if conn.dialect.name != "sqlite":
+        return
+    ddl = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'license'")).scalar()
+    if ddl is None or "AUTOINCREMENT" in ddl.upper():
+        return
+    insp = inspect(conn)
+    old_cols = {c["name"] for c in insp.get_columns("license")}
+    cols = ", ".join(c.name for c in License.__table__.columns if c.name in old_cols)
+    conn.execute(text("ALTER TABLE license RENAME TO license_old"))
+    for ix in insp.get_indexes("license_old"):
+        conn.execute(text(f"DROP INDEX IF EXISTS {ix['name']}"))
+    License.__table__.create(conn)
+    conn.execute(text(f"INSERT INTO license ({cols}) SELECT {cols} FROM license_old"))
+    conn.execute(text("DROP TABLE license_old"))
+    top = max(
+        conn.execute(select(func.max(License.id))).scalar() or 0,
+        conn.execute(select(func.max(CreditLedger.license_id))).scalar() or 0,
+    )
+    conn.execute(text("DELETE FROM sqlite_sequence WHERE name = 'license'"))
+    conn.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('license', :top)"), {"top": top})
+
+
+# ======== Секціонування activity_log (PostgreSQL, разово: flask --app app logs-partition) ========
+PG_IS_PARTITIONED_SQL = "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('activity_log')"
+
+
+def next_month(dt: datetime) -> datetime:
+    """Початок наступного місяця для dt, що вже є початком місяця."""
+    return (dt.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def ensure_activity_partitions(conn, start: datetime, end: datetime):
+    """Місячні секції activity_log_pYYYYMM, що покривають [start, end)."""
+    m = start.astimezone(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    while m < end:
+        nxt = next_month(m)
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS activity_log_p{m:%Y%m} PARTITION OF activity_log"
+            f" FOR VALUES FROM ('{m.isoformat()}') TO ('{nxt.isoformat()}')"
+        ))
+        m = nxt
+
+
+def partition_activity_log(engine=None, months_ahead: int = 2) -> bool:
+    """Перетворює activity_log на секціоновану по місяцях created_at. False — вже секціонована.
+
+    Рядки копіюються однією транзакцією під ACCESS EXCLUSIVE — на великій
+    таблиці спершу дайте ретеншну прибрати старе. PK стає (id, created_at):
+    PostgreSQL вимагає ключ секціонування в унікальних індексах.
+    """
+    engine = engine or db.engine
+    if engine.dialect.name != "postgresql":
+        raise RuntimeError("activity_log partitioning needs PostgreSQL")
+    with engine.connect() as conn:
+        with _migration_lock(conn):
+            if conn.execute(text(PG_IS_PARTITIONED_SQL)).first():
+                return False
+            conn.execute(text("LOCK TABLE activity_log IN ACCESS EXCLUSIVE MODE"))
+            seq = conn.execute(text("SELECT pg_get_serial_sequence('activity_log', 'id')")).scalar()
+            now = datetime.now(timezone.utc)
+            first = conn.execute(select(func.min(ActivityLog.created_at))).scalar() or now
+            # стара таблиця звільняє імена; послідовність id переживає DROP
+            conn.execute(text(f"ALTER SEQUENCE {seq} OWNED BY NONE"))
+            conn.execute(text("ALTER TABLE activity_log RENAME TO activity_log_old"))
+            conn.execute(text("ALTER TABLE activity_log_old RENAME CONSTRAINT activity_log_pkey TO activity_log_old_pkey"))
+            conn.execute(text("DROP INDEX IF EXISTS ix_activity_log_action"))
+            conn.execute(text("DROP INDEX IF EXISTS ix_activity_log_created_at"))
+            conn.execute(text(
+                "CREATE TABLE activity_log ("
+                f" id INTEGER NOT NULL DEFAULT nextval('{seq}'),"
+                " action VARCHAR(64) NOT NULL,"
+                " details TEXT,"
+                " created_at TIMESTAMPTZ NOT NULL DEFAULT now(),"
+                " PRIMARY KEY (id, created_at)"
+                ") PARTITION BY RANGE (created_at)"
+            ))
+            end = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+            for _ in range(months_ahead + 1):
+                end = next_month(end)
+            ensure_activity_partitions(conn, first, end)
+            conn.execute(text("CREATE TABLE activity_log_default PARTITION OF activity_log DEFAULT"))
+            conn.execute(text(
+                "INSERT INTO activity_log (id, action, details, created_at)"
+                " SELECT id, action, details, created_at FROM activity_log_old"
+            ))
+            conn.execute(text(f"ALTER SEQUENCE {seq} OWNED BY activity_log.id"))
+            conn.execute(text("DROP TABLE activity_log_old"))
+            create_index(conn, "ix_activity_log_action", "activity_log", "action")
+            create_index(conn, "ix_activity_log_created_at", "activity_log", "created_at")
+            conn.commit()
+    return True
+
+
+# ======== Виконання ========
+def current_version(conn) -> int:
+    """Один SELECT; -1, якщо таблиці версій ще нема."""
+    try:
+        v = conn.execute(select(SchemaVersion.version).where(SchemaVersion.id == 1)).scalar()
+    except (OperationalError, ProgrammingError):
+        conn.rollback()
+        return -1
+    return int(v or 0)
+
+
+def _set_version(conn, version: int):
+    now = datetime.now(timezone.utc)
+    res = conn.execute(
+        update(SchemaVersion).where(SchemaVersion.id == 1).values(version=version, applied_at=now)
+    )
+    if not res.rowcount:
+        conn.execute(insert(SchemaVersion.__table__).values(id=1, version=version, applied_at=now))
+
+
+@contextmanager
+def _migration_lock(conn):
+    dialect = conn.dialect.name
+    if dialect == "postgresql":
+        # очікування лока й DDL на великих таблицях не обмежуємо DB_STATEMENT_TIMEOUT_MS
+        conn.execute(text("SET statement_timeout = 0"))
+        conn.execute(text("SELECT pg_advisory_lock(:k)"), {"k": MIGRATION_LOCK_KEY})
+        conn.commit()
+        try:
+            yield
+        finally:
+            conn.rollback()
+            conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": MIGRATION_LOCK_KEY})
+            conn.execute(text("RESET statement_timeout"))
+            conn.commit()
+        return
+    if dialect == "sqlite":
+        try:
+            import fcntl
+        except ImportError:  # Windows — SQLite і так серіалізує DDL
+            yield
+            return
+        path = conn.engine.url.database
+        if not path or path == ":memory:":
+            path = os.path.join(tempfile.gettempdir(), "amulet-migrate")
+        with open(path + ".migrate.lock", "w") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+        return
+    yield
+
+
+def upgrade(engine=None) -> list:
+    """Застосовує всі міграції новіші за поточну версію. Повертає список застосованих."""
+    engine = engine or db.engine
+    applied = []
+    with engine.connect() as conn:
+        with _migration_lock(conn):
+            SchemaVersion.__table__.create(conn, checkfirst=True)
+            conn.commit()
+            version = current_version(conn)
+            conn.commit()
+            for num, name, fn in MIGRATIONS:
+                if num <= version:
+                    continue
+                log.info("migrations: applying %d %s", num, name)
+                fn(conn)
+                _set_version(conn, num)
+                conn.commit()
+                applied.append((num, name))
+    return applied
+
+
+def ensure_current(engine=None) -> list:
+    """Швидкий шлях для старту воркера: один SELECT, міграції — лише якщо схема відстає."""
+    engine = engine or db.engine
+    with engine.connect() as conn:
+        if current_version(conn) >= latest_version():
+            return []
+    return upgrade(engine)
@@ -2,14 +2,47 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime, timezone
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import text
+from flask_sqlalchemy.session import Session
+
+
+class RoutingSession(Session):
+    """Сесія, що може віддати SELECT репліці (див. replica.py).
+
+    route_reads() повертає engine репліки для поточного запиту або None;
+    записи, flush і SELECT ... FOR UPDATE завжди йдуть на primary.
+    """
+    route_reads = None
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and RoutingSession.route_reads is not None and not self._flushing
+                and clause is not None and clause.is_select
+                and getattr(clause, "_for_update_arg", None) is None):
+            engine = RoutingSession.route_reads()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
 
 # імпортуйте з app: from models import db, License, ApiKey, Config, Price, ActivityLog
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+
+class SchemaVersion(db.Model):
+    """Версія схеми БД (єдиний рядок) — див. migrations.py."""
+    __tablename__ = "schema_version"
+
+    id = db.Column(db.Integer, primary_key=True)              # завжди 1
+    version = db.Column(db.Integer, nullable=False, default=0)
+    applied_at = db.Column(db.DateTime(timezone=True), nullable=True)
+
+    def __repr__(self):
+        return f"<SchemaVersion {self.version}>"
 
 
 class License(db.Model):
     __tablename__ = "license"
+    # id видаленої ліцензії не видається повторно: credit_ledger посилається на нього без FK
+    __table_args__ = {"sqlite_autoincrement": True}
 
     id = db.Column(db.Integer, primary_key=True)
     key = db.Column(db.String(100), unique=True, nullable=False, index=True)
@@ -29,8 +62,11 @@ class ApiKey(db.Model):
     api_key = db.Column(db.String(255), unique=True, nullable=False, index=True)
     status = db.Column(db.String(16), nullable=False, default="active", index=True)
     in_use = db.Column(db.Boolean, nullable=False, default=False)
-    last_used = db.Column(db.DateTime(timezone=True), nullable=True)
+    last_used = db.Column(db.DateTime(timezone=True), nullable=True, index=True)
     note = db.Column(db.Text, nullable=True)
+    # оренда ключа клієнтом: NULL у leased_until при in_use — ручне утримання адміном
+    lease_token = db.Column(db.String(64), nullable=True)
+    leased_until = db.Column(db.DateTime(timezone=True), nullable=True, index=True)
 
     def __repr__(self):
         return f"<ApiKey id={self.id} status={self.status} in_use={self.in_use}>"
@@ -50,7 +86,7 @@ class Config(db.Model):
         db.DateTime(timezone=True),
         nullable=False,
         default=lambda: datetime.now(timezone.utc),
-        server_default=text("now()"),
+        server_default=db.func.now(),
     )
 
     def __repr__(self):
@@ -67,13 +103,30 @@ class Price(db.Model):
         db.DateTime(timezone=True),
         nullable=False,
         default=lambda: datetime.now(timezone.utc),
-        server_default=text("now()"),
+        server_default=db.func.now(),
     )
 
     def __repr__(self):
         return f"<Price {self.model}={self.price}>"
 
 
+class CatalogVersion(db.Model):
+    """Лічильник версії каталогу (config + price) для кешів у воркерах."""
+    __tablename__ = "catalog_version"
+
+    id = db.Column(db.Integer, primary_key=True)              # завжди 1
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(
+        db.DateTime(timezone=True),
+        nullable=False,
+        default=lambda: datetime.now(timezone.utc),
+        server_default=db.func.now(),
+    )
+
+    def __repr__(self):
+        return f"<CatalogVersion {self.version}>"
+
+
 class ActivityLog(db.Model):
     __tablename__ = "activity_log"
 
@@ -84,9 +137,106 @@ class ActivityLog(db.Model):
         db.DateTime(timezone=True),
         nullable=False,
         default=lambda: datetime.now(timezone.utc),
-        server_default=text("now()"),
+        server_default=db.func.now(),
+        index=True,
+    )
+
+    def __repr__(self):
+        return f"<Log {self.id} {self.action}>"
+
+class IdempotencyKey(db.Model):
+    __tablename__ = "idempotency_key"
+    __table_args__ = (
+        db.UniqueConstraint("scope", "key", name="uq_idempotency_scope_key"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    scope = db.Column(db.String(32), nullable=False)
+    key = db.Column(db.String(128), nullable=False)
+    fingerprint = db.Column(db.String(16), nullable=False)
+    status_code = db.Column(db.Integer, nullable=True)        # NULL — запит ще виконується
+    response = db.Column(db.Text, nullable=True)
+    expires_at = db.Column(db.DateTime(timezone=True), nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<Idempotency {self.scope}:{self.key} status={self.status_code}>"
+
+
+class CreditLedger(db.Model):
+    """Append-only журнал змін кредиту (див. ledger.py).
+
+    amount — зі знаком (списання < 0), balance_after — License.credit після рядка.
+    kind: debit | adjust (адмінка) | daily (стиснені списання за день по моделі).
+    """
+    __tablename__ = "credit_ledger"
+    __table_args__ = (
+        db.Index("ix_credit_ledger_license_id_id", "license_id", "id"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    license_id = db.Column(db.Integer, nullable=False)        # без FK: історія переживає видалення ліцензії
+    kind = db.Column(db.String(16), nullable=False, default="debit")
+    model = db.Column(db.String(64), nullable=True)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    unit_price = db.Column(db.Integer, nullable=True)
+    amount = db.Column(db.Integer, nullable=False)
+    balance_after = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(
+        db.DateTime(timezone=True),
+        nullable=False,
+        default=lambda: datetime.now(timezone.utc),
+        server_default=db.func.now(),
         index=True,
     )
 
     def __repr__(self):
-        return f"<Log {self.id} {self.action}>"
\ No newline at end of file
+        return f"<Ledger {self.id} lic={self.license_id} {self.kind} {self.amount:+d}>"
+
+
+class StatRollup(db.Model):
+    """Попередньо агреговані лічильники для /admin_api/stats (див. rollups.py)."""
+    __tablename__ = "stat_rollup"
+    __table_args__ = (
+        db.UniqueConstraint("granularity", "bucket", "metric", "dim", name="uq_stat_rollup_bucket"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    granularity = db.Column(db.String(4), nullable=False)       # hour | day
+    bucket = db.Column(db.DateTime(timezone=True), nullable=False)
+    metric = db.Column(db.String(32), nullable=False)
+    dim = db.Column(db.String(64), nullable=False, default="")   # модель або ""
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<Rollup {self.granularity} {self.bucket} {self.metric}[{self.dim}]={self.value}>"
+
+
+class StatActive(db.Model):
+    """Які ліцензії вже пораховані активними у відкритому бакеті (для distinct-лічильника)."""
+    __tablename__ = "stat_active"
+    __table_args__ = (
+        db.UniqueConstraint("granularity", "bucket", "license_id", name="uq_stat_active_bucket"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    granularity = db.Column(db.String(4), nullable=False)
+    bucket = db.Column(db.DateTime(timezone=True), nullable=False, index=True)
+    license_id = db.Column(db.Integer, nullable=False)
+
+
+class StatWatermark(db.Model):
+    """Останній оброблений id джерела для rollup-задачі (та архіву логів, див. retention.py)."""
+    __tablename__ = "stat_watermark"
+
+    name = db.Column(db.String(32), primary_key=True)
+    last_id = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime(timezone=True), nullable=True)
+
+
+class RateBucket(db.Model):
+    """Спільний token bucket ліміту запитів (RATE_LIMIT_BACKEND=db, див. ratelimit.py)."""
+    __tablename__ = "rate_bucket"
+
+    key = db.Column(db.String(160), primary_key=True)     # endpoint:scope:значення
+    tokens = db.Column(db.Float, nullable=False)
+    updated = db.Column(db.Float, nullable=False, index=True)   # unix time останнього поповнення
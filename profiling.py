@@ -0,0 +1,177 @@
+# profiling.py
+# -*- coding: utf-8 -*-
+"""Опційне профілювання запитів (за замовчуванням вимкнено).
+
+PROFILE_SAMPLE_RATE=N    — кожен N-й запит під cProfile (1 = всі).
+PROFILE_SLOW_MS=T        — запити довші за T мс зберігаються з переліком SQL
+                           (cProfile-статистика є, якщо запит ще й семплований).
+PROFILE_QUERY_LIMIT=K    — запит з понад K SQL-запитами позначається (N+1)
+                           у лозі, в метриці та дампом.
+
+Дампи — JSON у PROFILE_DIR, не більше PROFILE_MAX_DUMPS (старі видаляються).
+Одночасно профілюється лише один запит на процес: cProfile вміє тільки так.
+"""
+import io
+import os
+import re
+import json
+import time
+import pstats
+import cProfile
+import logging
+import tempfile
+import itertools
+import threading
+
+from flask import request, g
+
+import metrics
+
+PROFILE_SAMPLE_RATE = int(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "0"))
+PROFILE_QUERY_LIMIT = int(os.getenv("PROFILE_QUERY_LIMIT", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "amulet-profiles"))
+PROFILE_MAX_DUMPS = int(os.getenv("PROFILE_MAX_DUMPS", "50"))
+PROFILE_TOP_FUNCS = 40
+PROFILE_SQL_MAX = 2000   # символів на один SQL у дампі
+PROFILE_QUERIES_MAX = 500
+
+DUMP_NAME_RE = re.compile(r"^[0-9]+-[0-9]+-[a-z]+-[A-Za-z0-9_.-]*\.json$")
+
+log = logging.getLogger(__name__)
+_seq = itertools.count(1)
+_profiler_lock = threading.Lock()
+_rotate_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return PROFILE_SAMPLE_RATE > 0 or PROFILE_SLOW_MS > 0 or PROFILE_QUERY_LIMIT > 0
+
+
+def _before_request():
+    g._p_start = time.perf_counter()
+    g._m_capture = []
+    if PROFILE_SAMPLE_RATE > 0 and next(_seq) % PROFILE_SAMPLE_RATE == 0 \
+            and _profiler_lock.acquire(blocking=False):
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            _profiler_lock.release()
+            return
+        g._p_profiler = prof
+
+
+def _stop_profiler():
+    prof = g.pop("_p_profiler", None)
+    if prof is None:
+        return None
+    prof.disable()
+    _profiler_lock.release()
+    return prof
+
+
+def _after_request(resp):
+    prof = _stop_profiler()
+    start = g.pop("_p_start", None)
+    if start is None:
+        return resp
+    elapsed_ms = (time.perf_counter() - start) * 1000.0
+    captured = g.pop("_m_capture", None) or []
+    route = request.url_rule.rule if request.url_rule else "<unmatched>"
+
+    reasons = []
+    if prof is not None:
+        reasons.append("sampled")
+    if PROFILE_SLOW_MS > 0 and elapsed_ms >= PROFILE_SLOW_MS:
+        reasons.append("slow")
+    if PROFILE_QUERY_LIMIT > 0 and len(captured) > PROFILE_QUERY_LIMIT:
+        reasons.append("queries")
+        metrics.inc("amulet_http_query_heavy_total", (("route", route),))
+        log.warning("%s %s issued %d queries (limit %d)", request.method, route, len(captured), PROFILE_QUERY_LIMIT)
+    if reasons:
+        try:
+            _write_dump(reasons, route, resp.status_code, elapsed_ms, captured, prof)
+        except OSError:
+            log.exception("profile dump failed")
+    return resp
+
+
+def _teardown(exc):
+    # якщо view впав і after_request не викликався — не тримаємо профайлер
+    if "_p_profiler" in g:
+        _stop_profiler()
+
+
+def _profile_text(prof) -> str:
+    buf = io.StringIO()
+    pstats.Stats(prof, stream=buf).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCS)
+    return buf.getvalue()
+
+
+def _write_dump(reasons, route, status, elapsed_ms, captured, prof):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", route).strip("_")[:60]
+    name = f"{int(time.time() * 1000)}-{os.getpid()}-{reasons[0]}-{slug}.json"
+    dump = {
+        "route": route,
+        "method": request.method,
+        "path": request.path,
+        "status": status,
+        "elapsed_ms": round(elapsed_ms, 3),
+        "reasons": reasons,
+        "query_count": len(captured),
+        "query_ms": round(sum(t for _, t in captured) * 1000.0, 3),
+        "queries": [
+            {"sql": sql[:PROFILE_SQL_MAX], "ms": round(t * 1000.0, 3)}
+            for sql, t in captured[:PROFILE_QUERIES_MAX]
+        ],
+        "profile": _profile_text(prof) if prof is not None else None,
+    }
+    path = os.path.join(PROFILE_DIR, name)
+    with open(path + ".tmp", "w") as fh:
+        json.dump(dump, fh)
+    os.replace(path + ".tmp", path)
+    _rotate()
+
+
+def _rotate():
+    with _rotate_lock:
+        names = sorted(n for n in os.listdir(PROFILE_DIR) if DUMP_NAME_RE.match(n))
+        for n in names[:max(0, len(names) - PROFILE_MAX_DUMPS)]:
+            try:
+                os.remove(os.path.join(PROFILE_DIR, n))
+            except OSError:
+                pass
+
+
+def list_dumps() -> list:
+    """Дампи від найновішого: імʼя, розмір, причина, маршрут."""
+    try:
+        names = os.listdir(PROFILE_DIR)
+    except OSError:
+        return []
+    out = []
+    for n in sorted((n for n in names if DUMP_NAME_RE.match(n)), reverse=True):
+        try:
+            st = os.stat(os.path.join(PROFILE_DIR, n))
+        except OSError:
+            continue
+        ts_ms, pid, reason, slug = n[:-5].split("-", 3)
+        out.append({
+            "name": n,
+            "size": st.st_size,
+            "created": int(ts_ms) / 1000.0,
+            "pid": int(pid),
+            "reason": reason,
+            "route": slug,
+        })
+    return out
+
+
+def init_app(app):
+    if not enabled():
+        return
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown)
@@ -0,0 +1,146 @@
+# queries.py
+# -*- coding: utf-8 -*-
+"""Фільтри та keyset-пагінація для адмінських списків (спільні для list/export/bulk)."""
+import os
+from datetime import datetime, timezone
+
+from sqlalchemy import select
+
+from models import db, License, ApiKey, ActivityLog
+
+ADMIN_PAGE_DEFAULT = int(os.getenv("ADMIN_PAGE_DEFAULT", "100"))
+ADMIN_PAGE_MAX = int(os.getenv("ADMIN_PAGE_MAX", "500"))
+BULK_IDS_MAX = int(os.getenv("BULK_IDS_MAX", "10000"))
+
+
+def _prefix(col, value: str):
+    """Префіксний пошук: межі [value, value з наступним останнім символом) обмежують
+    btree-скан і при не-C collation, LIKE — точність."""
+    conds = [col >= value, col.startswith(value, autoescape=True)]
+    if value and ord(value[-1]) < 0x10FFFF:
+        conds.append(col < value[:-1] + chr(ord(value[-1]) + 1))
+    return conds
+
+
+def _bool(value: str):
+    v = str(value).strip().lower()
+    if v in ("1", "true", "yes"):
+        return True
+    if v in ("0", "false", "no"):
+        return False
+    return None
+
+
+def parse_ts(value: str):
+    """ISO-дата/час із query-рядка; без зони — UTC. Некоректне значення -> None."""
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(str(value).strip().replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+def license_filters(args) -> list:
+    """status / mac (префікс) / q (префікс ключа) / active_before / active_after."""
+    cond = []
+    status = str(args.get("status", "")).strip().lower()
+    if status:
+        cond.append(License.status == status)
+    mac = str(args.get("mac", "")).strip().upper()
+    if mac:
+        cond += _prefix(License.mac_id, mac)
+    q = str(args.get("q", "")).strip()
+    if q:
+        cond += _prefix(License.key, q)
+    before = parse_ts(args.get("active_before"))
+    if before:
+        cond.append(License.last_active < before)
+    after = parse_ts(args.get("active_after"))
+    if after:
+        cond.append(License.last_active >= after)
+    return cond
+
+
+def apikey_filters(args) -> list:
+    """status / in_use / q (префікс ключа)."""
+    cond = []
+    status = str(args.get("status", "")).strip().lower()
+    if status:
+        cond.append(ApiKey.status == status)
+    in_use = _bool(args.get("in_use", ""))
+    if in_use is not None:
+        cond.append(ApiKey.in_use.is_(in_use))
+    q = str(args.get("q", "")).strip()
+    if q:
+        cond += _prefix(ApiKey.api_key, q)
+    return cond
+
+
+def log_filters(args) -> list:
+    """action / since / until (по індексу created_at)."""
+    cond = []
+    action = str(args.get("action", "")).strip()
+    if action:
+        cond.append(ActivityLog.action == action)
+    since = parse_ts(args.get("since"))
+    if since:
+        cond.append(ActivityLog.created_at >= since)
+    until = parse_ts(args.get("until"))
+    if until:
+        cond.append(ActivityLog.created_at < until)
+    return cond
+
+
+def page_params(args):
+    """(limit, cursor) з query-рядка; limit обмежений ADMIN_PAGE_MAX."""
+    try:
+        limit = int(args.get("limit", ADMIN_PAGE_DEFAULT))
+    except ValueError:
+        limit = ADMIN_PAGE_DEFAULT
+    limit = max(1, min(limit, ADMIN_PAGE_MAX))
+    try:
+        cursor = int(args.get("cursor", 0)) or None
+    except ValueError:
+        cursor = None
+    return limit, cursor
+
+
+def keyset_page(id_col, columns, conditions, args):
+    """Сторінка рядків за id DESC після cursor. Повертає (rows, next_cursor)."""
+    limit, cursor = page_params(args)
+    stmt = select(*columns).where(*conditions)
+    if cursor:
+        stmt = stmt.where(id_col < cursor)
+    rows = db.session.execute(stmt.order_by(id_col.desc()).limit(limit + 1)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1].id
+    return rows, next_cursor
+
+
+class SelectionError(ValueError):
+    """Некоректний вибір для масової операції (-> 400)."""
+
+
+def selection(model, body: dict, filters):
+    """Умови для масової операції: ids або filter. Порожній вибір -> None (не вся таблиця).
+
+    ids — лише список цілих не довший за BULK_IDS_MAX; інакше SelectionError,
+    а не обрізаний чи «посимвольний» вибір.
+    """
+    ids = body.get("ids")
+    if ids:
+        if not isinstance(ids, list) or not all(isinstance(x, int) and not isinstance(x, bool) for x in ids):
+            raise SelectionError("ids must be a list of integers")
+        if len(ids) > BULK_IDS_MAX:
+            raise SelectionError(f"too many ids (max {BULK_IDS_MAX}), use filter")
+        return [model.id.in_(ids)]
+    flt = body.get("filter")
+    if isinstance(flt, dict):
+        cond = filters(flt)
+        if cond or flt.get("all") is True:
+            return cond
+    return None
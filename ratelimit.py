@@ -0,0 +1,278 @@
+# ratelimit.py
+# -*- coding: utf-8 -*-
+"""Ліміт запитів клієнтських endpoint-ів: token bucket на ліцензію, MAC та IP.
+
+@limit("license_check") стоїть одразу під @app.post і відсікає зайві запити
+ще до Idempotency-Key та будь-якого SQL — 429 з Retry-After.
+Запит бере по токену з кошиків key:<ключ>, mac:<MAC>, ip:<IP> (які є в
+запиті); IP-кошик ширший у RATE_LIMIT_IP_FACTOR разів — за NAT буває багато клієнтів.
+
+RATE_LIMITS="license_check=1/10,license_debit=5/30" — токенів за секунду / місткість
+(rate 0 вимикає ліміт endpoint-а). Сховище кошиків (RATE_LIMIT_BACKEND):
+  memory — памʼять воркера (LRU), без I/O; ліміт фактично × кількість воркерів;
+  db     — таблиця rate_bucket в основній БД, один атомарний UPSERT на кошик;
+  local  — окремий файл SQLite (RATE_LIMIT_STORE), спільний для воркерів хоста:
+           локальна заміна Redis-подібного сховища без навантаження на основну БД.
+Якщо спільне сховище недоступне, запит пропускається (ліміт не валить API).
+"""
+import os
+import math
+import time
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request, jsonify
+from sqlalchemy import create_engine, event, select, delete, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import SQLAlchemyError
+
+import activity
+import metrics
+from models import db, RateBucket
+
+RATE_LIMIT = os.getenv("RATE_LIMIT", "1") == "1"
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")          # memory | db | local
+RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", os.path.join(tempfile.gettempdir(), "amulet-ratelimit.db"))
+RATE_LIMIT_IP_FACTOR = float(os.getenv("RATE_LIMIT_IP_FACTOR", "5"))
+# скільки довірених проксі стоїть перед застосунком (роутер хостингу дописує X-Forwarded-For)
+RATE_LIMIT_PROXIES = int(os.getenv("RATE_LIMIT_PROXIES", "1"))
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))   # кошиків у памʼяті воркера
+RATE_LIMIT_SWEEP_INTERVAL = float(os.getenv("RATE_LIMIT_SWEEP_INTERVAL", "600"))   # сек
+RATE_LIMIT_TOP = 20
+RATE_LIMIT_TRACKED = 1000   # скільки джерел відмов памʼятає воркер для топу
+
+# endpoint -> (токенів за секунду, місткість кошика)
+DEFAULT_LIMITS = {
+    "license_check": (1.0, 10),
+    "license_debit": (5.0, 30),
+    "license_debit_batch": (2.0, 10),
+    "client_bootstrap": (0.2, 5),
+    "next_api_key": (1.0, 10),
+}
+
+log = logging.getLogger(__name__)
+
+
+def parse_limits(spec: str) -> dict:
+    """DEFAULT_LIMITS, перекриті записами "endpoint=rate/burst" через кому."""
+    out = dict(DEFAULT_LIMITS)
+    for part in spec.split(","):
+        name, _, value = part.strip().partition("=")
+        if not name or not value:
+            continue
+        rate, _, burst = value.partition("/")
+        try:
+            rate = float(rate)
+            burst = float(burst) if burst else max(1.0, rate)
+        except ValueError:
+            log.warning("ratelimit: bad RATE_LIMITS entry %r", part)
+            continue
+        out[name] = (rate, burst)
+    return out
+
+
+LIMITS = parse_limits(os.getenv("RATE_LIMITS", ""))
+
+
+class _MemoryBuckets:
+    """Кошики воркера: key -> [tokens, ts]. Токени беруться з усіх кошиків або з жодного."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, items) -> list:
+        """items: [(key, rate, burst)]. Повертає [(key, секунд до токена)] для порожніх кошиків."""
+        now = time.monotonic()
+        with self._lock:
+            level, empty = [], []
+            for key, rate, burst in items:
+                b = self._data.get(key)
+                tokens = burst if b is None else min(burst, b[0] + (now - b[1]) * rate)
+                if tokens < 1:
+                    empty.append((key, (1 - tokens) / rate))
+                level.append((key, tokens))
+            if empty:
+                return empty
+            for key, tokens in level:
+                self._data[key] = [tokens - 1, now]
+                self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return []
+
+    def sweep(self):
+        pass
+
+
+class _SqlBuckets:
+    """Кошики в таблиці rate_bucket: поповнення й списання — один UPSERT ... WHERE на кошик.
+
+    Кошики перевіряються по черзі, тож при відмові з одного токени з
+    попередніх уже взято — для захисту від зациклених клієнтів це не шкодить.
+    """
+
+    def __init__(self, engine=None):
+        self.engine = engine   # None — основна БД (db.engine)
+
+    def _engine(self):
+        return self.engine if self.engine is not None else db.engine
+
+    def take(self, items) -> list:
+        engine = self._engine()
+        t = RateBucket.__table__
+        pg = engine.dialect.name == "postgresql"
+        least = func.least if pg else func.min
+        now = time.time()
+        empty = []
+        with engine.begin() as conn:
+            for key, rate, burst in items:
+                ins = (pg_insert if pg else sqlite_insert)(t).values(key=key, tokens=burst - 1, updated=now)
+                refilled = least(burst, t.c.tokens + (now - t.c.updated) * rate)
+                stmt = ins.on_conflict_do_update(
+                    index_elements=[t.c.key],
+                    set_={"tokens": refilled - 1, "updated": now},
+                    where=refilled >= 1,
+                ).returning(t.c.tokens)
+                if conn.execute(stmt).first() is not None:
+                    continue
+                row = conn.execute(select(t.c.tokens, t.c.updated).where(t.c.key == key)).first()
+                have = min(burst, row.tokens + (now - row.updated) * rate) if row else 0.0
+                empty.append((key, max(0.0, 1 - have) / rate))
+        return empty
+
+    def sweep(self):
+        """Видаляє кошики, що встигли наповнитися до краю: вони рівні відсутнім."""
+        full_after = max((b / r for r, b in LIMITS.values() if r > 0), default=0)
+        with self._engine().begin() as conn:
+            conn.execute(delete(RateBucket).where(RateBucket.updated < time.time() - full_after))
+
+
+def _local_engine(path: str):
+    engine = create_engine(f"sqlite:///{path}", connect_args={"timeout": 5})
+
+    @event.listens_for(engine, "connect")
+    def _wal(dbapi_conn, _):
+        # кілька воркерів пишуть одночасно — WAL замість блокування всього файлу
+        dbapi_conn.execute("PRAGMA journal_mode=WAL")
+        dbapi_conn.execute("PRAGMA synchronous=OFF")
+
+    RateBucket.__table__.create(engine, checkfirst=True)
+    return engine
+
+
+_backend = _MemoryBuckets(RATE_LIMIT_MAX_KEYS)
+
+_stats_lock = threading.Lock()
+_stats = {}                   # endpoint -> {"allowed": n, "rejected": n}
+_offenders = OrderedDict()    # "scope:значення" -> відмов у цьому воркері
+_errors = {"backend": 0}
+
+
+def client_ip() -> str:
+    """IP клієнта: RATE_LIMIT_PROXIES-та адреса з кінця X-Forwarded-For (її дописав наш проксі)."""
+    if RATE_LIMIT_PROXIES > 0:
+        hops = [h.strip() for h in request.headers.get("X-Forwarded-For", "").split(",") if h.strip()]
+        if len(hops) >= RATE_LIMIT_PROXIES:
+            return hops[-RATE_LIMIT_PROXIES]
+    return request.remote_addr or ""
+
+
+def _buckets(endpoint: str, rate: float, burst: float) -> list:
+    j = request.get_json(silent=True)
+    j = j if isinstance(j, dict) else {}
+    out = []
+    key = str(j.get("key", "")).strip()
+    if key:
+        out.append((f"{endpoint}:key:{key[:100]}", rate, burst))
+    mac = str(j.get("mac", "")).strip().upper()
+    if mac:
+        out.append((f"{endpoint}:mac:{mac[:32]}", rate, burst))
+    ip = client_ip()
+    if ip:
+        out.append((f"{endpoint}:ip:{ip[:45]}", rate * RATE_LIMIT_IP_FACTOR, burst * RATE_LIMIT_IP_FACTOR))
+    return out
+
+
+def _count(endpoint: str, empty: list):
+    with _stats_lock:
+        st = _stats.setdefault(endpoint, {"allowed": 0, "rejected": 0})
+        if not empty:
+            st["allowed"] += 1
+            return
+        st["rejected"] += 1
+        for bucket, _ in empty:
+            _, scope, value = bucket.split(":", 2)
+            src = f"{scope}:{activity.mask(value) if scope == 'key' else value}"
+            _offenders[src] = _offenders.pop(src, 0) + 1
+            while len(_offenders) > RATE_LIMIT_TRACKED:
+                _offenders.popitem(last=False)
+    for bucket, _ in empty:
+        metrics.inc("amulet_rate_limited_total", (("endpoint", endpoint), ("scope", bucket.split(":", 2)[1])))
+
+
+def limit(endpoint: str):
+    """Token bucket для endpoint-а за ключем, MAC та IP; порожній кошик -> 429 з Retry-After."""
+    def deco(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            rate, burst = LIMITS.get(endpoint, (0.0, 0.0))
+            if not RATE_LIMIT or rate <= 0:
+                return view(*args, **kwargs)
+            items = _buckets(endpoint, rate, burst)
+            try:
+                empty = _backend.take(items) if items else []
+            except SQLAlchemyError:
+                with _stats_lock:
+                    _errors["backend"] += 1
+                log.warning("ratelimit: %s backend failed, request let through", RATE_LIMIT_BACKEND, exc_info=True)
+                empty = []
+            _count(endpoint, empty)
+            if not empty:
+                return view(*args, **kwargs)
+            retry = max(1, math.ceil(max(w for _, w in empty)))
+            resp = jsonify(ok=False, msg="Too many requests", retry_after=retry)
+            resp.status_code = 429
+            resp.headers["Retry-After"] = str(retry)
+            return resp
+        return wrapper
+    return deco
+
+
+def sweep():
+    _backend.sweep()
+
+
+def status() -> dict:
+    """Налаштування, лічильники цього воркера та відмови всіх воркерів (з /metrics)."""
+    with _stats_lock:
+        stats = {k: dict(v) for k, v in _stats.items()}
+        top = sorted(_offenders.items(), key=lambda kv: kv[1], reverse=True)[:RATE_LIMIT_TOP]
+        errors = dict(_errors)
+    return {
+        "enabled": RATE_LIMIT,
+        "backend": RATE_LIMIT_BACKEND,
+        "limits": {k: {"rate": r, "burst": b} for k, (r, b) in LIMITS.items()},
+        "ip_factor": RATE_LIMIT_IP_FACTOR,
+        "proxies": RATE_LIMIT_PROXIES,
+        "pid": os.getpid(),
+        "worker": stats,
+        "worker_errors": errors,
+        "top_rejected": [{"source": s, "rejected": n} for s, n in top],
+        "rejected_total": metrics.counter_totals("amulet_rate_limited_total"),
+    }
+
+
+def init_app(app):
+    global _backend
+    if RATE_LIMIT_BACKEND == "db":
+        _backend = _SqlBuckets()
+    elif RATE_LIMIT_BACKEND == "local":
+        _backend = _SqlBuckets(_local_engine(RATE_LIMIT_STORE))
+    elif RATE_LIMIT_BACKEND != "memory":
+        log.warning("ratelimit: unknown RATE_LIMIT_BACKEND=%r, using memory", RATE_LIMIT_BACKEND)
@@ -0,0 +1,144 @@
+# replica.py
+# -*- coding: utf-8 -*-
+"""Опційна репліка для читання (REPLICA_DATABASE_URL).
+
+Маршрути з @read_only віддають свої SELECT-и репліці (RoutingSession у
+models.py); усе інше, а також записи й SELECT ... FOR UPDATE, йде на primary.
+Стан репліки перевіряється не частіше ніж раз на REPLICA_CHECK_INTERVAL:
+  - недоступна (помилка зʼєднання)                   -> читаємо з primary;
+  - лаг реплікації > REPLICA_MAX_LAG секунд (PostgreSQL) -> primary;
+  - catalog_version на репліці менша, ніж на primary  -> primary
+    (так само працює і для двох файлів SQLite без реплікації).
+Якщо репліка впала посеред запиту, read-only view повторюється на primary.
+"""
+import os
+import time
+import logging
+import threading
+from functools import wraps
+
+from flask import g, has_request_context
+from sqlalchemy import select, text
+from sqlalchemy.exc import DBAPIError
+
+import dbpool
+import metrics
+from models import db, RoutingSession, CatalogVersion
+
+REPLICA_DATABASE_URL = os.getenv("REPLICA_DATABASE_URL", "")
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "5"))             # сек
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", "5"))
+REPLICA_BIND = "replica"
+
+PG_LAG_SQL = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0"
+    " WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0"
+    " ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+log = logging.getLogger(__name__)
+_probe_lock = threading.Lock()
+_state = {"healthy": False, "lag": None, "replica_version": None, "primary_version": None,
+          "checked": 0.0, "error": None}
+
+
+def enabled() -> bool:
+    return bool(REPLICA_DATABASE_URL)
+
+
+def bind_config() -> dict:
+    """SQLALCHEMY_BINDS: репліка з тими ж налаштуваннями пулу, що й primary."""
+    if not enabled():
+        return {}
+    return {REPLICA_BIND: {"url": REPLICA_DATABASE_URL, **dbpool.engine_options(REPLICA_DATABASE_URL)}}
+
+
+def _catalog_version(conn) -> int:
+    return int(conn.execute(select(CatalogVersion.version).where(CatalogVersion.id == 1)).scalar() or 0)
+
+
+def _probe():
+    with db.engines[REPLICA_BIND].connect() as conn:
+        lag = float(conn.execute(PG_LAG_SQL).scalar() or 0) if conn.dialect.name == "postgresql" else 0.0
+        replica_version = _catalog_version(conn)
+    with db.engine.connect() as conn:
+        primary_version = _catalog_version(conn)
+    return lag, replica_version, primary_version
+
+
+def _set_state(healthy: bool, **fields):
+    if healthy != _state["healthy"]:
+        log.warning("replica: %s (%s)", "in use" if healthy else "bypassed, reading from primary",
+                    fields.get("error") or f"lag={fields.get('lag')}")
+    _state.update(fields, healthy=healthy, checked=time.monotonic())
+
+
+def check(force: bool = False):
+    """Оновлює стан репліки, якщо минув інтервал (один потік пробує, інші беруть останній стан)."""
+    if not force and time.monotonic() - _state["checked"] < REPLICA_CHECK_INTERVAL:
+        return
+    if not _probe_lock.acquire(blocking=False):
+        return
+    try:
+        try:
+            lag, rv, pv = _probe()
+        except Exception as e:
+            _set_state(False, error=str(e).splitlines()[0][:200], lag=None)
+            return
+        healthy = lag <= REPLICA_MAX_LAG and rv >= pv
+        _set_state(healthy, lag=round(lag, 3), replica_version=rv, primary_version=pv,
+                   error=None if healthy else ("lagging" if lag > REPLICA_MAX_LAG else "catalog behind"))
+    finally:
+        _probe_lock.release()
+
+
+def _route_reads():
+    if not has_request_context():
+        return None
+    return g.get("_replica_engine")
+
+
+def read_only(view):
+    """Дозволяє маршруту читати з репліки (лише SELECT; повтор на primary при збої репліки)."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not enabled():
+            return view(*args, **kwargs)
+        check()
+        engine = db.engines[REPLICA_BIND] if _state["healthy"] else None
+        g._replica_engine = engine
+        metrics.inc("amulet_db_replica_reads_total", (("db", "replica" if engine is not None else "primary"),))
+        if engine is None:
+            return view(*args, **kwargs)
+        try:
+            return view(*args, **kwargs)
+        except DBAPIError as e:
+            # view лише читає, тож повтор на primary безпечний
+            db.session.rollback()
+            _set_state(False, error=str(e).splitlines()[0][:200], lag=None)
+            g._replica_engine = None
+            metrics.inc("amulet_db_replica_reads_total", (("db", "fallback"),))
+            return view(*args, **kwargs)
+    return wrapper
+
+
+def status() -> dict:
+    out = {"enabled": enabled(), "max_lag": REPLICA_MAX_LAG, "check_interval": REPLICA_CHECK_INTERVAL}
+    if enabled():
+        out.update({k: v for k, v in _state.items() if k != "checked"})
+        out["checked_ago"] = round(time.monotonic() - _state["checked"], 3) if _state["checked"] else None
+    return out
+
+
+def init_app(app):
+    if not enabled():
+        return
+    RoutingSession.route_reads = _route_reads
+    metrics.instrument_engine(db.engines[REPLICA_BIND])
+
+    @metrics.gauge_source
+    def _replica_gauges():
+        out = [("amulet_db_replica_healthy", (), 1.0 if _state["healthy"] else 0.0)]
+        if _state["lag"] is not None:
+            out.append(("amulet_db_replica_lag_seconds", (), float(_state["lag"])))
+        return out
@@ -0,0 +1,297 @@
+# retention.py
+# -*- coding: utf-8 -*-
+"""Ретеншн activity_log: обмеження за віком і кількістю рядків + стиснутий архів.
+
+Фонова задача прибирає старі рядки пакетами по діапазону id (LOG_PURGE_BATCH),
+кожен пакет — коротка транзакція, тож таблиця не блокується на хвилини.
+Межа id, до якої можна прибирати:
+  - вік: перший рядок з created_at >= now - LOG_RETENTION_DAYS (індекс created_at);
+  - кількість: max(id) - LOG_MAX_ROWS (прогалини в id лише зменшують залишок);
+  - не далі водяного знаку rollups "activity": непораховане в статистику не чіпаємо.
+Перед видаленням пакет пишеться в сегмент LOG_ARCHIVE_DIR/
+activity-<id від>-<id до>-<час від>-<час до>.ndjson.gz (gzip, рядок = подія);
+/admin_api/logs?archive=1 гортає сегменти тим самим keyset-курсором, що й таблицю.
+Прогрес — водяний знак "activity_purge" у stat_watermark (CAS, як у rollups),
+тож кілька воркерів не архівують той самий пакет.
+
+PostgreSQL із секціонуванням (flask --app app logs-partition): пакети лише
+архівуються, а завершені місячні секції, повністю заархівовані, видаляються
+DROP TABLE — миттєво і без роздутої таблиці після DELETE.
+"""
+import os
+import re
+import gzip
+import json
+import logging
+from datetime import datetime, timezone, timedelta
+
+from sqlalchemy import select, delete, func, text
+
+from models import db, ActivityLog
+import dbutil
+import migrations
+import queries
+
+LOG_RETENTION_DAYS = int(os.getenv("LOG_RETENTION_DAYS", "90"))        # 0 = без обмеження за віком
+LOG_MAX_ROWS = int(os.getenv("LOG_MAX_ROWS", "2000000"))              # 0 = без обмеження кількості
+LOG_PURGE_INTERVAL = float(os.getenv("LOG_PURGE_INTERVAL", "300"))     # сек
+LOG_PURGE_BATCH = int(os.getenv("LOG_PURGE_BATCH", "5000"))
+LOG_PURGE_MAX_BATCHES = int(os.getenv("LOG_PURGE_MAX_BATCHES", "20"))  # пакетів за прохід
+LOG_ARCHIVE = os.getenv("LOG_ARCHIVE", "1") == "1"                      # 0 = видаляти без архіву
+LOG_ARCHIVE_DIR = os.getenv(
+    "LOG_ARCHIVE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "instance", "log-archive")
+)
+LOG_PARTITION_AHEAD = int(os.getenv("LOG_PARTITION_AHEAD", "2"))       # місяців наперед
+
+WATERMARK = "activity_purge"
+ROLLUP_WATERMARK = "activity"   # джерело activity у rollups.SOURCES
+SEGMENT_RE = re.compile(r"^activity-(\d{12})-(\d{12})-(\d{14})-(\d{14})\.ndjson\.gz$")
+PARTITION_RE = re.compile(r"^activity_log_p(\d{6})$")
+TS_FMT = "%Y%m%d%H%M%S"
+
+log = logging.getLogger(__name__)
+
+
+def enabled() -> bool:
+    return LOG_RETENTION_DAYS > 0 or LOG_MAX_ROWS > 0
+
+
+def _boundary() -> int:
+    """Найбільший id, який уже можна прибрати (0 — нічого)."""
+    top = db.session.execute(select(func.max(ActivityLog.id))).scalar() or 0
+    bound = 0
+    if LOG_RETENTION_DAYS > 0:
+        cutoff = datetime.now(timezone.utc) - timedelta(days=LOG_RETENTION_DAYS)
+        first_kept = db.session.execute(
+            select(ActivityLog.id).where(ActivityLog.created_at >= cutoff)
+            .order_by(ActivityLog.created_at).limit(1)
+        ).scalar()
+        bound = top if first_kept is None else first_kept - 1
+    if LOG_MAX_ROWS > 0:
+        bound = max(bound, top - LOG_MAX_ROWS)
+    return max(0, min(bound, dbutil.watermark(ROLLUP_WATERMARK)))
+
+
+# ---- Сегменти архіву
+def _row_dict(r) -> dict:
+    return {
+        "id": r.id,
+        "action": r.action,
+        "details": r.details,
+        "created_at": dbutil.aware(r.created_at).isoformat() if r.created_at else None,
+    }
+
+
+def _write_segment(rows) -> str:
+    """Атомарно пише сегмент і fsync-ить його до того, як рядки зникнуть із БД."""
+    os.makedirs(LOG_ARCHIVE_DIR, exist_ok=True)
+    times = [dbutil.aware(r.created_at) for r in rows]
+    name = "activity-%012d-%012d-%s-%s.ndjson.gz" % (
+        rows[0].id, rows[-1].id, min(times).strftime(TS_FMT), max(times).strftime(TS_FMT),
+    )
+    path = os.path.join(LOG_ARCHIVE_DIR, name)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as raw:
+        with gzip.GzipFile(filename=name[:-3], fileobj=raw, mode="wb") as gz:
+            for r in rows:
+                gz.write((json.dumps(_row_dict(r), ensure_ascii=False) + "\n").encode("utf-8"))
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp, path)
+    return name
+
+
+def list_segments() -> list:
+    """Сегменти від найновішого (за id): імʼя, діапазон id і часу, розмір."""
+    try:
+        names = os.listdir(LOG_ARCHIVE_DIR)
+    except OSError:
+        return []
+    out = []
+    for n in names:
+        m = SEGMENT_RE.match(n)
+        if not m:
+            continue
+        try:
+            size = os.path.getsize(os.path.join(LOG_ARCHIVE_DIR, n))
+        except OSError:
+            continue
+        out.append({
+            "name": n,
+            "first_id": int(m.group(1)),
+            "last_id": int(m.group(2)),
+            "since": datetime.strptime(m.group(3), TS_FMT).replace(tzinfo=timezone.utc),
+            "until": datetime.strptime(m.group(4), TS_FMT).replace(tzinfo=timezone.utc),
+            "size": size,
+        })
+    out.sort(key=lambda s: (s["last_id"], s["first_id"]), reverse=True)
+    return out
+
+
+def _load_segment(name: str) -> list:
+    with gzip.open(os.path.join(LOG_ARCHIVE_DIR, name), "rt", encoding="utf-8") as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+
+def read_archive(args):
+    """Сторінка заархівованих подій (id DESC після cursor) з фільтрами action / since / until.
+
+    Повертає (items, next_cursor) у форматі /admin_api/logs. Сегменти поза
+    діапазоном часу пропускаються за імʼям; перекриті (повторний архів після
+    збою) дедуплікуються, бо id віддаються строго спадно.
+    """
+    limit, cursor = queries.page_params(args)
+    action = str(args.get("action", "")).strip()
+    since = queries.parse_ts(args.get("since"))
+    until = queries.parse_ts(args.get("until"))
+    out = []
+    last = cursor or None
+    for seg in list_segments():
+        if last is not None and seg["first_id"] >= last:
+            continue
+        # у назві час обрізаний до секунди
+        if since and seg["until"] + timedelta(seconds=1) <= since:
+            continue
+        if until and seg["since"] >= until:
+            continue
+        for row in reversed(_load_segment(seg["name"])):
+            if last is not None and row["id"] >= last:
+                continue
+            if action and row["action"] != action:
+                continue
+            if since or until:
+                ts = queries.parse_ts(row["created_at"])
+                if ts is None or (since and ts < since) or (until and ts >= until):
+                    continue
+            out.append(row)
+            last = row["id"]
+            if len(out) > limit:
+                break
+        if len(out) > limit:
+            break
+    next_cursor = None
+    if len(out) > limit:
+        out = out[:limit]
+        next_cursor = out[-1]["id"]
+    return out, next_cursor
+
+
+# ---- Прибирання
+def _step(bound: int, drop_rows: bool) -> int:
+    old = dbutil.watermark(WATERMARK)
+    if old >= bound:
+        db.session.rollback()
+        return 0
+    rows = db.session.execute(
+        select(ActivityLog.id, ActivityLog.action, ActivityLog.details, ActivityLog.created_at)
+        .where(ActivityLog.id > old, ActivityLog.id <= bound)
+        .order_by(ActivityLog.id)
+        .limit(LOG_PURGE_BATCH)
+    ).all()
+    if not rows:
+        db.session.rollback()
+        return 0
+    last = rows[-1].id
+    try:
+        if not dbutil.advance_watermark(WATERMARK, old, last):
+            db.session.rollback()
+            return 0
+        if LOG_ARCHIVE:
+            _write_segment(rows)
+        if drop_rows:
+            # межа не новіша за водяний знак rollups (вже «осілі» рядки), тож у
+            # діапазоні (old, last] немає подій, яких не було в SELECT вище
+            db.session.execute(
+                delete(ActivityLog).where(ActivityLog.id > old, ActivityLog.id <= last)
+                .execution_options(synchronize_session=False)
+            )
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return len(rows)
+
+
+def partitioned() -> bool:
+    if db.engine.dialect.name != "postgresql":
+        return False
+    return db.session.execute(text(migrations.PG_IS_PARTITIONED_SQL)).first() is not None
+
+
+def _month_start(dt: datetime) -> datetime:
+    return dt.astimezone(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _drop_partitions(archived: int) -> list:
+    """DROP завершених місячних секцій, усі рядки яких уже в архіві (id <= archived)."""
+    current = _month_start(datetime.now(timezone.utc))
+    names = db.session.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid"
+        " WHERE i.inhparent = 'activity_log'::regclass"
+    )).scalars().all()
+    dropped = []
+    for name in sorted(names):
+        m = PARTITION_RE.match(name)
+        if not m:
+            continue   # activity_log_default
+        start = datetime.strptime(m.group(1), "%Y%m").replace(tzinfo=timezone.utc)
+        if migrations.next_month(start) > current:
+            break
+        top = db.session.execute(text(f'SELECT max(id) FROM "{name}"')).scalar()
+        if top is not None and top > archived:
+            break
+        db.session.execute(text(f'DROP TABLE IF EXISTS "{name}"'))
+        db.session.commit()
+        dropped.append(name)
+    db.session.rollback()
+    return dropped
+
+
+def run() -> int:
+    """Фонова задача: архівує й прибирає до LOG_PURGE_MAX_BATCHES пакетів за прохід."""
+    if not enabled():
+        return 0
+    part = partitioned()
+    bound = _boundary()
+    db.session.rollback()
+    total = 0
+    for _ in range(LOG_PURGE_MAX_BATCHES):
+        n = _step(bound, drop_rows=not part)
+        total += n
+        if n < LOG_PURGE_BATCH:
+            break
+    if part:
+        dropped = _drop_partitions(dbutil.watermark(WATERMARK))
+        if dropped:
+            log.info("retention: dropped partitions %s", ", ".join(dropped))
+        now = datetime.now(timezone.utc)
+        end = _month_start(now)
+        for _ in range(LOG_PARTITION_AHEAD + 1):
+            end = migrations.next_month(end)
+        migrations.ensure_activity_partitions(db.session, now, end)
+        db.session.commit()
+    if total:
+        log.info("retention: %s %d activity rows", "archived" if part else "purged", total)
+    return total
+
+
+def status() -> dict:
+    segments = list_segments()
+    out = {
+        "enabled": enabled(),
+        "retention_days": LOG_RETENTION_DAYS,
+        "max_rows": LOG_MAX_ROWS,
+        "archive": LOG_ARCHIVE,
+        "partitioned": partitioned(),
+        "archived_up_to": dbutil.watermark(WATERMARK),
+        "rollup_watermark": dbutil.watermark(ROLLUP_WATERMARK),
+        # min/max id замість count(*): не скануємо всю таблицю
+        "min_id": db.session.execute(select(func.min(ActivityLog.id))).scalar(),
+        "max_id": db.session.execute(select(func.max(ActivityLog.id))).scalar(),
+        "segments": len(segments),
+        "archive_bytes": sum(s["size"] for s in segments),
+    }
+    if segments:
+        out["archive_since"] = min(s["since"] for s in segments).isoformat()
+        out["archive_until"] = max(s["until"] for s in segments).isoformat()
+    return out
@@ -0,0 +1,279 @@
+# rollups.py
+# -*- coding: utf-8 -*-
+"""Погодинні / денні зведення для адмін-аналітики (/admin_api/stats).
+
+Фонова задача читає лише нові рядки з моменту водяного знаку (stat_watermark):
+  - credit_ledger (списання)  -> debits / debit_units / credits_spent по моделях;
+  - activity_log              -> checks, active_licenses (distinct), leases,
+                                 lease_empty, releases;
+  - поточний стан пулу ключів -> pool_leased / pool_total (пік за бакет).
+Рядки, молодші за ROLLUP_SETTLE_SECONDS, ще не беремо: activity пишеться
+асинхронно, і id може «обігнати» ще не записані події.
+Кожен пакет — одна транзакція з CAS водяного знаку, тож кілька воркерів не
+порахують той самий пакет двічі. /admin_api/stats читає лише готові бакети.
+"""
+import os
+import json
+import logging
+from datetime import datetime, timezone, timedelta
+
+from sqlalchemy import select, insert, delete, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+
+from models import db, ActivityLog, CreditLedger, StatRollup, StatActive, StatWatermark
+import dbutil
+import leases
+
+ROLLUP_INTERVAL = float(os.getenv("ROLLUP_INTERVAL", "60"))                 # сек
+ROLLUP_BATCH_SIZE = int(os.getenv("ROLLUP_BATCH_SIZE", "5000"))
+ROLLUP_MAX_BATCHES = int(os.getenv("ROLLUP_MAX_BATCHES", "20"))             # пакетів за прохід
+ROLLUP_SETTLE_SECONDS = int(os.getenv("ROLLUP_SETTLE_SECONDS", "120"))
+ROLLUP_HOURLY_KEEP_DAYS = int(os.getenv("ROLLUP_HOURLY_KEEP_DAYS", "35"))
+ROLLUP_IN_CHUNK = 500
+
+GRANULARITIES = ("hour", "day")
+# метрики, що не сумуються за діапазон (distinct / пік)
+NON_ADDITIVE = ("active_licenses", "pool_leased", "pool_total")
+PEAK_METRICS = ("pool_leased", "pool_total")
+ACTIVITY_ACTIONS = ("license_check", "license_debit", "apikey_lease", "apikey_release")
+STATS_MAX_BUCKETS = {"hour": 24 * 14, "day": 400}
+
+log = logging.getLogger(__name__)
+
+
+def floor(dt: datetime, granularity: str) -> datetime:
+    dt = dbutil.aware(dt).astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    return dt.replace(hour=0) if granularity == "day" else dt
+
+
+class _Batch:
+    """Накопичувач одного пакета: лічильники та distinct-ліцензії по бакетах."""
+
+    def __init__(self):
+        self.counters = {}
+        self.active = {}
+
+    def add(self, ts, metric: str, value: int = 1, dim: str = ""):
+        for gran in GRANULARITIES:
+            k = (gran, floor(ts, gran), metric, dim)
+            self.counters[k] = self.counters.get(k, 0) + value
+
+    def seen(self, ts, license_id: int):
+        for gran in GRANULARITIES:
+            self.active.setdefault((gran, floor(ts, gran)), set()).add(license_id)
+
+
+# ---- Джерела: (рядки, новий водяний знак) або ([], None), якщо нового нема
+def _ledger_rows(after_id: int, settled: datetime):
+    rows = db.session.execute(
+        select(CreditLedger.id, CreditLedger.kind, CreditLedger.model, CreditLedger.units,
+               CreditLedger.amount, CreditLedger.created_at)
+        .where(CreditLedger.id > after_id)
+        .order_by(CreditLedger.id)
+        .limit(ROLLUP_BATCH_SIZE)
+    ).all()
+    return _settled_prefix(rows, settled)
+
+
+def _activity_rows(after_id: int, settled: datetime):
+    rows = db.session.execute(
+        select(ActivityLog.id, ActivityLog.action, ActivityLog.details, ActivityLog.created_at)
+        .where(ActivityLog.id > after_id, ActivityLog.action.in_(ACTIVITY_ACTIONS))
+        .order_by(ActivityLog.id)
+        .limit(ROLLUP_BATCH_SIZE)
+    ).all()
+    return _settled_prefix(rows, settled)
+
+
+def _settled_prefix(rows, settled: datetime):
+    out = []
+    for r in rows:
+        if dbutil.aware(r.created_at) >= settled:
+            break
+        out.append(r)
+    return out, (out[-1].id if out else None)
+
+
+def _fold_ledger(batch: _Batch, rows):
+    for r in rows:
+        if r.kind not in ("debit", "daily"):
+            continue
+        model = (r.model or "")[:64]
+        batch.add(r.created_at, "debits", 1, model)
+        batch.add(r.created_at, "debit_units", int(r.units or 0), model)
+        batch.add(r.created_at, "credits_spent", -int(r.amount or 0), model)
+
+
+def _fold_activity(batch: _Batch, rows):
+    for r in rows:
+        try:
+            d = json.loads(r.details) if r.details else {}
+        except ValueError:
+            d = {}
+        if r.action == "license_check":
+            batch.add(r.created_at, "checks")
+            if d.get("result") == "ok" and isinstance(d.get("license_id"), int):
+                batch.seen(r.created_at, d["license_id"])
+        elif r.action == "license_debit":
+            if isinstance(d.get("license_id"), int):
+                batch.seen(r.created_at, d["license_id"])
+        elif r.action == "apikey_lease":
+            batch.add(r.created_at, "leases" if d.get("result") == "ok" else "lease_empty")
+        elif r.action == "apikey_release":
+            batch.add(r.created_at, "releases")
+
+
+SOURCES = {
+    "ledger": (_ledger_rows, _fold_ledger),
+    "activity": (_activity_rows, _fold_activity),
+}
+
+
+# ---- Запис
+def _upsert(rows: list, peak: bool = False):
+    """rows: dict(granularity, bucket, metric, dim, value). Сума (або максимум для піків)."""
+    if not rows:
+        return
+    t = StatRollup.__table__
+    dialect = db.engine.dialect.name
+    ins = pg_insert(t) if dialect == "postgresql" else sqlite_insert(t)
+    if peak:
+        merged = (func.greatest if dialect == "postgresql" else func.max)(t.c.value, ins.excluded.value)
+    else:
+        merged = t.c.value + ins.excluded.value
+    stmt = ins.on_conflict_do_update(
+        index_elements=[t.c.granularity, t.c.bucket, t.c.metric, t.c.dim],
+        set_={"value": merged},
+    )
+    db.session.execute(stmt, rows)
+
+
+def _count_new_active(batch: _Batch):
+    """Дописує нові (бакет, ліцензія) і додає їх кількість до active_licenses."""
+    for (gran, bucket), ids in batch.active.items():
+        ids = list(ids)
+        existing = set()
+        for i in range(0, len(ids), ROLLUP_IN_CHUNK):
+            existing |= set(db.session.execute(
+                select(StatActive.license_id).where(
+                    StatActive.granularity == gran, StatActive.bucket == bucket,
+                    StatActive.license_id.in_(ids[i:i + ROLLUP_IN_CHUNK]),
+                )
+            ).scalars())
+        fresh = [i for i in ids if i not in existing]
+        if fresh:
+            db.session.execute(insert(StatActive), [
+                {"granularity": gran, "bucket": bucket, "license_id": i} for i in fresh
+            ])
+            k = (gran, bucket, "active_licenses", "")
+            batch.counters[k] = batch.counters.get(k, 0) + len(fresh)
+
+
+def _step(name: str) -> int:
+    fetch, fold = SOURCES[name]
+    old = dbutil.watermark(name)
+    settled = datetime.now(timezone.utc) - timedelta(seconds=ROLLUP_SETTLE_SECONDS)
+    rows, new = fetch(old, settled)
+    if new is None:
+        db.session.rollback()
+        return 0
+    batch = _Batch()
+    fold(batch, rows)
+    try:
+        if not dbutil.advance_watermark(name, old, new):
+            db.session.rollback()
+            return 0
+        _count_new_active(batch)
+        _upsert([
+            {"granularity": g, "bucket": b, "metric": m, "dim": d, "value": v}
+            for (g, b, m, d), v in batch.counters.items() if v
+        ])
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return 0
+    return len(rows)
+
+
+def _sample_pool():
+    stats = leases.pool_stats()
+    now = datetime.now(timezone.utc)
+    _upsert([
+        {"granularity": g, "bucket": floor(now, g), "metric": m, "dim": "", "value": int(v)}
+        for g in GRANULARITIES for m, v in (("pool_leased", stats["in_use"]),
+                                            ("pool_total", stats["total"] - stats["inactive"]))
+    ], peak=True)
+    db.session.commit()
+
+
+def _prune():
+    now = datetime.now(timezone.utc)
+    db.session.execute(delete(StatRollup).where(
+        StatRollup.granularity == "hour",
+        StatRollup.bucket < now - timedelta(days=ROLLUP_HOURLY_KEEP_DAYS),
+    ))
+    # distinct-множини потрібні, лише поки в бакет можуть прийти запізнілі рядки
+    db.session.execute(delete(StatActive).where(StatActive.bucket < floor(now, "day") - timedelta(days=2)))
+    db.session.commit()
+
+
+def run() -> int:
+    """Фонова задача: доганяє обидва джерела пакетами, знімає пік пулу, чистить старе."""
+    total = 0
+    for name in SOURCES:
+        for _ in range(ROLLUP_MAX_BATCHES):
+            n = _step(name)
+            total += n
+            if n < ROLLUP_BATCH_SIZE:
+                break
+    _sample_pool()
+    _prune()
+    return total
+
+
+# ---- Читання
+def query(granularity: str, since: datetime, until: datetime) -> dict:
+    """Ряди метрик по бакетах [since, until). Обсяг відповіді залежить від діапазону, не від даних.
+
+    Діапазон, довший за STATS_MAX_BUCKETS, обрізається з боку since — найновіші бакети лишаються.
+    """
+    start, end = floor(since, granularity), floor(until, granularity)
+    step = timedelta(hours=1) if granularity == "hour" else timedelta(days=1)
+    start = max(start, end - (STATS_MAX_BUCKETS[granularity] - 1) * step)
+    buckets = []
+    b = start
+    while b <= end:
+        buckets.append(b)
+        b += step
+    index = {bk: i for i, bk in enumerate(buckets)}
+    rows = db.session.execute(
+        select(StatRollup.bucket, StatRollup.metric, StatRollup.dim, StatRollup.value)
+        .where(StatRollup.granularity == granularity,
+               StatRollup.bucket >= buckets[0], StatRollup.bucket <= buckets[-1])
+    ).all()
+    series, models = {}, {}
+    for bucket, metric, dim, value in rows:
+        i = index.get(floor(bucket, granularity))
+        if i is None:
+            continue
+        target = models.setdefault(dim, {}) if dim else series
+        arr = target.setdefault(metric, [0] * len(buckets))
+        arr[i] += int(value)
+    totals = {}
+    for metric in ("debits", "debit_units", "credits_spent"):
+        series[metric] = [sum(m.get(metric, [0] * len(buckets))[i] for m in models.values())
+                          for i in range(len(buckets))]
+    for metric, arr in series.items():
+        if metric not in NON_ADDITIVE:
+            totals[metric] = sum(arr)
+    marks = {name: last for name, last in db.session.execute(select(StatWatermark.name, StatWatermark.last_id))}
+    return {
+        "granularity": granularity,
+        "buckets": [bk.isoformat() for bk in buckets],
+        "series": series,
+        "models": models,
+        "totals": totals,
+        "watermarks": marks,
+    }
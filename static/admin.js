@@ -1,5 +1,5 @@
 // static/admin.js
-// Amulet Admin Pro — Licenses / API Keys / Config / Prices / Logs (без Voices)
+// Amulet Admin Pro — Licenses / API Keys / Config / Prices / Logs / Stats (без Voices)
 
 (function () {
   const $ = (sel, root = document) => root.querySelector(sel);
@@ -46,6 +46,113 @@
     setTimeout(() => { box.style.opacity = '0'; }, 2200);
   }
 
+  // Значення поля фільтра; datetime-local — місцевий час браузера без зони,
+  // а API без зони вважає час UTC, тож переводимо в ISO з Z
+  function filterValue(form, name, v) {
+    const val = String(v).trim();
+    const el = form.elements[name];
+    if (val && el && el.type === 'datetime-local') {
+      const d = new Date(val);
+      return isNaN(d) ? '' : d.toISOString();
+    }
+    return val;
+  }
+
+  // ===== Keyset-пагінація: сторінки вантажаться на вимогу =====
+  function makePager({ url, table, filter, more, colspan, render }) {
+    const pager = { cursor: null, busy: false };
+    pager.load = async (reset = true) => {
+      if (pager.busy) return;
+      pager.busy = true;
+      const tbody = $(`${table} tbody`);
+      if (reset) {
+        pager.cursor = null;
+        tbody.innerHTML = `<tr><td colspan="${colspan}">Завантаження…</td></tr>`;
+        const all = $(`${table} [data-select-all]`);
+        if (all) all.checked = false;
+      }
+      const params = new URLSearchParams();
+      const form = filter ? $(filter) : null;
+      if (form) {
+        new FormData(form).forEach((v, k) => {
+          const val = filterValue(form, k, v);
+          if (val) params.set(k, val);
+        });
+      }
+      if (pager.cursor) params.set('cursor', pager.cursor);
+      try {
+        const j = await fetchJSON(`${url}?${params}`);
+        const items = j.items || [];
+        if (reset) tbody.innerHTML = items.length ? '' : `<tr><td colspan="${colspan}">—</td></tr>`;
+        items.forEach(row => {
+          const tr = document.createElement('tr');
+          tr.innerHTML = render(row);
+          tbody.appendChild(tr);
+        });
+        pager.cursor = j.next_cursor || null;
+      } catch (e) {
+        if (reset) tbody.innerHTML = `<tr><td colspan="${colspan}" class="error">${escapeHtml(e.message)}</td></tr>`;
+        else toast(e.message, 'error');
+      } finally {
+        pager.busy = false;
+        const btn = $(more);
+        if (btn) btn.classList.toggle('hidden', !pager.cursor);
+      }
+    };
+    const form = filter ? $(filter) : null;
+    if (form) form.addEventListener('submit', (ev) => { ev.preventDefault(); pager.load(true); });
+    const btn = $(more);
+    if (btn) btn.addEventListener('click', () => pager.load(false));
+    return pager;
+  }
+
+  // ===== Масові дії: вибрані рядки або все за поточним фільтром =====
+  function bindBulk({ bar, table, filter, url, reload }) {
+    const box = $(bar);
+    if (!box) return;
+    const selectedIds = () => $$(`${table} tbody input.row-select:checked`).map(cb => parseInt(cb.value, 10));
+    const updateCount = () => {
+      const n = selectedIds().length;
+      $('[data-count]', box).textContent = n ? `вибрано: ${n}` : '';
+    };
+    $(table).addEventListener('change', (ev) => {
+      if (ev.target.matches('[data-select-all]')) {
+        $$(`${table} tbody input.row-select`).forEach(cb => { cb.checked = ev.target.checked; });
+      }
+      updateCount();
+    });
+    box.addEventListener('click', async (ev) => {
+      const btn = ev.target.closest('button[data-scope]');
+      if (!btn) return;
+      const action = $('select[name="action"]', box).value;
+      if (!action) { toast('Оберіть дію', 'warn'); return; }
+      const payload = { action };
+      const amount = $('input[name="amount"]', box);
+      if (amount) payload.amount = parseInt(amount.value || '0', 10) || 0;
+      if (btn.dataset.scope === 'selected') {
+        payload.ids = selectedIds();
+        if (!payload.ids.length) { toast('Нічого не вибрано', 'warn'); return; }
+        if (!confirm(`Застосувати «${action}» до ${payload.ids.length} записів?`)) return;
+      } else {
+        const flt = {};
+        new FormData($(filter)).forEach((v, k) => {
+          const val = filterValue($(filter), k, v);
+          if (val) flt[k] = val;
+        });
+        if (!Object.keys(flt).length) {
+          if (!confirm(`Фільтр порожній — застосувати «${action}» до ВСІХ записів?`)) return;
+          flt.all = true;
+        } else if (!confirm(`Застосувати «${action}» до всіх записів за фільтром?`)) return;
+        payload.filter = flt;
+      }
+      try {
+        const r = await fetchJSON(url, { method: 'POST', body: JSON.stringify(payload) });
+        if (r.ok) { toast(`Змінено записів: ${r.affected}`, 'ok'); reload(); }
+      } catch (e) { toast(e.message, 'error'); }
+    });
+    return updateCount;
+  }
+
   // ===== Tabs =====
   function bindTabs() {
     $$('#nav .tab').forEach(btn => {
@@ -61,18 +168,18 @@
     else if (tab === 'config') loadConfig();
     else if (tab === 'prices') loadPrices();
     else if (tab === 'logs') loadLogs();
+    else if (tab === 'stats') loadStats();
   }
 
   // ===== Licenses =====
-  async function loadLicenses() {
-    const tbody = $('#licensesTable tbody');
-    tbody.innerHTML = '<tr><td colspan="7">Завантаження…</td></tr>';
-    try {
-      const j = await fetchJSON('/admin_api/licenses');
-      tbody.innerHTML = '';
-      (j.items || []).forEach(row => {
-        const tr = document.createElement('tr');
-        tr.innerHTML = `
+  let licensesPager = null;
+  function loadLicenses() {
+    if (!licensesPager) {
+      licensesPager = makePager({
+        url: '/admin_api/licenses', table: '#licensesTable', filter: '#licensesFilter',
+        more: '#licensesMore', colspan: 8,
+        render: row => `
+          <td><input type="checkbox" class="row-select" value="${row.id}"></td>
           <td>${row.id}</td>
           <td><code>${escapeHtml(row.key)}</code></td>
           <td>${row.mac_id ? `<small>${escapeHtml(row.mac_id)}</small>` : '—'}</td>
@@ -80,12 +187,10 @@
           <td><b>${row.credit}</b></td>
           <td>${row.last_active ? new Date(row.last_active).toLocaleString() : '—'}</td>
           <td><button class="btn btn-danger" data-id="${row.id}">Видалити</button></td>
-        `;
-        tbody.appendChild(tr);
+        `,
       });
-    } catch (e) {
-      tbody.innerHTML = `<tr><td colspan="7" class="error">${escapeHtml(e.message)}</td></tr>`;
     }
+    return licensesPager.load(true);
   }
 
   function bindLicenseForm() {
@@ -116,15 +221,14 @@
   }
 
   // ===== API Keys =====
-  async function loadApiKeys() {
-    const tbody = $('#apiKeysTable tbody');
-    tbody.innerHTML = '<tr><td colspan="7">Завантаження…</td></tr>';
-    try {
-      const j = await fetchJSON('/admin_api/apikeys');
-      tbody.innerHTML = '';
-      (j.items || []).forEach(row => {
-        const tr = document.createElement('tr');
-        tr.innerHTML = `
+  let apiKeysPager = null;
+  function loadApiKeys() {
+    if (!apiKeysPager) {
+      apiKeysPager = makePager({
+        url: '/admin_api/apikeys', table: '#apiKeysTable', filter: '#apiKeysFilter',
+        more: '#apiKeysMore', colspan: 8,
+        render: row => `
+          <td><input type="checkbox" class="row-select" value="${row.id}"></td>
           <td>${row.id}</td>
           <td><code>${escapeHtml(row.api_key)}</code></td>
           <td><span class="badge ${row.status === 'active' ? 'ok' : 'bad'}">${row.status}</span></td>
@@ -135,12 +239,10 @@
             <button class="btn btn-secondary" data-act="toggle" data-id="${row.id}">${row.in_use ? 'Відпустити' : 'Зайняти'}</button>
             <button class="btn btn-danger" data-act="del" data-id="${row.id}">Видалити</button>
           </td>
-        `;
-        tbody.appendChild(tr);
+        `,
       });
-    } catch (e) {
-      tbody.innerHTML = `<tr><td colspan="7" class="error">${escapeHtml(e.message)}</td></tr>`;
     }
+    return apiKeysPager.load(true);
   }
 
   function bindApiKeyForm() {
@@ -298,27 +400,90 @@
   }
 
   // ===== Logs =====
-  async function loadLogs() {
-    const tbody = $('#logsTable tbody');
-    tbody.innerHTML = '<tr><td colspan="4">Завантаження…</td></tr>';
-    try {
-      const j = await fetchJSON('/admin_api/logs');
-      tbody.innerHTML = '';
-      (j.items || []).forEach(row => {
-        const tr = document.createElement('tr');
-        tr.innerHTML = `
+  let logsPager = null;
+  function loadLogs() {
+    if (!logsPager) {
+      logsPager = makePager({
+        url: '/admin_api/logs', table: '#logsTable', filter: '#logsFilter',
+        more: '#logsMore', colspan: 4,
+        render: row => `
           <td>${row.id}</td>
-          <td>${row.action}</td>
+          <td>${escapeHtml(row.action)}</td>
           <td>${row.details ? `<code>${escapeHtml(row.details)}</code>` : '—'}</td>
           <td>${row.created_at ? new Date(row.created_at).toLocaleString() : '—'}</td>
-        `;
-        tbody.appendChild(tr);
+        `,
       });
+    }
+    return logsPager.load(true);
+  }
+
+  // ===== Stats (готові зведення, без сканування сирих таблиць) =====
+  const STAT_LABELS = {
+    checks: 'Перевірок', debits: 'Списань', debit_units: 'Одиниць', credits_spent: 'Кредитів',
+    leases: 'Lease', lease_empty: 'Без ключа', releases: 'Release',
+  };
+
+  async function loadStats() {
+    const form = $('#statsFilter');
+    const tbody = $('#statsTable tbody');
+    const mbody = $('#statsModelsTable tbody');
+    const totals = $('#statsTotals');
+    tbody.innerHTML = '<tr><td colspan="8">Завантаження…</td></tr>';
+    const params = new URLSearchParams();
+    new FormData(form).forEach((v, k) => {
+      const val = filterValue(form, k, v);
+      if (val) params.set(k, val);
+    });
+    try {
+      const j = await fetchJSON(`/admin_api/stats?${params}`);
+      const s = j.series || {};
+      const col = (m, i) => (s[m] ? s[m][i] : 0);
+      const hourly = j.granularity === 'hour';
+
+      totals.innerHTML = Object.entries(STAT_LABELS).map(([m, label]) =>
+        `<div class="stat"><b>${(j.totals || {})[m] ?? 0}</b><span>${label}</span></div>`).join('');
+
+      const models = Object.entries(j.models || {}).map(([model, ser]) => ({
+        model,
+        debits: (ser.debits || []).reduce((a, b) => a + b, 0),
+        units: (ser.debit_units || []).reduce((a, b) => a + b, 0),
+        spent: (ser.credits_spent || []).reduce((a, b) => a + b, 0),
+      })).sort((a, b) => b.spent - a.spent);
+      mbody.innerHTML = models.length ? models.map(r => `
+        <tr>
+          <td><code>${escapeHtml(r.model)}</code></td>
+          <td>${r.debits}</td>
+          <td>${r.units}</td>
+          <td>${r.spent}</td>
+        </tr>`).join('') : '<tr><td colspan="4">—</td></tr>';
+
+      const maxChecks = Math.max(1, ...(s.checks || [0]));
+      const rows = (j.buckets || []).map((b, i) => ({ b, i })).reverse();
+      tbody.innerHTML = rows.map(({ b, i }) => {
+        const d = new Date(b);
+        const width = Math.round(60 * col('checks', i) / maxChecks);
+        return `
+        <tr>
+          <td>${hourly ? d.toLocaleString() : d.toLocaleDateString()}</td>
+          <td>${col('checks', i)}<span class="bar" style="width:${width}px"></span></td>
+          <td>${col('active_licenses', i)}</td>
+          <td>${col('debits', i)}</td>
+          <td>${col('credits_spent', i)}</td>
+          <td>${col('leases', i)}</td>
+          <td>${col('lease_empty', i)}</td>
+          <td>${col('pool_leased', i)} / ${col('pool_total', i)}</td>
+        </tr>`;
+      }).join('') || '<tr><td colspan="8">—</td></tr>';
     } catch (e) {
-      tbody.innerHTML = `<tr><td colspan="4" class="error">${escapeHtml(e.message)}</td></tr>`;
+      tbody.innerHTML = `<tr><td colspan="8" class="error">${escapeHtml(e.message)}</td></tr>`;
     }
   }
 
+  function bindStatsForm() {
+    const form = $('#statsFilter');
+    if (form) form.addEventListener('submit', (ev) => { ev.preventDefault(); loadStats(); });
+  }
+
   // ===== Init =====
   function init() {
     bindTabs();
@@ -326,6 +491,15 @@
     bindApiKeyForm();
     bindConfigForm();
     bindPricesForm();
+    bindStatsForm();
+    bindBulk({
+      bar: '#licensesBulk', table: '#licensesTable', filter: '#licensesFilter',
+      url: '/admin_api/licenses/bulk', reload: loadLicenses,
+    });
+    bindBulk({
+      bar: '#apiKeysBulk', table: '#apiKeysTable', filter: '#apiKeysFilter',
+      url: '/admin_api/apikeys/bulk', reload: loadApiKeys,
+    });
     setTab(state.tab);
   }
 
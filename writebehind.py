@@ -0,0 +1,66 @@
+# writebehind.py
+# -*- coding: utf-8 -*-
+"""Відкладений запис License.last_active.
+
+/license/check лише кладе час у буфер воркера; фоновий flush() кожні
+LAST_ACTIVE_FLUSH_INTERVAL секунд пише все одним executemany UPDATE.
+Якщо в БД last_active свіжіший за LAST_ACTIVE_MAX_STALENESS, запис не потрібен взагалі.
+"""
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import update, bindparam, or_
+
+from models import db, License
+import dbutil
+import metrics
+
+LAST_ACTIVE_FLUSH_INTERVAL = float(os.getenv("LAST_ACTIVE_FLUSH_INTERVAL", "15"))   # сек
+LAST_ACTIVE_MAX_STALENESS = float(os.getenv("LAST_ACTIVE_MAX_STALENESS", "60"))     # сек
+
+_lock = threading.Lock()
+_pending = {}  # license.id -> datetime
+
+
+def touch(license_id: int, stored_last_active=None):
+    """Відмічає активність ліцензії; stored_last_active — значення, вже прочитане з БД."""
+    now = datetime.now(timezone.utc)
+    stored = dbutil.aware(stored_last_active)
+    if stored is not None and now - stored < timedelta(seconds=LAST_ACTIVE_MAX_STALENESS):
+        return
+    with _lock:
+        _pending[license_id] = now
+
+
+@metrics.gauge_source
+def _pending_gauge():
+    return [("amulet_last_active_pending", (), float(len(_pending)))]
+
+
+def flush() -> int:
+    """Пише накопичені таймстемпи одним bulk UPDATE. Повертає кількість записів."""
+    global _pending
+    with _lock:
+        batch, _pending = _pending, {}
+    if not batch:
+        return 0
+    t = License.__table__
+    stmt = (
+        update(t)
+        .where(t.c.id == bindparam("lic_id"))
+        # не відкочуємо назад час, який уже записав debit чи інший воркер
+        .where(or_(t.c.last_active.is_(None), t.c.last_active < bindparam("ts")))
+        .values(last_active=bindparam("ts"))
+    )
+    try:
+        db.session.execute(stmt, [{"lic_id": k, "ts": v} for k, v in batch.items()])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        with _lock:
+            for k, v in batch.items():
+                if k not in _pending or _pending[k] < v:
+                    _pending[k] = v
+        raise
+    return len(batch)